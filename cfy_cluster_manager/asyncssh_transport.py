@@ -0,0 +1,265 @@
+import os
+import sys
+import stat
+import asyncio
+import threading
+from os.path import basename, expanduser, join, normpath, relpath
+
+try:
+    import asyncssh
+    from asyncssh.encryption import get_default_encryption_algs
+except ImportError:
+    asyncssh = None
+
+from .exceptions import (CommandTimeoutError, RemoteTransportError,
+                         SSHConnectionError)
+from .throttle import upload_throttle
+from .transport import (CommandResult, DEFAULT_SFTP_REQUEST_SIZE,
+                        KEEPALIVE_INTERVAL, prefer, SSH_PORT, Transport)
+
+KEEPALIVE_COUNT_MAX = 3
+# The SFTP writes of an upload waiting for the server at the same time
+DEFAULT_SFTP_MAX_REQUESTS = 128
+COMPRESSION_ALGS = ['zlib@openssh.com', 'zlib', 'none']
+
+
+class EventLoopThread(object):
+    """An asyncio event loop running in a daemon thread.
+
+    All the asyncssh transports share a single loop, so any number of
+    concurrent remote operations costs a single thread. The blocking `VM`
+    interface hands coroutines over to the loop and waits for their results.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        name='cfy-cluster-manager-asyncssh')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+_event_loop_thread = None
+_event_loop_thread_lock = threading.Lock()
+
+
+def get_event_loop_thread():
+    global _event_loop_thread
+    with _event_loop_thread_lock:
+        if _event_loop_thread is None:
+            _event_loop_thread = EventLoopThread()
+        return _event_loop_thread
+
+
+def run_concurrently(coroutines):
+    """Run coroutines concurrently on the shared event loop.
+
+    This is the way to fan out operations to many nodes, e.g.
+    `run_concurrently(t.async_run('uptime') for t in transports)`.
+
+    :return: The results in the coroutines' order. A coroutine that raised
+             has the exception as its result.
+    """
+    async def _gather():
+        return await asyncio.gather(*coroutines, return_exceptions=True)
+    return get_event_loop_thread().run(_gather())
+
+
+class AsyncSSHTransport(Transport):
+    """Run remote operations using asyncssh.
+
+    A single connection to the host is kept open and shared by all
+    operations, each running on its own SSH channel. The connection sends
+    keepalives, so it breaks soon after the host stops answering. Uploads
+    pipeline up to `sftp_max_requests` SFTP writes.
+
+    :param ciphers: The ciphers to prefer, e.g. ['aes128-gcm@openssh.com'].
+    :param compression: Whether to compress the SSH connection.
+    :param sftp_request_size: The size of the SFTP writes, in bytes.
+    :param sftp_max_requests: The SFTP writes waiting for the server at the
+                              same time.
+    """
+    name = 'asyncssh'
+
+    def __init__(self, host, username, key_file_path=None, password=None,
+                 port=SSH_PORT, **options):
+        super(AsyncSSHTransport, self).__init__(
+            host, username, key_file_path, password, port, **options)
+        self.ciphers = options.get('ciphers')
+        self.compression = options.get('compression', False)
+        self.sftp_request_size = options.get('sftp_request_size',
+                                             DEFAULT_SFTP_REQUEST_SIZE)
+        self.sftp_max_requests = options.get('sftp_max_requests',
+                                             DEFAULT_SFTP_MAX_REQUESTS)
+        self._connection = None
+        self._connect_lock = None
+        self._event_loop_thread = get_event_loop_thread()
+
+    async def _get_connection(self, connect_timeout):
+        if self._connect_lock is None:
+            # Created here so it's bound to the shared loop
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._connection is None or self._connection.is_closed():
+                self._connection = await self._connect(connect_timeout)
+                self.connections += 1
+            return self._connection
+
+    async def _connect(self, connect_timeout):
+        connect_kwargs = {
+            'host': self.host,
+            'port': self.port,
+            'username': self.username,
+            'known_hosts': None,
+            'keepalive_interval': KEEPALIVE_INTERVAL,
+            'keepalive_count_max': KEEPALIVE_COUNT_MAX
+        }
+        if self.key_file_path:
+            connect_kwargs['client_keys'] = [self.key_file_path]
+        else:
+            connect_kwargs['password'] = self.password
+        if self.ciphers:
+            connect_kwargs['encryption_algs'] = prefer(
+                self.ciphers, [alg.decode() for alg in
+                               get_default_encryption_algs()])
+        if self.compression:
+            connect_kwargs['compression_algs'] = COMPRESSION_ALGS
+        try:
+            return await asyncio.wait_for(asyncssh.connect(**connect_kwargs),
+                                          connect_timeout)
+        except (OSError, asyncssh.Error, asyncio.TimeoutError) as exc:
+            raise SSHConnectionError(
+                "SSH: could not connect to {host} (username: {user}, "
+                "key: {key}): {exc}".format(
+                    host=self.host, user=self.username,
+                    key=self.key_file_path, exc=str(exc) or 'timed out'),
+                # Bad credentials won't get better by retrying
+                transient=not isinstance(exc, asyncssh.PermissionDenied))
+
+    async def async_test_connection(self, connect_timeout=None):
+        await self._get_connection(connect_timeout)
+
+    async def async_run(self, command, use_sudo=False, connect_timeout=None,
+                        timeout=None):
+        connection = await self._get_connection(connect_timeout)
+        full_command = ("sudo -S -p '' " + command) if use_sudo else command
+        try:
+            process = await asyncio.wait_for(
+                connection.run(full_command, check=False), timeout)
+        except asyncio.TimeoutError:
+            raise CommandTimeoutError(
+                'The command `{0}` on host {1} timed out after {2} '
+                'seconds'.format(command, self.host, int(timeout)))
+        except asyncssh.ChannelOpenError as exc:
+            # The command never started, so this is like a failed connection
+            raise SSHConnectionError(
+                'SSH: could not open a channel to {0}: {1}'.format(
+                    self.host, exc))
+        except (OSError, asyncssh.Error) as exc:
+            raise RemoteTransportError(
+                'The connection to {0} broke while running `{1}`: '
+                '{2}'.format(self.host, command, exc))
+        return CommandResult(command, process.stdout, process.stderr,
+                             process.returncode)
+
+    async def _put(self, sftp, local_path, remote_path):
+        """Upload a file, waiting for the upload throttle if it's set.
+
+        The remote file gets the local file's mode, like fabric gives it.
+        """
+        if not upload_throttle.enabled:
+            await sftp.put(local_path, remote_path, preserve=True,
+                           block_size=self.sftp_request_size,
+                           max_requests=self.sftp_max_requests)
+            return
+        if await sftp.isdir(remote_path):
+            remote_path = join(remote_path, basename(local_path))
+        writes = set()
+        try:
+            async with sftp.open(remote_path, 'wb') as remote_file:
+                await self._pipelined_write(local_path, remote_file, writes)
+        finally:
+            for write in writes:
+                write.cancel()
+        await sftp.chmod(remote_path,
+                         stat.S_IMODE(os.stat(local_path).st_mode))
+
+    async def _pipelined_write(self, local_path, remote_file, writes):
+        with open(local_path, 'rb') as local_file:
+            offset = 0
+            while True:
+                data = local_file.read(self.sftp_request_size)
+                if not data:
+                    break
+                await asyncio.sleep(
+                    upload_throttle.reserve(self.host, len(data)))
+                if len(writes) >= self.sftp_max_requests:
+                    done, _ = await asyncio.wait(
+                        writes, return_when=asyncio.FIRST_COMPLETED)
+                    for write in done:
+                        writes.remove(write)
+                        write.result()
+                writes.add(asyncio.ensure_future(
+                    remote_file.write(data, offset)))
+                offset += len(data)
+        while writes:
+            await writes.pop()
+
+    async def async_put_file(self, local_path, remote_path,
+                             connect_timeout=None):
+        connection = await self._get_connection(connect_timeout)
+        try:
+            async with connection.start_sftp_client() as sftp:
+                await self._put(sftp, expanduser(local_path), remote_path)
+        except (OSError, asyncssh.Error) as exc:
+            raise RemoteTransportError('Failed copying {0} to {1}: {2}'.format(
+                local_path, self.host, exc))
+
+    async def async_put_dir(self, local_dir_path, remote_dir_path,
+                            connect_timeout=None):
+        """Copy a directory's content, copying each directory's files
+        concurrently over a single SFTP session."""
+        connection = await self._get_connection(connect_timeout)
+        try:
+            async with connection.start_sftp_client() as sftp:
+                for dir_path, _, file_names in os.walk(local_dir_path):
+                    remote_path = normpath(join(
+                        remote_dir_path, relpath(dir_path, local_dir_path)))
+                    await sftp.makedirs(remote_path, exist_ok=True)
+                    await asyncio.gather(*[
+                        self._put(sftp, join(dir_path, file_name),
+                                  join(remote_path, file_name))
+                        for file_name in file_names])
+        except (OSError, asyncssh.Error) as exc:
+            raise RemoteTransportError('Failed copying {0} to {1}: {2}'.format(
+                local_dir_path, self.host, exc))
+
+    async def async_close(self):
+        if self._connection is not None:
+            self._connection.close()
+            await self._connection.wait_closed()
+            self._connection = None
+
+    def test_connection(self, connect_timeout):
+        self._event_loop_thread.run(
+            self.async_test_connection(connect_timeout))
+
+    def run(self, command, use_sudo, hide_stdout, connect_timeout, timeout):
+        result = self._event_loop_thread.run(
+            self.async_run(command, use_sudo, connect_timeout, timeout))
+        if not hide_stdout and result.stdout:
+            sys.stdout.write(result.stdout)
+        return result
+
+    def put_file(self, local_path, remote_path, connect_timeout):
+        self._event_loop_thread.run(
+            self.async_put_file(local_path, remote_path, connect_timeout))
+
+    def put_dir(self, local_dir_path, remote_dir_path, connect_timeout):
+        self._event_loop_thread.run(self.async_put_dir(
+            local_dir_path, remote_dir_path, connect_timeout))
+
+    def close(self):
+        self._event_loop_thread.run(self.async_close())
@@ -0,0 +1,465 @@
+"""Benchmark the cluster orchestration against simulated instances.
+
+Every scenario runs the real `install`, `remove`, `upgrade`,
+`install --validate` or `install --override --fast-reset` (`reset`) flow
+using the `fake` transport, and records its wall time together with the
+SSH handshakes, remote commands, uploaded files and bytes it cost. The
+results can be compared to a baseline in order to catch regressions in the
+orchestration cost.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from contextlib import contextmanager
+from os.path import join
+
+import yaml
+import paramiko
+
+from . import main as cluster_manager
+from .concurrency import (concurrency_limiter, DEFAULT_MAX_PARALLEL,
+                          DEFAULT_MIN_PARALLEL)
+from .fake_transport import get_fake_cluster
+from .logger import get_cfy_cluster_manager_logger
+from .ssh_harness import SSHServerHarness
+from .throttle import transfer_stats
+from .utils import CONNECT_TIMEOUT, VM, write_dict_to_yaml_file
+
+logger = get_cfy_cluster_manager_logger()
+
+TOPOLOGIES = ('three-nodes', 'nine-nodes', 'external-db', 'large')
+OPERATIONS = ('validate', 'install', 'upgrade', 'remove', 'reset')
+METRICS = ('wall_time', 'handshakes', 'commands', 'sudo_commands', 'files',
+           'bytes')
+COUNTERS = METRICS[1:]
+PROTOCOL_TRANSPORTS = ('fabric', 'asyncssh')
+PROTOCOL_METRICS = ('wall_time', 'handshakes', 'channels', 'commands',
+                    'sftp_requests', 'sftp_bytes', 'bytes_received',
+                    'bytes_sent')
+THROUGHPUT_METRICS = ('wall_time', 'throughput', 'sftp_requests')
+
+LARGE_TOPOLOGY_NODES_PER_TYPE = 7
+DEFAULT_LATENCY = 0.02
+DEFAULT_BANDWIDTH = 10 * 1024 * 1024
+DEFAULT_RPM_SIZE = 1024 * 1024
+DEFAULT_POLL_INTERVAL = 0.1
+DEFAULT_TOLERANCE = 0.1
+PROTOCOL_COMMANDS = 10
+PROTOCOL_FILES = 10
+THROUGHPUT_LATENCIES = (0, 0.02, 0.1)
+DEFAULT_THROUGHPUT_FILE_SIZE = 32 * 1024 * 1024
+
+TOPOLOGY_TEMPLATES = {
+    'three-nodes': 'cfy_three_nodes_cluster_config.yaml',
+    'nine-nodes': 'cfy_nine_nodes_cluster_config.yaml',
+    'external-db': 'cfy_three_nodes_external_db_cluster_config.yaml',
+    'large': 'cfy_nine_nodes_cluster_config.yaml',
+}
+
+
+def _write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+
+
+def _get_topology_config(topology, work_dir):
+    """Build a complete configuration file for the topology.
+
+    The configuration is based on the one `generate-config` creates, so the
+    benchmark follows the configuration file format.
+    """
+    template_path = join(work_dir, 'template.yaml')
+    cluster_manager._handle_cluster_config_file(TOPOLOGY_TEMPLATES[topology],
+                                                template_path)
+    with open(template_path) as template_file:
+        config = yaml.safe_load(template_file)
+
+    key_path = join(work_dir, 'key.pem')
+    license_path = join(work_dir, 'license.yaml')
+    _write_file(key_path, 0)
+    _write_file(license_path, 0)
+    config.update({'ssh_user': 'centos',
+                   'ssh_key_path': key_path,
+                   'cloudify_license_path': license_path})
+
+    if topology == 'large':
+        node_template = config['existing_vms']['manager-1']
+        config['existing_vms'] = dict(
+            ('{0}-{1}'.format(node_type, i + 1), dict(node_template))
+            for node_type in ('postgresql', 'rabbitmq', 'manager')
+            for i in range(LARGE_TOPOLOGY_NODES_PER_TYPE))
+
+    for i, node_name in enumerate(sorted(config['existing_vms'])):
+        node_dict = config['existing_vms'][node_name]
+        node_dict['private_ip'] = '10.0.{0}.{1}'.format(i // 250, i % 250 + 1)
+        node_dict['public_ip'] = node_dict['private_ip']
+
+    if topology == 'external-db':
+        ca_path = join(work_dir, 'external_db_ca.pem')
+        _write_file(ca_path, 0)
+        config['external_db_configuration'].update({
+            'host': 'db.example.com', 'ca_path': ca_path,
+            'server_db_name': 'postgres', 'server_username': 'postgres',
+            'server_password': 'postgres', 'cloudify_password': 'cloudify'})
+    return config
+
+
+@contextmanager
+def _simulated_local_environment(work_dir, rpm_size, poll_interval):
+    """Point the local side of the cluster manager to `work_dir`.
+
+    The local machine's RPM installation and certificates generation are
+    skipped, since they are not part of the orchestration cost.
+    """
+    install_dir = join(work_dir, cluster_manager.DIR_NAME)
+    certs_dir = join(install_dir, cluster_manager.CERTS_DIR_NAME)
+
+    def install_cloudify_locally(rpm_path):
+        _write_file(join(install_dir, cluster_manager.RPM_NAME), rpm_size)
+
+    overrides = {
+        'CLUSTER_INSTALL_DIR': install_dir,
+        'RPM_PATH': join(install_dir, cluster_manager.RPM_NAME),
+        'CERTS_DIR': certs_dir,
+        'CONFIG_FILES_DIR': join(install_dir, cluster_manager.CONFIG_FILES),
+        'CA_PATH': join(certs_dir, 'ca.pem'),
+        'EXTERNAL_DB_CA_PATH': join(certs_dir, 'external_db_ca.pem'),
+        'LDAP_CA_PATH': join(certs_dir, 'ldap_ca.pem'),
+        'CREDENTIALS_FILE_PATH': join(work_dir, 'secret_credentials.yaml'),
+        'UNIT_POLL_INTERVAL': poll_interval,
+        'yum_is_present': lambda: True,
+        '_install_cloudify_locally': install_cloudify_locally,
+        '_generate_certs': lambda instances_dict: None,
+    }
+    originals = dict((name, getattr(cluster_manager, name))
+                     for name in overrides)
+    for name, value in overrides.items():
+        setattr(cluster_manager, name, value)
+    try:
+        yield
+    finally:
+        for name, value in originals.items():
+            setattr(cluster_manager, name, value)
+
+
+def run_scenario(topology, operation, latency=DEFAULT_LATENCY,
+                 bandwidth=DEFAULT_BANDWIDTH, rpm_size=DEFAULT_RPM_SIZE,
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+    """Run a single operation on a fresh simulated cluster.
+
+    `upgrade`, `remove` and `reset` are measured on an installed cluster,
+    but the installation itself is not measured.
+
+    :return: A dict of the measured METRICS.
+    """
+    work_dir = tempfile.mkdtemp(prefix='cfy-cluster-manager-bench-')
+    concurrency_limiter.configure(DEFAULT_MIN_PARALLEL, DEFAULT_MAX_PARALLEL)
+    transfer_stats.reset()
+    try:
+        config = _get_topology_config(topology, work_dir)
+        config['transport'] = 'fake'
+        config['transport_options'] = {
+            'root_dir': join(work_dir, 'fake_cluster'),
+            'latency': latency,
+            'bandwidth': bandwidth
+        }
+        config_path = join(work_dir, 'cluster_config.yaml')
+        write_dict_to_yaml_file(config, config_path)
+        cluster = get_fake_cluster(**config['transport_options'])
+
+        with _simulated_local_environment(work_dir, rpm_size, poll_interval):
+            if operation in ('upgrade', 'remove', 'reset'):
+                cluster_manager.install(config_path, False, False, False)
+            before = cluster.totals()
+            start_time = time.time()
+            if operation == 'validate':
+                cluster_manager.install(config_path, False, True, False)
+            elif operation == 'install':
+                cluster_manager.install(config_path, False, False, False)
+            elif operation == 'upgrade':
+                upgrade_rpm_path = join(work_dir, 'upgrade.rpm')
+                _write_file(upgrade_rpm_path, rpm_size)
+                cluster_manager.upgrade(config_path, False, upgrade_rpm_path)
+            elif operation == 'remove':
+                cluster_manager.remove(config_path, False)
+            elif operation == 'reset':
+                cluster_manager.install(config_path, True, False, False,
+                                        fast_reset=True)
+            wall_time = time.time() - start_time
+
+        counters = cluster.totals()
+        counters.subtract(before)
+        result = dict((counter, counters[counter]) for counter in COUNTERS)
+        result['wall_time'] = round(wall_time, 3)
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_benchmarks(topologies=TOPOLOGIES, operations=OPERATIONS, **settings):
+    """Run all combinations of topologies and operations.
+
+    :return: A dict of the settings and of each scenario's results, keyed
+             by `<topology>/<operation>`.
+    """
+    results = {}
+    for topology in topologies:
+        for operation in operations:
+            scenario = '{0}/{1}'.format(topology, operation)
+            sys.stderr.write('Running {0}\n'.format(scenario))
+            results[scenario] = run_scenario(topology, operation, **settings)
+    return {'settings': settings, 'results': results}
+
+
+def run_protocol_scenario(transport, latency=DEFAULT_LATENCY,
+                          file_size=DEFAULT_RPM_SIZE,
+                          commands=PROTOCOL_COMMANDS, files=PROTOCOL_FILES):
+    """Run `VM` operations over SSH against a loopback SSH server.
+
+    Unlike the orchestration scenarios, this runs the real SSH client code,
+    so it measures the protocol cost of the `VM` layer: `commands` remote
+    commands, a single file upload and a directory of `files` files upload.
+
+    :return: A dict of the measured PROTOCOL_METRICS.
+    """
+    work_dir = tempfile.mkdtemp(prefix='cfy-cluster-manager-bench-')
+    try:
+        key_path = join(work_dir, 'key.pem')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+        local_dir = join(work_dir, 'files')
+        os.mkdir(local_dir)
+        for i in range(files):
+            _write_file(join(local_dir, 'file-{0}'.format(i)), file_size)
+
+        with SSHServerHarness(join(work_dir, 'hosts'),
+                              delay=latency) as server:
+            vm = VM(server.host, server.host, key_path, 'centos',
+                    transport=transport,
+                    transport_options={'port': server.port})
+            start_time = time.time()
+            for _ in range(commands):
+                vm.run_command('test -e /tmp', hide_stdout=True,
+                               idempotent=True)
+            vm.put_file(join(local_dir, 'file-0'), '/tmp/file')
+            vm.put_dir(local_dir, '/tmp/files')
+            wall_time = time.time() - start_time
+            vm.transport.close()
+
+        stats = server.stats
+        result = dict((metric, stats[metric])
+                      for metric in PROTOCOL_METRICS[1:])
+        result['wall_time'] = round(wall_time, 3)
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_protocol_benchmarks(transports=PROTOCOL_TRANSPORTS, **settings):
+    results = {}
+    for transport in transports:
+        scenario = 'protocol/{0}'.format(transport)
+        sys.stderr.write('Running {0}\n'.format(scenario))
+        results[scenario] = run_protocol_scenario(transport, **settings)
+    return {'settings': settings, 'results': results}
+
+
+def run_throughput_scenario(transport, latency,
+                            file_size=DEFAULT_THROUGHPUT_FILE_SIZE,
+                            transport_options=None):
+    """Upload a single large file over SSH to a loopback SSH server.
+
+    The wall time includes opening the connection, when the transport opens
+    one for every operation.
+
+    :return: A dict of the measured THROUGHPUT_METRICS. The throughput is in
+             bytes per second.
+    """
+    work_dir = tempfile.mkdtemp(prefix='cfy-cluster-manager-bench-')
+    try:
+        key_path = join(work_dir, 'key.pem')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+        local_path = join(work_dir, 'cloudify.rpm')
+        _write_file(local_path, file_size)
+
+        with SSHServerHarness(join(work_dir, 'hosts'),
+                              delay=latency) as server:
+            options = dict(transport_options or {}, port=server.port)
+            vm = VM(server.host, server.host, key_path, 'centos',
+                    transport=transport, transport_options=options)
+            vm.test_connection()
+            server.reset_stats()
+            start_time = time.time()
+            vm.transport.put_file(local_path, '/tmp/cloudify.rpm',
+                                  CONNECT_TIMEOUT)
+            wall_time = time.time() - start_time
+            vm.transport.close()
+
+        return {'wall_time': round(wall_time, 3),
+                'throughput': int(file_size / wall_time),
+                'sftp_requests': server.stats['sftp_requests']}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_throughput_benchmarks(transports=PROTOCOL_TRANSPORTS,
+                              latencies=THROUGHPUT_LATENCIES, **settings):
+    results = {}
+    for transport in transports:
+        for latency in latencies:
+            scenario = 'throughput/{0}/{1}ms'.format(
+                transport, int(latency * 1000))
+            sys.stderr.write('Running {0}\n'.format(scenario))
+            results[scenario] = run_throughput_scenario(transport, latency,
+                                                        **settings)
+    settings['latencies'] = list(latencies)
+    return {'settings': settings, 'results': results}
+
+
+def _transport_option(value):
+    key, separator, option_value = value.partition('=')
+    if not separator:
+        raise argparse.ArgumentTypeError(
+            'expected KEY=VALUE, got {0}'.format(value))
+    return key, yaml.safe_load(option_value)
+
+
+def compare_results(results, baseline, tolerance=DEFAULT_TOLERANCE,
+                    metrics=METRICS):
+    """Compare results to a baseline.
+
+    :return: A list of regression descriptions. A metric regressed if it's
+             higher than its baseline value by more than `tolerance`.
+    """
+    regressions = []
+    for scenario, baseline_metrics in sorted(baseline['results'].items()):
+        scenario_metrics = results['results'].get(scenario)
+        if not scenario_metrics:
+            continue
+        for metric in metrics:
+            value = scenario_metrics[metric]
+            baseline_value = baseline_metrics[metric]
+            if value > baseline_value * (1 + tolerance):
+                regressions.append(
+                    '{0}: {1} went up from {2} to {3}'.format(
+                        scenario, metric, baseline_value, value))
+    return regressions
+
+
+def format_results(results, metrics=METRICS):
+    lines = ['{0:<24}'.format('scenario') +
+             ''.join('{0:>15}'.format(metric) for metric in metrics)]
+    for scenario, scenario_metrics in sorted(results['results'].items()):
+        lines.append('{0:<24}'.format(scenario) + ''.join(
+            '{0:>15}'.format(scenario_metrics[metric])
+            for metric in metrics))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Cloudify cluster orchestration against '
+                    'simulated instances')
+    parser.add_argument(
+        '--topology', action='append', choices=TOPOLOGIES,
+        help='A topology to benchmark. Can be passed multiple times. '
+             'Default: all topologies')
+    parser.add_argument(
+        '--operation', action='append', choices=OPERATIONS,
+        help='An operation to benchmark. Can be passed multiple times. '
+             'Default: all operations')
+    parser.add_argument(
+        '--protocol', action='store_true', default=False,
+        help='Instead of the orchestration, benchmark the SSH protocol cost '
+             'of remote commands and file uploads, using the real SSH '
+             'clients against a loopback SSH server')
+    parser.add_argument(
+        '--throughput', action='store_true', default=False,
+        help='Instead of the orchestration, benchmark the upload throughput '
+             'of a single large file using the real SSH clients against a '
+             'loopback SSH server, at several round trip times')
+    parser.add_argument(
+        '--transport', action='append', choices=PROTOCOL_TRANSPORTS,
+        help='A transport to benchmark with --protocol or --throughput. Can '
+             'be passed multiple times. Default: all SSH transports')
+    parser.add_argument(
+        '--transport-option', action='append', type=_transport_option,
+        metavar='KEY=VALUE',
+        help='A transport option used with --throughput, e.g. '
+             'compression=true. Can be passed multiple times')
+    parser.add_argument(
+        '--latency', type=float, action='append',
+        help='The simulated network round trip time, in seconds. With '
+             '--throughput, it can be passed multiple times. '
+             'Default: {0}, or {1} with --throughput'.format(
+                 DEFAULT_LATENCY,
+                 ', '.join(str(latency)
+                           for latency in THROUGHPUT_LATENCIES)))
+    parser.add_argument(
+        '--bandwidth', type=int, default=DEFAULT_BANDWIDTH,
+        help='The simulated upload bandwidth, in bytes per second. '
+             'Default: {0}'.format(DEFAULT_BANDWIDTH))
+    parser.add_argument(
+        '--rpm-size', type=int,
+        help='The size of the simulated RPMs (or of the uploaded files '
+             'with --protocol or --throughput), in bytes. '
+             'Default: {0}, or {1} with --throughput'.format(
+                 DEFAULT_RPM_SIZE, DEFAULT_THROUGHPUT_FILE_SIZE))
+    parser.add_argument(
+        '-o', '--output', help='Save the results to this JSON file')
+    parser.add_argument(
+        '--compare', metavar='BASELINE',
+        help='Compare the results to a baseline JSON file, and fail if any '
+             'of them regressed')
+    parser.add_argument(
+        '--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help='The relative increase over the baseline that is considered a '
+             'regression. Default: {0}'.format(DEFAULT_TOLERANCE))
+    args = parser.parse_args()
+    # Only the orchestration's errors are of interest here
+    logger.setLevel(logging.ERROR)
+
+    latency = args.latency[-1] if args.latency else DEFAULT_LATENCY
+    if args.throughput:
+        metrics = THROUGHPUT_METRICS
+        results = run_throughput_benchmarks(
+            args.transport or PROTOCOL_TRANSPORTS,
+            args.latency or THROUGHPUT_LATENCIES,
+            file_size=args.rpm_size or DEFAULT_THROUGHPUT_FILE_SIZE,
+            transport_options=dict(args.transport_option or []))
+    elif args.protocol:
+        metrics = PROTOCOL_METRICS
+        results = run_protocol_benchmarks(
+            args.transport or PROTOCOL_TRANSPORTS, latency=latency,
+            file_size=args.rpm_size or DEFAULT_RPM_SIZE)
+    else:
+        metrics = METRICS
+        results = run_benchmarks(args.topology or TOPOLOGIES,
+                                 args.operation or OPERATIONS,
+                                 latency=latency,
+                                 bandwidth=args.bandwidth,
+                                 rpm_size=args.rpm_size or DEFAULT_RPM_SIZE)
+    print(format_results(results, metrics))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        # A higher throughput is better, it's compared by the wall time
+        regressions = compare_results(
+            results, baseline, args.tolerance,
+            [metric for metric in metrics if metric != 'throughput'])
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""The `cfy_cluster_manager` command, and the client of its daemon.
+
+When a `cfy_cluster_manager serve` daemon serves the working directory,
+the commands it serves are sent to it over its Unix socket, and their
+output is streamed back. They then don't pay for the imports, the parsing
+of the configuration file and the SSH connections the daemon already has.
+Any other command, or any command when no daemon is running, runs in this
+process, so this module only imports the standard library.
+"""
+import os
+import sys
+import json
+import socket
+
+SOCKET_NAME = '.cfy_cluster_manager.sock'
+SOCKET_ENV = 'CFY_CLUSTER_MANAGER_SOCKET'
+SERVED_ACTIONS = ('status', 'install', 'reconfigure')
+HELP_FLAGS = ('-h', '--help')
+
+
+def get_socket_path():
+    """The daemon's socket: in the working directory, unless the
+    CFY_CLUSTER_MANAGER_SOCKET environment variable names another one."""
+    return os.environ.get(SOCKET_ENV, SOCKET_NAME)
+
+
+def is_served(argv):
+    return bool(argv) and argv[0] in SERVED_ACTIONS and \
+        not set(argv) & set(HELP_FLAGS)
+
+
+def connect(socket_path):
+    """A connection to the daemon, or None if it isn't running."""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except (IOError, OSError):
+        connection.close()
+        return None
+    return connection
+
+
+def send_message(connection, message):
+    connection.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def send_command(argv, socket_path=None, output=None):
+    """Run a command on the daemon, writing its output to `output`.
+
+    :return: The command's exit code, or None if the daemon isn't running
+             or doesn't serve the command.
+    """
+    if not is_served(argv):
+        return None
+    connection = connect(socket_path or get_socket_path())
+    if connection is None:
+        return None
+    output = output or sys.stdout
+    with connection:
+        send_message(connection, {'argv': argv, 'cwd': os.getcwd()})
+        for line in connection.makefile('r', encoding='utf-8'):
+            message = json.loads(line)
+            if 'log' in message:
+                output.write(message['log'] + '\n')
+                output.flush()
+            elif message.get('refused'):
+                return None
+            elif 'exit_code' in message:
+                return message['exit_code']
+    sys.stderr.write('The cluster manager daemon closed the connection '
+                     'before the command finished\n')
+    return 1
+
+
+def main():
+    exit_code = send_command(sys.argv[1:])
+    if exit_code is not None:
+        sys.exit(exit_code)
+    # Imported only here, so the commands the daemon serves don't pay for it
+    from .main import main as run_locally
+    run_locally()
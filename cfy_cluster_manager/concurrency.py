@@ -0,0 +1,202 @@
+"""An adaptive limit on the remote operations running at the same time.
+
+The limit is adjusted AIMD-style, like TCP's congestion window: it grows by
+one after a window of `limit` operations completed without a sign of
+overload, and it's halved once the instances or the network are
+overloaded. The signs of overload are:
+- An SSH connection failure, e.g. sshd refusing connections beyond its
+  `MaxStartups`, or a connection dropped in the middle of an operation.
+- Latency: the recent operations took much longer than the fastest run of
+  the same operation on the same node type.
+- Throughput: the upload throughput stopped growing with the limit, so
+  the link is saturated. The limit then stops growing.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+from .exceptions import RemoteTransportError
+from .logger import get_cfy_cluster_manager_logger
+
+logger = get_cfy_cluster_manager_logger()
+
+DEFAULT_MIN_PARALLEL = 2
+DEFAULT_MAX_PARALLEL = 8
+DECREASE_FACTOR = 0.5
+LATENCY_TOLERANCE = 2.0
+# Added to the latencies compared, so fast operations' jitter is ignored
+LATENCY_SLACK = 0.05
+THROUGHPUT_GAIN = 0.05
+MIN_WINDOW_UPLOADS = 2
+
+
+class LimitDecision(object):
+    def __init__(self, elapsed, old_limit, new_limit, reason):
+        self.elapsed = elapsed
+        self.old_limit = old_limit
+        self.new_limit = new_limit
+        self.reason = reason
+
+    def __str__(self):
+        return '{0:.1f}s: {1} -> {2}, {3}'.format(
+            self.elapsed, self.old_limit, self.new_limit, self.reason)
+
+
+def _latency_key(operation, node_type):
+    # e.g. "Running `systemctl status ...`" -> "Running `systemctl status"
+    return ' '.join(operation.split()[:3]), node_type
+
+
+class AdaptiveLimiter(object):
+    def __init__(self, floor=DEFAULT_MIN_PARALLEL,
+                 ceiling=DEFAULT_MAX_PARALLEL):
+        self._condition = threading.Condition()
+        self.configure(floor, ceiling)
+
+    def configure(self, floor, ceiling):
+        """Set the bounds, and start over from the floor."""
+        if not 1 <= floor <= ceiling:
+            raise ValueError('The concurrency floor must be between 1 and '
+                             'the ceiling, got {0} and {1}'.format(floor,
+                                                                   ceiling))
+        with self._condition:
+            self.floor = floor
+            self.ceiling = ceiling
+            self.limit = floor
+            self.in_flight = 0
+            self.decisions = []
+            self._start_time = time.time()
+            self._last_decrease = 0
+            self._min_latencies = {}
+            self._best_throughput = 0
+            self._best_limit = floor
+            self._uploads_in_flight = 0
+            self._upload_busy_since = None
+            self._reset_window()
+            self._condition.notify_all()
+
+    def _reset_window(self):
+        self._window_operations = 0
+        self._window_latencies = []
+        self._window_uploads = 0
+        self._window_bytes = 0
+        self._window_upload_time = 0
+
+    @contextmanager
+    def slot(self, operation, size=0, node_type=None):
+        """Run an operation once there's room for it.
+
+        :param size: The number of bytes the operation uploads.
+        :param node_type: The type of the node the operation runs on, since
+                          the same operation takes longer on some types.
+        """
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+            if size:
+                self._upload_started()
+        start_time = time.time()
+        outcome = 'failure'
+        try:
+            yield
+            outcome = 'success'
+        except RemoteTransportError as exc:
+            outcome = 'overload' if getattr(exc, 'transient', True) \
+                else 'failure'
+            raise
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                if size:
+                    self._upload_finished()
+                self._complete(operation, node_type, start_time,
+                               time.time() - start_time, size, outcome)
+                self._condition.notify_all()
+
+    def _upload_started(self):
+        if not self._uploads_in_flight:
+            self._upload_busy_since = time.time()
+        self._uploads_in_flight += 1
+
+    def _upload_finished(self):
+        self._uploads_in_flight -= 1
+        if not self._uploads_in_flight:
+            self._window_upload_time += time.time() - self._upload_busy_since
+
+    def _complete(self, operation, node_type, start_time, duration, size,
+                  outcome):
+        if outcome == 'overload':
+            # Operations started before the last decrease ran with the
+            # higher limit, so they don't decrease it again
+            if start_time >= self._last_decrease:
+                self._decrease('an SSH connection failed during '
+                               '"{0}"'.format(operation))
+            return
+        if outcome != 'success':
+            return
+        self._window_operations += 1
+        if size:
+            self._window_uploads += 1
+            self._window_bytes += size
+        else:
+            key = _latency_key(operation, node_type)
+            min_latency = min(self._min_latencies.get(key, duration),
+                              duration)
+            self._min_latencies[key] = min_latency
+            self._window_latencies.append(
+                (duration + LATENCY_SLACK) / (min_latency + LATENCY_SLACK))
+        if self._window_operations >= self.limit:
+            self._evaluate_window()
+
+    def _evaluate_window(self):
+        latency = (sum(self._window_latencies) /
+                   len(self._window_latencies)
+                   if self._window_latencies else 1)
+        throughput = None
+        if (self._window_uploads >= MIN_WINDOW_UPLOADS and
+                self._window_upload_time > 0):
+            throughput = self._window_bytes / self._window_upload_time
+        if latency > LATENCY_TOLERANCE:
+            self._decrease('the latency grew to {0:.1f} times the '
+                           'minimum'.format(latency))
+        elif (throughput is not None and self.limit > self._best_limit and
+              throughput < self._best_throughput * (1 + THROUGHPUT_GAIN)):
+            # More concurrency didn't help, the link is saturated
+            self._reset_window()
+        else:
+            if throughput is not None and \
+                    throughput > self._best_throughput:
+                self._best_throughput = throughput
+                self._best_limit = self.limit
+            self._set_limit(
+                min(self.ceiling, self.limit + 1),
+                '{0} operations completed, latency {1:.1f} times the '
+                'minimum'.format(self._window_operations, latency))
+
+    def _decrease(self, reason):
+        self._last_decrease = time.time()
+        self._set_limit(max(self.floor, int(self.limit * DECREASE_FACTOR)),
+                        reason)
+
+    def _set_limit(self, limit, reason):
+        self._reset_window()
+        if limit == self.limit:
+            return
+        decision = LimitDecision(time.time() - self._start_time, self.limit,
+                                 limit, reason)
+        logger.debug('Concurrency limit %s', decision)
+        self.decisions.append(decision)
+        self.limit = limit
+
+    def log_report(self):
+        if not self.decisions:
+            return
+        logger.info(
+            'The concurrency limit (floor %d, ceiling %d) changed %d times '
+            'and ended at %d:\n%s', self.floor, self.ceiling,
+            len(self.decisions), self.limit,
+            '\n'.join(str(decision) for decision in self.decisions))
+
+
+concurrency_limiter = AdaptiveLimiter()
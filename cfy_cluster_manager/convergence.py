@@ -0,0 +1,144 @@
+"""The state of the nodes, and the steps which bring them to the state the
+configuration describes.
+
+A node's desired state is the digest of its files in CLUSTER_INSTALL_DIR:
+the CA, its certificate, key and config file, and the license and CAs of
+managers. The bundle uploaded to a host holds a digest file per node, and
+once `cfy_manager install` or `configure` applied a node's files, its
+digest file is copied to /etc/cloudify. The observed state of a node is
+then whether its service is installed, and the digests of the uploaded and
+of the applied digest files, which `sha256sum` reports for all the nodes of
+a host in a single command.
+
+A node which isn't installed is installed, and an installed node whose
+applied files differ from the desired ones is configured. A host is
+uploaded to, and has the RPM installed, only if one of its nodes needs it.
+Since nothing is recorded as applied before it was, a run which failed
+midway leaves the rest of the work to the next run.
+"""
+import hashlib
+from collections import OrderedDict
+
+UPLOAD = 'upload'
+RPM_INSTALL = 'rpm install'
+INSTALL = 'cfy_manager install'
+CONFIGURE = 'cfy_manager configure'
+
+
+def get_marker_digest(digest):
+    """The SHA256 digest of a digest file holding `digest`."""
+    return hashlib.sha256(digest.encode('utf-8')).hexdigest()
+
+
+class NodeState(object):
+    """What was observed on a node.
+
+    :param installed: Whether the node's service is installed.
+    :param failed_install: Whether an installation of the node was started
+                           and didn't finish successfully, so it has to be
+                           removed before installing again.
+    :param uploaded_digest: The SHA256 of the node's uploaded digest file.
+    :param applied_digest: The SHA256 of the node's applied digest file.
+    :param rpm: The cloudify-manager-install package of the host, or None.
+    """
+    def __init__(self, installed=False, failed_install=False,
+                 uploaded_digest=None, applied_digest=None, rpm=None):
+        self.installed = installed
+        self.failed_install = failed_install
+        self.uploaded_digest = uploaded_digest
+        self.applied_digest = applied_digest
+        self.rpm = rpm
+
+    def rpm_matches(self, rpm_package):
+        """Whether the host has `rpm_package` installed, or any version of
+        it if the RPM's header couldn't be read."""
+        return self.rpm is not None and (
+            rpm_package is None or self.rpm.matches(rpm_package))
+
+    def __repr__(self):
+        return 'NodeState(installed={0}, failed_install={1})'.format(
+            self.installed, self.failed_install)
+
+
+def get_node_step(state, digest):
+    """The `cfy_manager` step the node needs, or None."""
+    if not state.installed:
+        return INSTALL
+    if state.applied_digest != get_marker_digest(digest):
+        return CONFIGURE
+    return None
+
+
+def get_actions(host_instances, states, digests, rpm_package):
+    """The steps each node of the hosts needs, in the order they run.
+
+    :param host_instances: The instances of each host, in their install
+                           order.
+    :param states: The NodeState of each instance.
+    :param digests: The desired digest of each instance.
+    :param rpm_package: The RpmPackage being installed, or None.
+    :return: The steps by instance, for the instances which need any.
+    """
+    actions = OrderedDict()
+    for instances in host_instances.values():
+        node_steps = [(instance, get_node_step(states[instance],
+                                               digests[instance]))
+                      for instance in instances]
+        node_steps = [(instance, step) for instance, step in node_steps
+                      if step]
+        if not node_steps:
+            continue
+        first_instance = node_steps[0][0]
+        needs_rpm = any(step == INSTALL for _, step in node_steps) and \
+            not states[first_instance].rpm_matches(rpm_package)
+        needs_upload = needs_rpm or any(
+            states[instance].uploaded_digest !=
+            get_marker_digest(digests[instance])
+            for instance, _ in node_steps)
+        host_steps = [step for step, needed in ((UPLOAD, needs_upload),
+                                                (RPM_INSTALL, needs_rpm))
+                      if needed]
+        for instance, step in node_steps:
+            actions[instance] = (host_steps if instance is first_instance
+                                 else []) + [step]
+    return actions
+
+
+def format_actions(instances, actions):
+    """A line per instance, listing the steps it needs."""
+    return '\n'.join(
+        '  {0} ({1}): {2}'.format(
+            instance.name, instance.private_ip,
+            ', '.join(actions[instance]) if instance in actions
+            else 'up to date')
+        for instance in instances)
+
+
+def get_node_status(state, digest):
+    """A description of what was observed on a node.
+
+    :param digest: The digest of the node's files in CLUSTER_INSTALL_DIR,
+                   or None if they aren't there.
+    """
+    if state.installed:
+        if digest is None:
+            files = 'the files it runs with are unknown'
+        elif get_node_step(state, digest) == CONFIGURE:
+            files = 'its files changed since they were applied'
+        else:
+            files = 'runs with its files'
+        description = 'installed, {0}'.format(files)
+    elif state.failed_install:
+        description = 'installation started and not finished'
+    else:
+        description = 'not installed'
+    return '{0} ({1})'.format(description, state.rpm or 'no RPM')
+
+
+def format_status(instances, states, digests):
+    """A line per instance, describing its state."""
+    return '\n'.join(
+        '  {0} ({1}): {2}'.format(instance.name, instance.private_ip,
+                                  get_node_status(states[instance],
+                                                  digests.get(instance)))
+        for instance in instances)
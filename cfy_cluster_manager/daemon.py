@@ -0,0 +1,142 @@
+"""The `cfy_cluster_manager serve` daemon.
+
+The daemon listens on a Unix socket, only its user may connect to, and
+runs the commands its clients send in its own process. Its modules are
+imported once, the configuration files it parsed are kept until they
+change, and the hosts' transports are kept with their connections, so a
+command it serves starts right away.
+
+A request is a line of JSON with the command's arguments and the client's
+working directory, and the daemon answers with a line of JSON per log
+record of the command, and a last line with its exit code. Since the run
+state (the stats, the limits and the deadline) belongs to the process, the
+commands run one at a time, and a command sent while another one runs
+waits for it. The daemon serves the directory it was started in only,
+like the CLI keeps its files in its working directory, and the clients of
+other directories run their commands themselves.
+"""
+import os
+import json
+import logging
+import argparse
+import threading
+import socketserver
+
+from .client import connect, send_message
+from .exceptions import ClusterInstallError
+from .logger import FORMAT_MSG, get_cfy_cluster_manager_logger
+
+logger = get_cfy_cluster_manager_logger()
+
+VERBOSE_FLAGS = ('-v', '--verbose')
+
+
+class RequestArgumentParser(argparse.ArgumentParser):
+    """Raise the errors in the arguments of a request, rather than exit the
+    daemon."""
+    def error(self, message):
+        raise ClusterInstallError('{0}: error: {1}'.format(self.prog,
+                                                           message))
+
+
+class _ClientLogHandler(logging.Handler):
+    """Send the log records to the client. Once the client is gone, the
+    command keeps on running, and its log is only kept in the log file."""
+    def __init__(self, send, level):
+        super(_ClientLogHandler, self).__init__(level)
+        self.setFormatter(logging.Formatter(FORMAT_MSG))
+        self._send = send
+        self.connected = True
+
+    def emit(self, record):
+        if not self.connected:
+            return
+        try:
+            self._send({'log': self.format(record)})
+        except (IOError, OSError):
+            self.connected = False
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        request = json.loads(line.decode('utf-8'))
+        if request.get('cwd') != self.server.cwd:
+            self._send({'refused': True})
+            return
+        argv = request['argv']
+        handler = _ClientLogHandler(
+            self._send, logging.DEBUG if set(argv) & set(VERBOSE_FLAGS)
+            else logging.INFO)
+        if not self.server.command_lock.acquire(False):
+            handler.handle(logger.makeRecord(
+                logger.name, logging.INFO, __file__, 0,
+                'Waiting for `%s` to finish', (self.server.running_command,),
+                None))
+            self.server.command_lock.acquire()
+        root_logger = logging.getLogger()
+        root_logger.addHandler(handler)
+        try:
+            self.server.running_command = ' '.join(argv)
+            exit_code = self.server.run_argv(argv)
+        finally:
+            self.server.running_command = None
+            root_logger.removeHandler(handler)
+            self.server.command_lock.release()
+        if handler.connected:
+            try:
+                self._send({'exit_code': exit_code})
+            except (IOError, OSError):
+                pass
+
+    def _send(self, message):
+        with self.server.send_lock:
+            send_message(self.connection, message)
+
+
+class ClusterManagerDaemon(socketserver.ThreadingMixIn,
+                           socketserver.UnixStreamServer):
+    """The daemon's server.
+
+    :param run_argv: A function running a command's arguments in this
+                     process, and returning its exit code.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, run_argv):
+        self.socket_path = socket_path
+        self.run_argv = run_argv
+        self.cwd = os.getcwd()
+        self.command_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.running_command = None
+        self._remove_stale_socket()
+        # Only the daemon's user may connect
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path,
+                                                   _RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        connection = connect(self.socket_path)
+        if connection is not None:
+            connection.close()
+            raise ClusterInstallError(
+                'A cluster manager daemon is already listening on '
+                '{0}'.format(self.socket_path))
+        logger.debug('Removing the stale socket %s', self.socket_path)
+        os.remove(self.socket_path)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def handle_error(self, request, client_address):
+        logger.exception('Failed handling a request')
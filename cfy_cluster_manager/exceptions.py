@@ -0,0 +1,43 @@
+class ClusterInstallError(Exception):
+    pass
+
+
+class ProcessExecutionError(ClusterInstallError):
+    def __init__(self, message, return_code=None):
+        self.return_code = return_code
+        super(ProcessExecutionError, self).__init__(message)
+
+
+class ValidationError(ClusterInstallError):
+    pass
+
+
+class CommandTimeoutError(ClusterInstallError):
+    pass
+
+
+class DeadlineExceededError(ClusterInstallError):
+    pass
+
+
+class NodeUnreachableError(ClusterInstallError):
+    pass
+
+
+class RemoteTransportError(ClusterInstallError):
+    """The SSH transport to a host failed, as opposed to a command failing."""
+    pass
+
+
+class SSHConnectionError(RemoteTransportError):
+    """An SSH connection could not be opened, so nothing ran on the host.
+
+    :param transient: False if retrying can't help, e.g. on bad credentials.
+    """
+    def __init__(self, message, transient=True):
+        self.transient = transient
+        super(SSHConnectionError, self).__init__(message)
+
+
+class CircuitOpenError(ClusterInstallError):
+    pass
@@ -0,0 +1,452 @@
+import os
+import re
+import json
+import time
+import shlex
+import random
+import shutil
+import hashlib
+import threading
+from collections import Counter, defaultdict
+from os.path import (basename, exists, expanduser, getsize, isdir, isfile,
+                     join, relpath)
+
+import yaml
+
+from .exceptions import (CommandTimeoutError, SSHConnectionError)
+from .rpm_header import QUERY_NONE, read_rpm_header, RpmHeaderError
+from .throttle import upload_throttle
+from .transport import CommandResult, Transport
+
+DEFAULT_ROOT_DIR = join(os.environ.get('CFY_WORKDIR', expanduser('~')),
+                        '.cloudify', 'fake_cluster')
+DEFAULT_RPM_VERSION = '5.1.2'
+RPM_PACKAGE_NAME = 'cloudify-manager-install'
+CFY_DIR = '/etc/cloudify'
+INSTALLED_DIR = join(CFY_DIR, '.installed')
+CFY_CONFIG_PATH = join(CFY_DIR, 'config.yaml')
+CFY_MANAGER_DEFAULTS = {'validations': {'skip_validations': False}}
+BASE_DIRS = ('/tmp', '/etc')
+
+
+class FakeHost(object):
+    """A simulated cluster node.
+
+    The node's filesystem is a local directory, and its package, systemd
+    and `cfy_manager` state is kept in a JSON file next to it, so it
+    persists between runs. `execute` emulates the commands the cluster
+    manager runs on the nodes.
+    """
+    def __init__(self, root_dir, host, options):
+        self.host = host
+        self.root = join(root_dir, host)
+        self.state_path = join(root_dir, host + '.json')
+        self.options = options
+        self.random = random.Random(options.get('seed'))
+        self._lock = threading.RLock()
+        for base_dir in BASE_DIRS:
+            if not isdir(self.path(base_dir)):
+                os.makedirs(self.path(base_dir))
+        self._commands = {
+            'test': self._test,
+            'mkdir': self._mkdir,
+            'cat': self._cat,
+            'sha256sum': self._sha256sum,
+            'cp': self._cp,
+            'mv': self._mv,
+            'rm': self._rm,
+            'rpm': self._rpm,
+            'yum': self._yum,
+            'systemctl': self._systemctl,
+            'systemd-run': self._systemd_run,
+            'journalctl': self._journalctl,
+            'cfy_manager': self._cfy_manager,
+            '/opt/cloudify/cfy_manager/bin/python': self._python,
+        }
+
+    def path(self, remote_path):
+        """The local path of a path on the node."""
+        return join(self.root, remote_path.lstrip('/'))
+
+    def _load_state(self):
+        if not exists(self.state_path):
+            return {'rpm_version': None, 'units': {}}
+        with open(self.state_path) as state_file:
+            return json.load(state_file)
+
+    def _save_state(self, state):
+        with open(self.state_path, 'w') as state_file:
+            json.dump(state, state_file)
+
+    def execute(self, command, timeout=None):
+        """Run a command on the node.
+
+        The command's simulated run time passes before it takes the node's
+        lock, so the node's other commands don't wait for it.
+
+        :return: A (stdout, stderr, return_code) tuple.
+        """
+        args = shlex.split(command)
+        handler = self._commands.get(args[0])
+        if not handler:
+            return '', '{0}: command not found'.format(args[0]), 127
+        self._sleep(self._get_duration(args), timeout, command)
+        with self._lock:
+            state = self._load_state()
+            self._update_units(state)
+            result = handler(state, args[1:], timeout)
+            self._save_state(state)
+        return result
+
+    def _get_duration(self, args):
+        if args[0] == 'yum':
+            return self.options.get('yum_duration', 0)
+        if args[0] == 'cfy_manager' and len(args) > 1:
+            return self.options.get('{0}_duration'.format(args[1]), 0)
+        return 0
+
+    def _sleep(self, duration, timeout, command):
+        if timeout is not None and duration > timeout:
+            time.sleep(timeout)
+            raise CommandTimeoutError(
+                'The command `{0}` on host {1} timed out after {2} '
+                'seconds'.format(command, self.host, int(timeout)))
+        time.sleep(duration)
+
+    def _test(self, state, args, timeout):
+        return '', '', 0 if exists(self.path(args[-1])) else 1
+
+    def _mkdir(self, state, args, timeout):
+        path = self.path(args[-1])
+        if not isdir(path):
+            os.makedirs(path)
+        return '', '', 0
+
+    def _cat(self, state, args, timeout):
+        path = self.path(args[-1])
+        if not isfile(path):
+            return '', 'cat: {0}: No such file or directory'.format(
+                args[-1]), 1
+        with open(path) as cat_file:
+            return cat_file.read(), '', 0
+
+    def _sha256sum(self, state, args, timeout):
+        lines, errors = [], []
+        for path in args:
+            if not isfile(self.path(path)):
+                errors.append('sha256sum: {0}: No such file or '
+                              'directory'.format(path))
+                continue
+            with open(self.path(path), 'rb') as digest_file:
+                lines.append('{0}  {1}'.format(
+                    hashlib.sha256(digest_file.read()).hexdigest(), path))
+        return '\n'.join(lines), '\n'.join(errors), 1 if errors else 0
+
+    def _cp(self, state, args, timeout):
+        source, destination = self.path(args[-2]), self.path(args[-1])
+        if not exists(source):
+            return '', 'cp: cannot stat {0}'.format(args[-2]), 1
+        if isdir(destination):
+            destination = join(destination, basename(source))
+        if isdir(source):
+            shutil.copytree(source, destination)
+        else:
+            shutil.copy(source, destination)
+        return '', '', 0
+
+    def _mv(self, state, args, timeout):
+        source = self.path(args[-2])
+        if not exists(source):
+            return '', 'mv: cannot stat {0}'.format(args[-2]), 1
+        shutil.move(source, self.path(args[-1]))
+        return '', '', 0
+
+    def _rm(self, state, args, timeout):
+        for arg in args:
+            if arg.startswith('-'):
+                continue
+            path = self.path(arg)
+            if isdir(path):
+                shutil.rmtree(path)
+            elif exists(path):
+                os.remove(path)
+        return '', '', 0
+
+    def _rpm(self, state, args, timeout):
+        installed = state['rpm_version'] and args[-1] == RPM_PACKAGE_NAME
+        if not installed:
+            return '', 'package {0} is not installed'.format(args[-1]), 1
+        if '--queryformat' in args:
+            tags = {'NAME': RPM_PACKAGE_NAME, 'RELEASE': 'ga',
+                    'VERSION': state['rpm_version'], 'ARCH': 'x86_64'}
+            tags.update(state.get('rpm_tags', {}))
+            query_format = args[args.index('--queryformat') + 1]
+            return re.sub(r'%{(\w+)}',
+                          lambda match: tags.get(match.group(1), QUERY_NONE),
+                          query_format).replace('\\n', '\n'), '', 0
+        return 'Name        : {0}\nVersion     : {1}\n'.format(
+            RPM_PACKAGE_NAME, state['rpm_version']), '', 0
+
+    def _yum(self, state, args, timeout):
+        action, target = args[0], [arg for arg in args[1:]
+                                   if not arg.startswith('-')][0]
+        if action == 'install':
+            if not isfile(self.path(target)):
+                return '', 'No package {0} available.'.format(target), 1
+            state['rpm_version'], state['rpm_tags'] = self._read_package(
+                target)
+            if not isdir(self.path(CFY_DIR)):
+                os.makedirs(self.path(CFY_DIR))
+        elif action == 'remove':
+            state['rpm_version'] = None
+            state.pop('rpm_tags', None)
+        return '', '', 0
+
+    def _read_package(self, rpm_path):
+        """The version and the query tags of the package an RPM installs.
+        A file which isn't an RPM installs the `rpm_version` option."""
+        try:
+            package = read_rpm_header(self.path(rpm_path))
+        except RpmHeaderError:
+            return self.options.get('rpm_version', DEFAULT_RPM_VERSION), {}
+        tags = {'NAME': package.name, 'VERSION': package.version,
+                'RELEASE': package.release, 'ARCH': package.arch,
+                'EPOCH': package.epoch, 'SHA1HEADER': package.digest}
+        return package.version, dict(
+            (tag, str(value)) for tag, value in tags.items()
+            if value is not None)
+
+    def _update_units(self, state):
+        """Finish the `cfy_manager install` units whose time has come."""
+        for unit_name, unit in list(state['units'].items()):
+            if unit['state'] != 'running' or time.time() < unit['ends_at']:
+                continue
+            if unit['succeeds']:
+                self._install_services(unit['config_path'])
+                del state['units'][unit_name]
+            else:
+                unit['state'] = 'failed'
+
+    def _get_services(self, config_path):
+        with open(self.path(config_path)) as config_file:
+            config = yaml.safe_load(config_file)
+        return config.get('services_to_install', [])
+
+    def _install_services(self, config_path):
+        installed_dir = self.path(INSTALLED_DIR)
+        if not isdir(installed_dir):
+            os.makedirs(installed_dir)
+        for service in self._get_services(config_path):
+            open(join(installed_dir, service), 'w').close()
+        self._merge_config(config_path)
+
+    def _merge_config(self, config_path):
+        """Write config.yaml like cfy_manager does: the given config file
+        merged with the defaults."""
+        with open(self.path(config_path)) as config_file:
+            config = yaml.safe_load(config_file) or {}
+        with open(self.path(CFY_CONFIG_PATH), 'w') as merged_file:
+            yaml.safe_dump(dict(CFY_MANAGER_DEFAULTS, **config), merged_file)
+
+    def _systemctl(self, state, args, timeout):
+        action, unit_name = args[0], args[-1]
+        unit = state['units'].get(unit_name)
+        if action == 'status':
+            if not unit:
+                return '', 'Unit {0} could not be found.'.format(
+                    unit_name), 4
+            return 'Active: {0}'.format(unit['state']), '', (
+                0 if unit['state'] == 'running' else 3)
+        elif action == 'reset-failed':
+            if unit and unit['state'] == 'failed':
+                del state['units'][unit_name]
+            return '', '', 0
+        return '', 'Unknown operation {0}.'.format(action), 1
+
+    def _systemd_run(self, state, args, timeout):
+        unit_name = args[args.index('--unit') + 1]
+        command = args[args.index('--uid') + 2:]
+        if unit_name in state['units']:
+            return '', 'Unit {0}.service already exists.'.format(
+                unit_name), 1
+        if (not state['rpm_version'] or
+                command[:2] != ['cfy_manager', 'install']):
+            return '', 'Failed to start transient service unit', 1
+        state['units'][unit_name] = {
+            'state': 'running',
+            'config_path': command[command.index('-c') + 1],
+            'ends_at': time.time() + self.options.get('install_duration', 0),
+            'succeeds': self.random.random() >= self.options.get(
+                'install_failure_rate', 0)
+        }
+        return 'Running as unit: {0}.service'.format(unit_name), '', 0
+
+    def _journalctl(self, state, args, timeout):
+        unit_name = args[args.index('-u') + 1]
+        unit = state['units'].get(unit_name)
+        if unit and unit['state'] == 'failed':
+            return 'cfy_manager[1]: Simulated installation failure', '', 0
+        return '-- No entries --', '', 0
+
+    def _cfy_manager(self, state, args, timeout):
+        if not state['rpm_version']:
+            return '', 'cfy_manager: command not found', 127
+        action = args[0]
+        config_path = args[args.index('-c') + 1] if '-c' in args else None
+        if config_path and not isfile(self.path(config_path)):
+            return '', 'No such file {0}'.format(config_path), 1
+        if action == 'remove':
+            for service in self._get_services(config_path):
+                service_path = join(self.path(INSTALLED_DIR), service)
+                if exists(service_path):
+                    os.remove(service_path)
+        elif action == 'install':
+            self._install_services(config_path)
+        elif action == 'configure':
+            self._merge_config(config_path)
+        return '', '', 0
+
+    def _python(self, state, args, timeout):
+        return '', '', 0
+
+
+class FakeCluster(object):
+    """Simulated nodes sharing a root directory, and their usage counters.
+
+    :param root_dir: The directory holding the nodes' filesystems and state.
+    :param latency: The network round trip time, in seconds.
+    :param handshake_round_trips: The round trips an SSH handshake costs.
+    :param bandwidth: The upload bandwidth, in bytes per second.
+    :param connection_failure_rate: The probability of a connection failure.
+    :param install_failure_rate: The probability of `cfy_manager install`
+                                 failing.
+    :param install_duration: How long `cfy_manager install` runs, in seconds.
+                             Likewise `remove_duration`, `upgrade_duration`,
+                             `configure_duration` and `yum_duration`.
+    :param dead_hosts: Hosts that don't answer at all.
+    :param rpm_version: The version `yum install` installs.
+    :param seed: Seeds the randomness of the failures.
+    """
+    def __init__(self, root_dir=DEFAULT_ROOT_DIR, **options):
+        self.root_dir = root_dir
+        self.options = options
+        self.random = random.Random(options.get('seed'))
+        self.stats = defaultdict(Counter)
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def get_host(self, host):
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = FakeHost(self.root_dir, host,
+                                             self.options)
+            return self._hosts[host]
+
+    def record(self, host, **counters):
+        with self._lock:
+            self.stats[host].update(counters)
+
+    def totals(self):
+        totals = Counter()
+        for host_stats in self.stats.values():
+            totals.update(host_stats)
+        return totals
+
+    def fails(self, rate_option):
+        with self._lock:
+            return self.random.random() < self.options.get(rate_option, 0)
+
+
+_fake_clusters = {}
+_fake_clusters_lock = threading.Lock()
+
+
+def get_fake_cluster(root_dir=None, **options):
+    """Return the FakeCluster of `root_dir` and `options`, creating it if
+    needed. Runs with other options, e.g. a daemon's runs of an edited
+    configuration file, get a cluster simulating those."""
+    root_dir = root_dir or DEFAULT_ROOT_DIR
+    key = (root_dir, json.dumps(options, sort_keys=True))
+    with _fake_clusters_lock:
+        if key not in _fake_clusters:
+            _fake_clusters[key] = FakeCluster(root_dir, **options)
+        return _fake_clusters[key]
+
+
+class FakeTransport(Transport):
+    """Operate simulated nodes instead of real ones.
+
+    Like the fabric transport, every operation opens a new connection. The
+    configured latency, bandwidth and failure rates are applied to each
+    operation, so the orchestration can be run and timed on a single host.
+    See FakeCluster for the options.
+    """
+    name = 'fake'
+
+    def __init__(self, host, username, key_file_path=None, password=None,
+                 **options):
+        super(FakeTransport, self).__init__(host, username, key_file_path,
+                                            password, **options)
+        self.cluster = get_fake_cluster(**options)
+        self.fake_host = self.cluster.get_host(host)
+        self.latency = options.get('latency', 0)
+        self.bandwidth = options.get('bandwidth')
+
+    def _connect(self, connect_timeout):
+        if self.host in self.cluster.options.get('dead_hosts', []):
+            time.sleep(connect_timeout or 0)
+            raise SSHConnectionError(
+                'SSH: could not connect to {0}: timed out'.format(self.host))
+        if self.cluster.fails('connection_failure_rate'):
+            raise SSHConnectionError(
+                'SSH: could not connect to {0}: Connection reset by '
+                'peer'.format(self.host))
+        time.sleep(self.latency *
+                   self.cluster.options.get('handshake_round_trips', 4))
+        self.cluster.record(self.host, handshakes=1)
+        self.connections += 1
+
+    def _upload(self, local_path, remote_path):
+        size = getsize(local_path)
+        delay = upload_throttle.reserve(self.host, size)
+        if self.bandwidth:
+            delay = max(delay, float(size) / self.bandwidth)
+        time.sleep(delay)
+        shutil.copy(local_path, remote_path)
+        self.cluster.record(self.host, files=1, bytes=size)
+
+    def test_connection(self, connect_timeout):
+        self._connect(connect_timeout)
+
+    def is_alive(self, timeout):
+        return self.host not in self.cluster.options.get('dead_hosts', [])
+
+    def run(self, command, use_sudo, hide_stdout, connect_timeout, timeout):
+        self._connect(connect_timeout)
+        time.sleep(self.latency)
+        self.cluster.record(self.host, commands=1,
+                            sudo_commands=1 if use_sudo else 0)
+        stdout, stderr, return_code = self.fake_host.execute(command,
+                                                             timeout)
+        return CommandResult(command, stdout, stderr, return_code)
+
+    def put_file(self, local_path, remote_path, connect_timeout):
+        self._connect(connect_timeout)
+        time.sleep(self.latency)
+        destination = self.fake_host.path(remote_path)
+        if isdir(destination):
+            destination = join(destination, basename(local_path))
+        self._upload(expanduser(local_path), destination)
+
+    def put_dir(self, local_dir_path, remote_dir_path, connect_timeout):
+        self._connect(connect_timeout)
+        for dir_path, _, file_names in os.walk(local_dir_path):
+            time.sleep(self.latency)
+            destination_dir = self.fake_host.path(
+                join(remote_dir_path, relpath(dir_path, local_dir_path)))
+            if not isdir(destination_dir):
+                os.makedirs(destination_dir)
+            for file_name in file_names:
+                time.sleep(self.latency)
+                self._upload(join(dir_path, file_name),
+                             join(destination_dir, file_name))
@@ -0,0 +1,274 @@
+"""Run an operation on a fleet of clusters, a few clusters at a time.
+
+Each cluster runs in a `cfy_cluster_manager` process of its own, in a work
+directory of the fleet directory which holds its credentials, its local
+install directory, its output and its metrics file. The fleet's budget of
+parallel steps and of upload bandwidth is split evenly between the
+clusters running at the same time, so the fleet never goes over it.
+
+The RPMs the clusters install from a URL are downloaded once, to a cache
+the clusters share, and the steps of all the clusters are recorded in the
+same history database. Once all the clusters finished, the report is built
+from their metrics files.
+"""
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os.path import (abspath, basename, exists, expanduser, isdir, join,
+                     splitext)
+
+from .logger import get_cfy_cluster_manager_logger
+from .openmetrics import parse_metrics
+from .plan import format_duration
+from .throttle import format_size
+from .utils import get_dict_from_yaml, run, write_dict_to_yaml_file
+
+logger = get_cfy_cluster_manager_logger()
+
+OPERATIONS = ('install', 'prepare', 'upgrade', 'converge')
+DEFAULT_MAX_CLUSTERS = 4
+DEFAULT_RPM_CACHE_DIR = join(expanduser('~'), '.cfy_cluster_manager',
+                             'rpm_cache')
+REPORT_NAME = 'fleet_report.json'
+CONFIG_NAME = 'cfy_cluster_config.yaml'
+METRICS_NAME = 'metrics.prom'
+OUTPUT_NAME = 'output.log'
+ERROR_PATTERN = re.compile(r' - ERROR - (.*)$')
+
+
+class FleetCluster(object):
+    def __init__(self, name, config_path, work_dir):
+        self.name = name
+        self.config_path = config_path
+        self.work_dir = work_dir
+        self.returncode = None
+        self.duration = None
+        self.metrics = {}
+
+    @property
+    def metrics_path(self):
+        return join(self.work_dir, METRICS_NAME)
+
+    @property
+    def output_path(self):
+        return join(self.work_dir, OUTPUT_NAME)
+
+    @property
+    def succeeded(self):
+        return self.returncode == 0
+
+    def metric_sum(self, name):
+        return sum(value for _, value in self.metrics.get(name, []))
+
+    @property
+    def nodes(self):
+        return len(self.metrics.get('node_success', []))
+
+    def get_error(self):
+        """The last error the cluster's run logged, or None."""
+        if self.succeeded or not exists(self.output_path):
+            return None
+        error = None
+        with open(self.output_path) as output_file:
+            for line in output_file:
+                match = ERROR_PATTERN.search(line.rstrip())
+                if match:
+                    error = match.group(1)
+        return error
+
+    def load_metrics(self):
+        if not exists(self.metrics_path):
+            return
+        with open(self.metrics_path) as metrics_file:
+            self.metrics = parse_metrics(metrics_file.read())
+
+    def to_dict(self):
+        return OrderedDict((
+            ('name', self.name),
+            ('config_path', self.config_path),
+            ('work_dir', self.work_dir),
+            ('succeeded', self.succeeded),
+            ('returncode', self.returncode),
+            ('duration', self.duration),
+            ('nodes', self.nodes),
+            ('nodes_succeeded', int(self.metric_sum('node_success'))),
+            ('remote_commands', int(self.metric_sum('remote_commands'))),
+            ('ssh_connections', int(self.metric_sum('ssh_connections'))),
+            ('uploaded_bytes', int(self.metric_sum('uploaded_bytes'))),
+            ('retries', int(self.metric_sum('retries'))),
+            ('output_path', self.output_path),
+            ('error', self.get_error()),
+        ))
+
+
+def _sanitize_name(name):
+    return re.sub(r'[^\w.-]', '_', name) or 'cluster'
+
+
+def get_clusters(config_paths, fleet_dir):
+    """A FleetCluster per configuration file, named after the file, and
+    working in a directory of that name in `fleet_dir`."""
+    clusters = []
+    names = set()
+    for config_path in config_paths:
+        base_name = _sanitize_name(splitext(basename(config_path))[0])
+        name = base_name
+        suffix = 2
+        while name in names:
+            name = '{0}_{1}'.format(base_name, suffix)
+            suffix += 1
+        names.add(name)
+        clusters.append(FleetCluster(name, abspath(expanduser(config_path)),
+                                     join(fleet_dir, name)))
+    return clusters
+
+
+def get_cached_rpm(rpm_path, cache_dir=DEFAULT_RPM_CACHE_DIR):
+    """The local path of an RPM: a local RPM as is, and an RPM URL
+    downloaded to the cache, unless it was already."""
+    expanded_rpm_path = expanduser(rpm_path)
+    if exists(expanded_rpm_path):
+        return abspath(expanded_rpm_path)
+    url_dir = join(cache_dir,
+                   hashlib.sha256(rpm_path.encode('utf-8')).hexdigest()[:16])
+    cached_path = join(url_dir, basename(rpm_path.rstrip('/')) or 'rpm')
+    if exists(cached_path):
+        logger.info('Using the cached RPM of %s', rpm_path)
+        return cached_path
+    if not isdir(url_dir):
+        os.makedirs(url_dir)
+    logger.info('Downloading Cloudify RPM from %s', rpm_path)
+    # Downloaded next to the cached path, so an interrupted download is
+    # never taken for a cached RPM
+    partial_path = '{0}.{1}.part'.format(cached_path, os.getpid())
+    run(['curl', '--fail', '-o', partial_path, rpm_path])
+    os.rename(partial_path, cached_path)
+    return cached_path
+
+
+def prepare_cluster(cluster, cache_dir=DEFAULT_RPM_CACHE_DIR):
+    """Create the cluster's work directory. If its RPM is a URL, the
+    cluster runs with a copy of its configuration file using the cached
+    RPM instead."""
+    if not isdir(cluster.work_dir):
+        os.makedirs(cluster.work_dir)
+    config = get_dict_from_yaml(cluster.config_path)
+    rpm_path = config.get('manager_rpm_path')
+    if not rpm_path or exists(expanduser(rpm_path)):
+        return
+    config['manager_rpm_path'] = get_cached_rpm(rpm_path, cache_dir)
+    cluster.config_path = join(cluster.work_dir, CONFIG_NAME)
+    write_dict_to_yaml_file(config, cluster.config_path)
+
+
+def split_budget(total, clusters):
+    """Each cluster's share of `total`, or None if there's no limit."""
+    if total is None:
+        return None
+    return max(1, int(total) // max(1, clusters))
+
+
+def get_cluster_command(cluster, operation, max_parallel, min_parallel,
+                        history_path, max_upload_rate=None,
+                        max_host_upload_rate=None, upgrade_rpm_path=None,
+                        transport=None, timeout=None, verbose=False):
+    command = [sys.executable, '-m', 'cfy_cluster_manager.main', operation,
+               '--config-path', cluster.config_path,
+               '--max-parallel', str(max_parallel),
+               '--min-parallel', str(min(min_parallel, max_parallel)),
+               '--history-db', history_path,
+               '--metrics-file', cluster.metrics_path]
+    for flag, value in (('--max-upload-rate', max_upload_rate),
+                        ('--max-host-upload-rate', max_host_upload_rate),
+                        ('--upgrade-rpm', upgrade_rpm_path),
+                        ('--transport', transport),
+                        ('--timeout', timeout)):
+        if value is not None:
+            command.extend([flag, str(value)])
+    if verbose:
+        command.append('--verbose')
+    return command
+
+
+def run_cluster_process(cluster, command):
+    """Run the cluster's command in its work directory, with its output
+    and log file there, and its local files in a directory of its own.
+
+    :return: The command's exit code.
+    """
+    env = dict(os.environ)
+    # The local files are kept in the work directory, and the files on the
+    # hosts where every cluster keeps them
+    env['CFY_WORKDIR'] = cluster.work_dir
+    with open(cluster.output_path, 'w') as output_file:
+        return subprocess.call(command, cwd=cluster.work_dir, env=env,
+                               stdout=output_file, stderr=subprocess.STDOUT)
+
+
+def run_fleet(clusters, commands, max_clusters=DEFAULT_MAX_CLUSTERS,
+              run_cluster=run_cluster_process):
+    """Run each cluster's command, at most `max_clusters` at a time.
+
+    :param commands: The command of each cluster.
+    :param run_cluster: A function running a cluster's command and
+                        returning its exit code.
+    """
+    def run_one(cluster):
+        logger.info('Starting cluster %s', cluster.name)
+        start_time = time.time()
+        try:
+            cluster.returncode = run_cluster(cluster, commands[cluster])
+        except OSError as exc:
+            logger.error('Failed running cluster %s: %s', cluster.name, exc)
+            cluster.returncode = -1
+        cluster.duration = time.time() - start_time
+        cluster.load_metrics()
+        logger.info('Cluster %s %s after %s', cluster.name,
+                    'succeeded' if cluster.succeeded else 'failed',
+                    format_duration(cluster.duration))
+
+    with ThreadPoolExecutor(max_workers=max_clusters) as executor:
+        list(executor.map(run_one, clusters))
+
+
+def format_report(clusters, operation):
+    rows = [('cluster', 'result', 'duration', 'nodes', 'commands',
+             'connections', 'uploaded', 'retries')]
+    for cluster in clusters:
+        result = cluster.to_dict()
+        rows.append((
+            cluster.name,
+            'ok' if cluster.succeeded
+            else 'failed ({0})'.format(cluster.returncode),
+            format_duration(cluster.duration or 0),
+            '{0}/{1}'.format(result['nodes_succeeded'], result['nodes']),
+            str(result['remote_commands']),
+            str(result['ssh_connections']),
+            format_size(result['uploaded_bytes']),
+            str(result['retries'])))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    succeeded = len([cluster for cluster in clusters if cluster.succeeded])
+    lines = ['Fleet {0} report: {1} of {2} clusters succeeded'.format(
+        operation, succeeded, len(clusters))]
+    lines.extend('  '.join(value.ljust(width)
+                           for value, width in zip(row, widths)).rstrip()
+                 for row in rows)
+    for cluster in clusters:
+        if not cluster.succeeded:
+            lines.append('{0}: {1} (see {2})'.format(
+                cluster.name, cluster.get_error() or 'no error was logged',
+                cluster.output_path))
+    return '\n'.join(lines)
+
+
+def write_report(clusters, operation, path):
+    with open(path, 'w') as report_file:
+        json.dump({'operation': operation,
+                   'clusters': [cluster.to_dict() for cluster in clusters]},
+                  report_file, indent=2)
@@ -0,0 +1,92 @@
+"""The journal of a `prepare` run, which stages the nodes for an install.
+
+Staging a node means uploading its files, installing the RPM and copying
+its config file to /etc/cloudify. The journal records each staged node as
+soon as it's staged, and then that the staging is complete. The journal
+belongs to the configuration file it was prepared from: once the
+configuration changes, the staging no longer counts.
+"""
+import json
+import time
+import hashlib
+import threading
+from os import remove
+from os.path import exists
+
+from .logger import get_cfy_cluster_manager_logger
+
+logger = get_cfy_cluster_manager_logger()
+
+JOURNAL_NAME = 'staging_journal.json'
+
+
+def get_config_digest(config_path):
+    with open(config_path, 'rb') as config_file:
+        return hashlib.sha256(config_file.read()).hexdigest()
+
+
+class StagingJournal(object):
+    def __init__(self, path):
+        self.path = path
+        self.config_digest = None
+        self.staged_nodes = []
+        self.completed_at = None
+        self._lock = threading.Lock()
+        if exists(path):
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as journal_file:
+                journal = json.load(journal_file)
+        except ValueError as exc:
+            logger.warning('Ignoring the invalid staging journal %s: %s',
+                           self.path, exc)
+            return
+        self.config_digest = journal.get('config_digest')
+        self.staged_nodes = journal.get('staged_nodes', [])
+        self.completed_at = journal.get('completed_at')
+
+    def _save(self):
+        with open(self.path, 'w') as journal_file:
+            json.dump({'config_digest': self.config_digest,
+                       'staged_nodes': self.staged_nodes,
+                       'completed_at': self.completed_at},
+                      journal_file, indent=2)
+
+    def matches(self, config_digest):
+        """Whether the journal is of the configuration with this digest."""
+        return self.config_digest is not None and \
+            self.config_digest == config_digest
+
+    def is_complete(self, config_digest):
+        return self.matches(config_digest) and self.completed_at is not None
+
+    def start(self, config_digest):
+        """Start staging, keeping the staged nodes of an earlier run of the
+        same configuration."""
+        with self._lock:
+            if not self.matches(config_digest):
+                self.staged_nodes = []
+            self.config_digest = config_digest
+            self.completed_at = None
+            self._save()
+
+    def node_staged(self, node_name):
+        with self._lock:
+            if node_name not in self.staged_nodes:
+                self.staged_nodes.append(node_name)
+            self._save()
+
+    def complete(self):
+        with self._lock:
+            self.completed_at = time.time()
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self.config_digest = None
+            self.staged_nodes = []
+            self.completed_at = None
+            if exists(self.path):
+                remove(self.path)
@@ -1,36 +1,83 @@
 import os
+import re
 import sys
 import time
+import fcntl
 import shutil
 import string
 import random
+import signal
+import difflib
+import hashlib
+import threading
 import argparse
+import tempfile
 from getpass import getuser
 from traceback import format_exception
+from contextlib import contextmanager
 from collections import OrderedDict
-from os.path import exists, expanduser, isdir, join
+from concurrent.futures import ThreadPoolExecutor
+from os.path import (abspath, basename, dirname, exists, expanduser, isdir,
+                     join, relpath)
 
 import pkg_resources
 from jinja2 import Environment, FileSystemLoader
 
+from .client import (get_socket_path, SERVED_ACTIONS, SOCKET_ENV,
+                     SOCKET_NAME)
+from .concurrency import concurrency_limiter, DEFAULT_MIN_PARALLEL
+from .convergence import (CONFIGURE, format_actions, format_status,
+                          get_actions, get_marker_digest, INSTALL, NodeState,
+                          UPLOAD)
+from .daemon import ClusterManagerDaemon, RequestArgumentParser
+from .fleet import (DEFAULT_MAX_CLUSTERS, DEFAULT_RPM_CACHE_DIR,
+                    format_report, get_cached_rpm, get_cluster_command,
+                    get_clusters, OPERATIONS as FLEET_OPERATIONS,
+                    prepare_cluster, REPORT_NAME as FLEET_REPORT_NAME,
+                    run_cluster_process, run_fleet, split_budget,
+                    write_report)
+from .journal import get_config_digest, JOURNAL_NAME, StagingJournal
 from .logger import get_cfy_cluster_manager_logger, setup_logger
+from .openmetrics import METRICS_INTERVAL, MetricsFileWriter, run_metrics
+from .plan import (build_converge_plan, build_install_plan,
+                   build_prepare_plan, build_upgrade_plan,
+                   DEFAULT_MAX_PARALLEL, estimate_plan, format_duration,
+                   format_plan, run_plan)
+from .profiler import SPANS_SUFFIX, start_profiling, stop_profiling
+from .remote_stats import remote_stats
+from .rpm_header import (parse_query_output, QUERY_FORMAT, read_rpm_header,
+                         RpmHeaderError)
+from .throttle import parse_rate, transfer_stats, upload_throttle
+from .timing_history import (DEFAULT_HISTORY_PATH, get_rpm_version,
+                             save_step_timings, step_timings, TimingHistory)
+from .retry import (NO_RETRIES, reset_circuit_breakers, retry_budget,
+                    retry_stats)
+from .transport import get_transport_class, transport_pool, TRANSPORTS
 from .utils import (check_cert_key_match, check_cert_path, check_san,
                     check_signed_by, cloudify_rpm_is_installed,
                     ClusterInstallError, copy, get_dict_from_yaml, move,
-                    raise_errors_list, run, sudo, VM,
-                    write_dict_to_yaml_file, yum_is_present)
+                    NodeUnreachableError, raise_errors_list, run,
+                    run_deadline, sudo, VM, write_dict_to_yaml_file,
+                    yaml_cache, yum_is_present)
 
 logger = get_cfy_cluster_manager_logger()
 
 CERTS_DIR_NAME = 'certs'
 CFY_CERTS_PATH = '{0}/.cloudify-test-ca'.format(expanduser('~'))
+LOCAL_LOCK_PATH = join(expanduser('~'), '.cfy_cluster_manager', 'local.lock')
 CONFIG_FILES = 'config_files'
 DIR_NAME = 'cloudify_cluster_manager'
 RPM_NAME = 'cloudify-manager-install.rpm'
+BUNDLE_DIGEST_NAME = '.bundle_sha256'
+NODE_DIGEST_NAME = '.{0}_sha256'
 UPGRADE_RPM_NAME = 'upgrade-cloudify-manager-install'
 TOP_DIR = '/tmp'
 
-CLUSTER_INSTALL_DIR = join(TOP_DIR, DIR_NAME)
+# The cluster's files are kept in CLUSTER_INSTALL_DIR on this machine, and
+# uploaded to REMOTE_INSTALL_DIR on the hosts. A fleet runs each of its
+# clusters with its work directory as CFY_WORKDIR, so their files are apart.
+CLUSTER_INSTALL_DIR = join(os.environ.get('CFY_WORKDIR', TOP_DIR), DIR_NAME)
+REMOTE_INSTALL_DIR = join(TOP_DIR, DIR_NAME)
 RPM_PATH = join(CLUSTER_INSTALL_DIR, RPM_NAME)
 CERTS_DIR = join(CLUSTER_INSTALL_DIR, CERTS_DIR_NAME)
 CONFIG_FILES_DIR = join(CLUSTER_INSTALL_DIR, CONFIG_FILES)
@@ -43,11 +90,30 @@ CREDENTIALS_FILE_PATH = join(os.getcwd(), 'secret_credentials.yaml')
 CLUSTER_CONFIG_FILES_DIR = pkg_resources.resource_filename(
     'cfy_cluster_manager', 'cfy_cluster_config_files')
 CLUSTER_CONFIG_FILE_NAME = 'cfy_cluster_config.yaml'
+DEFAULT_FLEET_DIR = 'cfy_cluster_fleet'
 CLUSTER_INSTALL_CONFIG_PATH = join(os.getcwd(), CLUSTER_CONFIG_FILE_NAME)
 
 SYSTEMD_RUN_UNIT_NAME = 'cfy_cluster_manager_{}'
+NODE_TYPES = ('postgresql', 'rabbitmq', 'manager')
 BASE_CFY_DIR = '/etc/cloudify/'
 INITIAL_INSTALL_DIR = join(BASE_CFY_DIR, '.installed')
+SERVICE_NAMES = {'postgresql': 'database_service',
+                 'rabbitmq': 'queue_service',
+                 'manager': 'manager_service'}
+# The values hidden in the config files' diffs, e.g. `admin_password: x`,
+# `erlang_cookie: x` or the `'password': 'x'` of an inline dict
+SECRET_PATTERN = re.compile(
+    r"((password|token|cookie)'?:\s*)('[^']*'|[^\s,}]+)")
+
+INSTALL_TIMEOUT = 3600
+UNIT_POLL_INTERVAL = 3
+UNIT_POLL_TIMEOUT = 30
+UNIT_LOG_LINES = 50
+LIVENESS_PROBES = 3
+RPM_INSTALL_TIMEOUT = 900
+REMOVE_TIMEOUT = 1800
+UPGRADE_TIMEOUT = 3600
+CONFIGURE_TIMEOUT = 1800
 
 DEFAULT_RPM = 'http://repository.cloudifysource.org/cloudify/5.1.2/ga-' \
               'release/cloudify-manager-install-5.1.2-ga.el7.x86_64.rpm'
@@ -64,17 +130,28 @@ class CfyNode(VM):
                  hostname,
                  cert_path,
                  key_path,
-                 config_file_path):
+                 config_file_path,
+                 transport=None,
+                 transport_options=None):
         super(CfyNode, self).__init__(private_ip, public_ip,
-                                      key_file_path, username, password)
+                                      key_file_path, username, password,
+                                      transport, transport_options)
         self.name = node_name
         self.hostname = hostname
         self.provided_cert_path = expanduser(cert_path) if cert_path else None
         self.provided_key_path = expanduser(key_path) if key_path else None
         self.cert_path = join(CERTS_DIR, node_name + '_cert.pem')
         self.key_path = join(CERTS_DIR, node_name + '_key.pem')
+        self.remote_cert_path = _get_remote_path(self.cert_path)
+        self.remote_key_path = _get_remote_path(self.key_path)
         self.type, self.number = node_name.split('-')
         self.installed = False
+        # Whether `prepare` staged the node, so only `cfy_manager` is left
+        self.staged = False
+        # Whether the host has the RPM being installed, once it's checked
+        self.rpm_up_to_date = None
+        # Whether this run uploaded the host's bundle
+        self.bundle_uploaded = False
         self.provided_config_path = (expanduser(config_file_path) if
                                      config_file_path else None)
         self.config_path = join(
@@ -85,7 +162,7 @@ class CfyNode(VM):
         # You need to verify cloudify-manager-install is installed
         cfy_version_res = self.run_command(
             'rpm --queryformat "%{VERSION}" -q cloudify-manager-install',
-            hide_stdout=True)
+            hide_stdout=True, idempotent=True)
         return cfy_version_res.stdout
 
 
@@ -96,6 +173,10 @@ def _exception_handler(type_, value, traceback):
     logger.error(error)
     debug_traceback = ''.join(format_exception(type_, value, traceback))
     logger.debug(debug_traceback)
+    retry_stats.log_report()
+    remote_stats.log_report()
+    concurrency_limiter.log_report()
+    transfer_stats.log_report()
 
 
 sys.excepthook = _exception_handler
@@ -111,8 +192,38 @@ def _generate_instance_certificate(instance):
     sudo(['chmod', '444', new_key_path])
 
 
+@contextmanager
+def _local_lock():
+    """Hold a lock shared by the cluster manager processes of this machine,
+    e.g. the clusters of a fleet."""
+    if not exists(dirname(LOCAL_LOCK_PATH)):
+        os.makedirs(dirname(LOCAL_LOCK_PATH))
+    with open(LOCAL_LOCK_PATH, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
 def _generate_certs(instances_dict):
+    """Generate the instances' certificates. Once the cluster's CA was
+    generated, the certificates of nodes added later are signed by it.
+
+    `cfy_manager generate-test-cert` keeps its CA in CFY_CERTS_PATH, so
+    other processes are locked out until it's removed.
+    """
+    with _local_lock():
+        _generate_certs_locked(instances_dict)
+
+
+def _generate_certs_locked(instances_dict):
     logger.info('Generating certificates')
+    if exists(join(CERTS_DIR, 'ca.key')):
+        if not exists(CFY_CERTS_PATH):
+            os.makedirs(CFY_CERTS_PATH)
+        copy(CA_PATH, join(CFY_CERTS_PATH, 'ca.crt'))
+        copy(join(CERTS_DIR, 'ca.key'), join(CFY_CERTS_PATH, 'ca.key'))
     for instances_list in instances_dict.values():
         for instance in instances_list:
             _generate_instance_certificate(instance)
@@ -144,39 +255,41 @@ def _get_rabbitmq_cluster_members(rabbitmq_instances, load_balance_ip):
 
 def _prepare_postgresql_config_files(template,
                                      postgresql_instances,
-                                     credentials):
+                                     credentials,
+                                     config_files_dir):
     logger.info('Preparing PostgreSQL config files')
     postgresql_cluster = _get_postgresql_cluster_members(postgresql_instances)
     for node in postgresql_instances:
         if node.provided_config_path:
-            _create_config_file(node)
+            _create_config_file(node, config_files_dir)
             continue
         rendered_data = template.render(node=node,
                                         creds=credentials,
-                                        ca_path=CA_PATH,
+                                        ca_path=_get_remote_path(CA_PATH),
                                         postgresql_cluster=postgresql_cluster)
-        _create_config_file(node, rendered_data)
+        _create_config_file(node, config_files_dir, rendered_data)
 
 
 def _prepare_rabbitmq_config_files(template,
                                    rabbitmq_instances,
                                    credentials,
-                                   load_balancer_ip):
+                                   load_balancer_ip,
+                                   config_files_dir):
     logger.info('Preparing RabbitMQ config files')
     rabbitmq_cluster = _get_rabbitmq_cluster_members(
         rabbitmq_instances, load_balancer_ip)
     for i, node in enumerate(rabbitmq_instances):
         if node.provided_config_path:
-            _create_config_file(node)
+            _create_config_file(node, config_files_dir)
             continue
         join_cluster = rabbitmq_instances[0].name if i > 0 else None
         rendered_data = template.render(node=node,
                                         creds=credentials,
-                                        ca_path=CA_PATH,
+                                        ca_path=_get_remote_path(CA_PATH),
                                         join_cluster=join_cluster,
                                         rabbitmq_cluster=rabbitmq_cluster,
                                         load_balancer_ip=load_balancer_ip)
-        _create_config_file(node, rendered_data)
+        _create_config_file(node, config_files_dir, rendered_data)
 
 
 def _prepare_manager_config_files(template,
@@ -184,37 +297,42 @@ def _prepare_manager_config_files(template,
                                   credentials,
                                   load_balancer_ip,
                                   external_db_config,
-                                  ldap_configuration):
+                                  ldap_configuration,
+                                  config_files_dir):
     logger.info('Preparing Manager config files')
     if external_db_config:
-        external_db_config.update({'ssl_client_verification': False,
-                                   'ca_path': EXTERNAL_DB_CA_PATH})
+        external_db_config.update({
+            'ssl_client_verification': False,
+            'ca_path': _get_remote_path(EXTERNAL_DB_CA_PATH)})
     if ldap_configuration:
-        ldap_configuration.update({'ca_cert': LDAP_CA_PATH})
+        ldap_configuration.update({'ca_cert': _get_remote_path(LDAP_CA_PATH)})
 
+    rabbitmq_cluster = _get_rabbitmq_cluster_members(
+        instances_dict['rabbitmq'], load_balancer_ip)
+    postgresql_cluster = ({} if external_db_config else
+                          _get_postgresql_cluster_members(
+                              instances_dict['postgresql']))
     for node in instances_dict['manager']:
         if node.provided_config_path:
-            _create_config_file(node)
+            _create_config_file(node, config_files_dir)
             continue
         rendered_data = template.render(
             node=node,
             creds=credentials,
-            ca_path=CA_PATH,
-            license_path=join(CLUSTER_INSTALL_DIR, 'license.yaml'),
+            ca_path=_get_remote_path(CA_PATH),
+            license_path=join(REMOTE_INSTALL_DIR, 'license.yaml'),
             load_balancer_ip=load_balancer_ip,
-            rabbitmq_cluster=_get_rabbitmq_cluster_members(
-                instances_dict['rabbitmq'], load_balancer_ip),
-            postgresql_cluster={} if external_db_config else
-            _get_postgresql_cluster_members(instances_dict['postgresql']),
+            rabbitmq_cluster=rabbitmq_cluster,
+            postgresql_cluster=postgresql_cluster,
             external_db_configuration=external_db_config,
             ldap_configuration=ldap_configuration
         )
 
-        _create_config_file(node, rendered_data)
+        _create_config_file(node, config_files_dir, rendered_data)
 
 
-def _create_config_file(node, rendered_data=None):
-    config_path = join(CONFIG_FILES_DIR, '{0}_config.yaml'.format(node.name))
+def _create_config_file(node, config_files_dir, rendered_data=None):
+    config_path = join(config_files_dir, '{0}_config.yaml'.format(node.name))
     if rendered_data:
         with open(config_path, 'w') as config_file:
             config_file.write(rendered_data)
@@ -222,8 +340,12 @@ def _create_config_file(node, rendered_data=None):
         copy(node.provided_config_path, config_path)
 
 
-def _prepare_config_files(instances_dict, credentials, config):
-    os.mkdir(CONFIG_FILES_DIR)
+def _prepare_config_files(instances_dict, credentials, config,
+                          config_files_dir=None):
+    """Render the instances' config files into `config_files_dir`, which
+    is created, CONFIG_FILES_DIR by default."""
+    config_files_dir = config_files_dir or CONFIG_FILES_DIR
+    os.mkdir(config_files_dir)
     templates_env = Environment(
         loader=FileSystemLoader(pkg_resources.resource_filename(
             'cfy_cluster_manager', 'config_files_templates')))
@@ -236,13 +358,15 @@ def _prepare_config_files(instances_dict, credentials, config):
         _prepare_postgresql_config_files(
             templates_env.get_template('postgresql_config.yaml'),
             instances_dict['postgresql'],
-            credentials)
+            credentials,
+            config_files_dir)
 
     _prepare_rabbitmq_config_files(
         templates_env.get_template('rabbitmq_config.yaml'),
         instances_dict['rabbitmq'],
         credentials,
-        config.get('load_balancer_ip'))
+        config.get('load_balancer_ip'),
+        config_files_dir)
 
     _prepare_manager_config_files(
         templates_env.get_template('manager_config.yaml'),
@@ -250,61 +374,161 @@ def _prepare_config_files(instances_dict, credentials, config):
         credentials,
         config.get('load_balancer_ip'),
         external_db_config,
-        ldap_configuration
+        ldap_configuration,
+        config_files_dir
     )
 
 
 def _install_cloudify_remotely(instance):
     logger.info('Installing Cloudify RPM on %s', instance.name)
     instance.run_command(
-        'yum install -y {}'.format(RPM_PATH), use_sudo=True, hide_stdout=True)
+        'yum install -y {}'.format(_get_remote_path(RPM_PATH)),
+        use_sudo=True, hide_stdout=True, timeout=RPM_INSTALL_TIMEOUT,
+        idempotent=True)
 
 
 def _get_service_status_code(instance):
     """Checking the status code of the cfy_manager_install_<type> service."""
     result = instance.run_command(
         'systemctl status {}'.format(instance.unit_name),
-        use_sudo=True, hide_stdout=True, ignore_failure=True)
+        use_sudo=True, hide_stdout=True, ignore_failure=True,
+        timeout=UNIT_POLL_TIMEOUT, retry_policy=NO_RETRIES)
     return result.return_code
 
 
+def _get_unit_logs(instance, lines=UNIT_LOG_LINES):
+    """Return the tail of the `cfy_manager install` transient unit's journal.
+
+    Since the installation runs detached from the SSH session, its output is
+    not streamed back to us, so we fetch it from the journal when needed.
+    """
+    result = instance.run_command(
+        'journalctl -u {0} --no-pager -n {1}'.format(
+            instance.unit_name, lines),
+        use_sudo=True, hide_stdout=True, ignore_failure=True,
+        idempotent=True)
+    return result.stdout
+
+
 def _wait_for_cloudify_current_installation(instance):
     logger.info(
         'Waiting for current installation of %s to finish', instance.name)
     status_code = 0
-    retry_count = 0
-    while status_code == 0 and retry_count <= 600:
-        if retry_count % 20 == 0:
+    start_time = time.time()
+    poll_count = 0
+    while status_code == 0:
+        run_deadline.check()
+        if time.time() - start_time > INSTALL_TIMEOUT:
+            raise ClusterInstallError(
+                'Got a time out while waiting for the current installation '
+                'of {0} to finish'.format(instance.name))
+        if poll_count % 10 == 0:
             logger.info('Waiting for current installation of %s to finish',
                         instance.name)
+        time.sleep(UNIT_POLL_INTERVAL)
+        poll_count += 1
+        try:
+            status_code = _get_service_status_code(instance)
+        except ClusterInstallError as exc:
+            # The installation runs detached from our SSH session, so losing
+            # the connection doesn't affect it. We keep on polling as long as
+            # the instance itself is alive.
+            logger.warning('Could not get the installation status of %s, '
+                           'retrying: %s', instance.name, exc)
+            _verify_instance_alive(instance)
+
+
+def _verify_instance_alive(instance):
+    """Raise NodeUnreachableError if the instance doesn't answer probes."""
+    for _ in range(LIVENESS_PROBES):
+        if instance.is_alive():
+            return
         time.sleep(1)
-        retry_count += 1
-        status_code = _get_service_status_code(instance)
+    raise NodeUnreachableError(
+        'The instance {0} ({1}) is unreachable. It might have crashed or '
+        'been disconnected from the network'.format(instance.name,
+                                                    instance.private_ip))
 
-    if retry_count > 600:
-        raise ClusterInstallError(
-            'Got a time out while waiting for the current installation of '
-            '%s to finish', instance.name)
+
+def _monitor_cloudify_installation(instance):
+    """Wait for a detached `cfy_manager install` unit and verify its result."""
+    _wait_for_cloudify_current_installation(instance)
+    _verify_cloudify_installed_successfully(instance)
+    instance.run_command('cp {0} {1}'.format(
+        '/etc/cloudify/config.yaml', instance.config_path), use_sudo=True,
+        idempotent=True)
+    _record_applied_files(instance)
+    instance.installed = True
+
+
+def _get_remote_path(path):
+    """The path on the hosts of a file of CLUSTER_INSTALL_DIR."""
+    return join(REMOTE_INSTALL_DIR, relpath(path, CLUSTER_INSTALL_DIR))
+
+
+def _get_uploaded_digest_path(instance):
+    return join(REMOTE_INSTALL_DIR, NODE_DIGEST_NAME.format(instance.name))
+
+
+def _get_applied_digest_path(instance):
+    return join(BASE_CFY_DIR, NODE_DIGEST_NAME.format(instance.name))
+
+
+def _record_applied_files(instance):
+    """Record that the instance runs with its uploaded files. Bundles
+    uploaded by older versions have no digest file of the instance."""
+    instance.run_command('cp {0} {1}'.format(
+        _get_uploaded_digest_path(instance),
+        _get_applied_digest_path(instance)), use_sudo=True,
+        ignore_failure=True, idempotent=True)
 
 
 def _rpm_was_installed(instance):
     logger.debug(
         'Checking if Cloudify RPM was installed on %s', instance.private_ip)
     result = instance.run_command('rpm -qi cloudify-manager-install',
-                                  hide_stdout=True, ignore_failure=True)
+                                  hide_stdout=True, ignore_failure=True,
+                                  idempotent=True)
 
     return not result.failed
 
 
+def _get_installed_rpm(instance):
+    """The cloudify-manager-install package installed on the instance, or
+    None."""
+    result = instance.run_command(
+        "rpm -q --queryformat '{0}' cloudify-manager-install".format(
+            QUERY_FORMAT), hide_stdout=True, ignore_failure=True,
+        idempotent=True)
+    if result.failed:
+        return None
+    return parse_query_output(result.stdout)
+
+
+def _read_rpm_package(rpm_path):
+    """The package in a local RPM, or None if its header can't be read."""
+    if not exists(rpm_path):
+        return None
+    try:
+        package = read_rpm_header(rpm_path)
+    except (IOError, OSError, RpmHeaderError) as exc:
+        logger.warning('Could not read the RPM header, so any installed '
+                       'version of cloudify-manager-install is accepted: %s',
+                       exc)
+        return None
+    logger.debug('The RPM %s is %s', rpm_path, package)
+    return package
+
+
 def _verify_service_installed(instance):
     """Checking if the instance type .installed file was created."""
     logger.info('Verifying that %s (%s) was installed successfully',
                 instance.name, instance.private_ip)
-    names_mapping = {'postgresql': 'database_service',
-                     'rabbitmq': 'queue_service',
-                     'manager': 'manager_service'}
-    return instance.file_exists(
-        join(INITIAL_INSTALL_DIR, names_mapping[instance.type]))
+    return instance.file_exists(_get_service_path(instance))
+
+
+def _get_service_path(instance):
+    return join(INITIAL_INSTALL_DIR, SERVICE_NAMES[instance.type])
 
 
 def _cloudify_was_previously_installed_successfully(instance):
@@ -331,7 +555,7 @@ def _cloudify_was_previously_installed_successfully(instance):
     elif status_code == 3:
         instance.run_command(
             'systemctl reset-failed {}'.format(instance.unit_name),
-            use_sudo=True, hide_stdout=True)
+            use_sudo=True, hide_stdout=True, idempotent=True)
         return False
     elif status_code == 4:
         return _verify_service_installed(instance)
@@ -344,8 +568,9 @@ def _verify_cloudify_installed_successfully(instance):
     status_code = _get_service_status_code(instance)
     if status_code == 3:
         raise ClusterInstallError(
-            'Failed installing Cloudify on instance {}.'.format(
-                instance.private_ip))
+            'Failed installing Cloudify on instance {0}. Last lines of the '
+            'installation log:\n{1}'.format(instance.private_ip,
+                                            _get_unit_logs(instance)))
     elif status_code == 4:
         return _verify_service_installed(instance)
     else:
@@ -353,36 +578,268 @@ def _verify_cloudify_installed_successfully(instance):
             'Service {} status is unknown'.format(instance.unit_name))
 
 
-def _install_instances(instances_dict, verbose):
-    for i, instance_type in enumerate(instances_dict):
-        logger.info('installing %s instances', instance_type)
-        for instance in instances_dict[instance_type]:
-            if instance.installed:
-                logger.info('Already installed %s (%s)',
-                            instance.name, instance.private_ip)
-                continue
+def _start_cloudify_installation(instance, verbose):
+    """Start `cfy_manager install` as a detached transient systemd unit.
+
+    The unit is not bound to the SSH session, so the installation keeps on
+    running if the connection to the instance drops. Its progress is then
+    followed by `_monitor_cloudify_installation`.
+    """
+    install_cmd = (
+        'systemd-run --unit {unit_name} --uid {user_name} '
+        'cfy_manager install -c {config} {verbose}'.format(
+            config=instance.config_path, unit_name=instance.unit_name,
+            user_name=getuser(), verbose='-v' if verbose else ''))
+
+    instance.run_command(install_cmd, use_sudo=True)
+
+
+def _run_plan(steps, run_step, history, version, max_parallel, done=()):
+    """Run the plan's steps in parallel, the longest critical path first.
+
+    A node's result is set once its last step finished, or once one of its
+    steps failed.
+    """
+    estimate_plan(steps, history, version)
+    last_steps = dict((step.instance, step) for step in steps)
+
+    def run_node_step(step):
+        try:
+            run_step(step)
+        except BaseException:
+            run_metrics.set_node_result(step.instance.name, False)
+            raise
+        if last_steps[step.instance] is step:
+            run_metrics.set_node_result(step.instance.name, True)
+
+    run_plan(steps, run_node_step, max_parallel, done)
+
 
-            logger.info('Installing %s', instance.name)
-            instance.put_dir(CLUSTER_INSTALL_DIR, CLUSTER_INSTALL_DIR)
+def _get_host_instances(instances_dict):
+    """The instances of each host. A three nodes cluster's hosts run an
+    instance of each type."""
+    host_instances = {}
+    for instances_list in instances_dict.values():
+        for instance in instances_list:
+            host_instances.setdefault(instance.private_ip, []).append(
+                instance)
+    return host_instances
+
+
+def _rpm_up_to_date_on_host(instance, host_instances, rpm_package):
+    """Whether the host has `rpm_package` installed, or any version of it
+    if the RPM's header couldn't be read."""
+    if instance.rpm_up_to_date is None:
+        installed = _get_installed_rpm(instance)
+        up_to_date = installed is not None and (
+            rpm_package is None or installed.matches(rpm_package))
+        if installed is not None and not up_to_date:
+            logger.warning('%s has %s installed rather than %s',
+                           instance.private_ip, installed, rpm_package)
+        for host_instance in host_instances:
+            host_instance.rpm_up_to_date = up_to_date
+    return instance.rpm_up_to_date
+
+
+def _get_node_files(instance):
+    """The files of CLUSTER_INSTALL_DIR the instance needs: the CA, its
+    own certificate, key and config file, and the license and the external
+    DB and LDAP CAs for managers."""
+    paths = [CA_PATH, instance.cert_path, instance.key_path,
+             join(CONFIG_FILES_DIR, '{0}_config.yaml'.format(instance.name))]
+    if instance.type == 'manager':
+        paths.extend((join(CLUSTER_INSTALL_DIR, 'license.yaml'),
+                      EXTERNAL_DB_CA_PATH, LDAP_CA_PATH))
+    return sorted(path for path in paths if exists(path))
+
+
+def _get_node_digest(instance, config_path=None):
+    """:param config_path: A config file to take in place of the instance's
+                        one in CONFIG_FILES_DIR, e.g. a newly rendered
+                        one."""
+    if not config_path:
+        return _get_bundle_digest(_get_node_files(instance))
+    node_config_path = join(CONFIG_FILES_DIR,
+                            '{0}_config.yaml'.format(instance.name))
+    paths = set(_get_node_files(instance))
+    paths.add(node_config_path)
+    return _get_bundle_digest(sorted(paths),
+                              {node_config_path: config_path})
+
+
+def _get_bundle_files(host_instances, include_rpm):
+    """The files of CLUSTER_INSTALL_DIR the instances of a host need, and
+    the RPM if it's needed."""
+    paths = set()
+    for instance in host_instances:
+        paths.update(_get_node_files(instance))
+    if include_rpm:
+        paths.add(RPM_PATH)
+    return sorted(paths)
+
+
+def _get_bundle_digest(paths, sources=None):
+    """The SHA256 digest of the bundle's files' paths and contents.
+
+    :param sources: The local files holding the contents of some of the
+                    paths, by path.
+    """
+    sources = sources or {}
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(relpath(path, CLUSTER_INSTALL_DIR).encode('utf-8') +
+                      b'\0')
+        with open(sources.get(path, path), 'rb') as bundle_file:
+            for chunk in iter(lambda: bundle_file.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _create_bundle(host_instances, paths, digest):
+    """Stage a host's files in a local directory laid out like
+    CLUSTER_INSTALL_DIR, so the other nodes' keys never leave this machine.
+
+    :return: The bundle's directory.
+    """
+    bundle_dir = tempfile.mkdtemp(prefix='{0}_{1}_'.format(
+        DIR_NAME, host_instances[0].private_ip))
+    for path in paths:
+        bundle_path = join(bundle_dir, relpath(path, CLUSTER_INSTALL_DIR))
+        if not isdir(dirname(bundle_path)):
+            os.makedirs(dirname(bundle_path))
+        try:
+            # The RPM is large, so it's linked rather than copied if possible
+            os.link(path, bundle_path)
+        except OSError:
+            shutil.copy2(path, bundle_path)
+    with open(join(bundle_dir, BUNDLE_DIGEST_NAME), 'w') as digest_file:
+        digest_file.write(digest)
+    for instance in host_instances:
+        with open(join(bundle_dir, NODE_DIGEST_NAME.format(instance.name)),
+                  'w') as digest_file:
+            digest_file.write(_get_node_digest(instance))
+    return bundle_dir
+
+
+def _get_uploaded_bundle_digest(instance):
+    result = instance.run_command(
+        'cat {0}'.format(join(REMOTE_INSTALL_DIR, BUNDLE_DIGEST_NAME)),
+        hide_stdout=True, ignore_failure=True, idempotent=True)
+    return None if result.failed else result.stdout.strip()
 
-            if not _rpm_was_installed(instance):
-                _install_cloudify_remotely(instance)
 
-            instance.run_command('cp {0} {1}'.format(
-                join(CONFIG_FILES_DIR, '{}_config.yaml'.format(instance.name)),
-                instance.config_path), use_sudo=True)
+def _upload_bundle(instance, host_instances, rpm_package,
+                   reuse_bundle=False):
+    """Upload the host's bundle, once for all the host's instances.
 
-            install_cmd = (
-                'systemd-run -t --unit {unit_name} --uid {user_name} '
-                'cfy_manager install -c {config} {verbose}'.format(
-                    config=instance.config_path, unit_name=instance.unit_name,
-                    user_name=getuser(), verbose='-v' if verbose else ''))
+    :param reuse_bundle: Keep the bundle a previous installation uploaded,
+                         if it has the same files. The RPM is left out of
+                         the comparison, since it's uploaded only to hosts
+                         which don't have it installed.
+    """
+    if instance.bundle_uploaded:
+        logger.debug('The files of %s were already uploaded',
+                     instance.private_ip)
+        return
+    include_rpm = not _rpm_up_to_date_on_host(instance, host_instances,
+                                              rpm_package)
+    paths = _get_bundle_files(host_instances, include_rpm)
+    digest = _get_bundle_digest([path for path in paths if path != RPM_PATH])
+    if reuse_bundle and not include_rpm and \
+            _get_uploaded_bundle_digest(instance) == digest:
+        logger.info('Reusing the files uploaded to %s before',
+                    instance.private_ip)
+    else:
+        # The upload doesn't remove the files of a previous bundle
+        instance.run_command('rm -rf {0}'.format(REMOTE_INSTALL_DIR),
+                             idempotent=True)
+        bundle_dir = _create_bundle(host_instances, paths, digest)
+        try:
+            instance.put_dir(bundle_dir, REMOTE_INSTALL_DIR)
+        finally:
+            shutil.rmtree(bundle_dir, ignore_errors=True)
+    for host_instance in host_instances:
+        host_instance.bundle_uploaded = True
+
+
+def _install_instances(instances_dict, verbose, history, version,
+                       max_parallel=DEFAULT_MAX_PARALLEL, rpm_package=None,
+                       reuse_bundle=False):
+    steps = build_install_plan(instances_dict)
+    done = [step for step in steps if step.instance.installed or (
+        step.instance.staged and step.step != 'cfy_manager install')]
+    for instance in set(step.instance for step in done
+                        if step.instance.installed):
+        logger.info('Already installed %s (%s)',
+                    instance.name, instance.private_ip)
+        run_metrics.set_node_result(instance.name, True)
+    host_instances = _get_host_instances(instances_dict)
+    _run_plan(steps, lambda step: _run_install_step(
+        step, verbose, host_instances[step.instance.private_ip],
+        rpm_package, reuse_bundle), history, version, max_parallel, done)
+
+
+def _stage_instances(instances_dict, journal, history, version,
+                     max_parallel=DEFAULT_MAX_PARALLEL, rpm_package=None):
+    """Upload the files, install the RPM and copy the config file on all
+    the instances, recording each staged instance in the journal."""
+    steps = build_prepare_plan(instances_dict)
+    done = [step for step in steps
+            if step.instance.name in journal.staged_nodes]
+    for instance in set(step.instance for step in done):
+        logger.info('Already staged %s (%s)',
+                    instance.name, instance.private_ip)
+        run_metrics.set_node_result(instance.name, True)
+    host_instances = _get_host_instances(instances_dict)
+
+    def run_step(step):
+        _run_install_step(step, False,
+                          host_instances[step.instance.private_ip],
+                          rpm_package)
+        if step.step == 'config copy':
+            journal.node_staged(step.instance.name)
+
+    _run_plan(steps, run_step, history, version, max_parallel, done)
+
+
+def _copy_config_file(instance):
+    instance.run_command('cp {0} {1}'.format(
+        _get_remote_path(join(CONFIG_FILES_DIR,
+                              '{}_config.yaml'.format(instance.name))),
+        instance.config_path), use_sudo=True, idempotent=True)
+
+
+def _run_install_step(step, verbose, host_instances, rpm_package,
+                      reuse_bundle=False):
+    instance = step.instance
+    if step.step == 'upload':
+        logger.info('Installing %s', instance.name)
+        with remote_stats.phase('upload'), \
+                step_timings.step(instance, 'upload'):
+            _upload_bundle(instance, host_instances, rpm_package,
+                           reuse_bundle)
+
+    elif step.step == 'rpm install':
+        with remote_stats.phase('rpm install'):
+            if not _rpm_up_to_date_on_host(instance, host_instances,
+                                           rpm_package):
+                with step_timings.step(instance, 'rpm install'):
+                    _install_cloudify_remotely(instance)
+                for host_instance in host_instances:
+                    host_instance.rpm_up_to_date = True
+
+    elif step.step == 'config copy':
+        with remote_stats.phase('config copy'), \
+                step_timings.step(instance, 'config copy'):
+            _copy_config_file(instance)
 
-            instance.run_command(install_cmd, use_sudo=True)
-            _verify_cloudify_installed_successfully(instance)
-            instance.run_command('cp {0} {1}'.format(
-                '/etc/cloudify/config.yaml', instance.config_path),
-                use_sudo=True)
+    else:
+        with remote_stats.phase('cfy_manager install'), \
+                step_timings.step(instance, 'cfy_manager install'):
+            if not instance.staged:
+                _copy_config_file(instance)
+            _start_cloudify_installation(instance, verbose)
+            _monitor_cloudify_installation(instance)
 
 
 def _sort_instances_dict(instances_dict):
@@ -391,6 +848,17 @@ def _sort_instances_dict(instances_dict):
             instance_items.sort(key=lambda x: int(x.name.rsplit('-', 1)[1]))
 
 
+def _is_shared_vm(vm_name):
+    """Whether the VM runs an instance of each node type, as the VMs of a
+    three nodes cluster do, rather than being named after its node type."""
+    return vm_name.rsplit('-', 1)[0] not in NODE_TYPES
+
+
+def _using_three_nodes_cluster(config):
+    return any(_is_shared_vm(vm_name)
+               for vm_name in config.get('existing_vms'))
+
+
 def _using_provided_certificates(config):
     return config.get('ca_cert_path')
 
@@ -410,7 +878,9 @@ def _get_cfy_node(config, node_dict, node_name, config_path,
                      node_dict.get('hostname'),
                      cert_path=node_dict.get('cert_path'),
                      key_path=node_dict.get('key_path'),
-                     config_file_path=config_path)
+                     config_file_path=config_path,
+                     transport=config.get('transport'),
+                     transport_options=config.get('transport_options'))
     if validate_connection:
         logger.debug('Testing connection to %s', new_vm.private_ip)
         new_vm.test_connection()
@@ -436,31 +906,46 @@ def _get_instances_ordered_dict(config):
     return instances_dict
 
 
-def _generate_three_nodes_cluster_dict(config):
-    """Going over the existing_vms list and "replicating" each instance X3."""
+def _generate_three_nodes_cluster_dict(config, validate_connection=True):
+    """Going over the existing_vms list and "replicating" each shared VM X3.
+
+    VMs named after a node type, e.g. manager-4, were added to the cluster
+    later, and are instances of their type only.
+    """
     instances_dict = _get_instances_ordered_dict(config)
-    raw_existing_nodes_list = sorted(config.get('existing_vms').items(),
-                                     key=lambda x: x[0])
+    raw_existing_nodes_list = sorted(
+        [node for node in config.get('existing_vms').items()
+         if _is_shared_vm(node[0])], key=lambda x: x[0])
     existing_nodes_list = [node[1] for node in raw_existing_nodes_list]
-    validate_connection = True
+    validate_shared_connection = validate_connection
     for node_type in instances_dict:
         for i, node_dict in enumerate(existing_nodes_list):
-            new_vm = _get_cfy_node(config,
-                                   node_dict,
-                                   node_name=(node_type + '-' + str(i + 1)),
-                                   config_path=node_dict['config_path'].get(
-                                       node_type + '_config_path'),
-                                   validate_connection=validate_connection)
+            new_vm = _get_cfy_node(
+                config,
+                node_dict,
+                node_name=(node_type + '-' + str(i + 1)),
+                config_path=node_dict['config_path'].get(
+                    node_type + '_config_path'),
+                validate_connection=validate_shared_connection)
             instances_dict[node_type].append(new_vm)
-        validate_connection = False
+        validate_shared_connection = False
+    for node_name, node_dict in config.get('existing_vms').items():
+        if not _is_shared_vm(node_name):
+            new_vm = _get_cfy_node(config, node_dict, node_name,
+                                   node_dict.get('config_path'),
+                                   validate_connection)
+            instances_dict[new_vm.type].append(new_vm)
+
+    _sort_instances_dict(instances_dict)
     return instances_dict
 
 
-def _generate_general_cluster_dict(config):
+def _generate_general_cluster_dict(config, validate_connection=True):
     instances_dict = _get_instances_ordered_dict(config)
     for node_name, node_dict in config.get('existing_vms').items():
         new_vm = _get_cfy_node(config, node_dict, node_name,
-                               node_dict.get('config_path'))
+                               node_dict.get('config_path'),
+                               validate_connection)
         instances_dict[new_vm.type].append(new_vm)
 
     _sort_instances_dict(instances_dict)
@@ -471,7 +956,8 @@ def _create_cluster_install_directory():
     logger.info('Creating `{0}` directory'.format(DIR_NAME))
     if exists(CLUSTER_INSTALL_DIR):
         new_dirname = (time.strftime('%Y%m%d-%H%M%S_') + DIR_NAME)
-        move(CLUSTER_INSTALL_DIR, join(TOP_DIR, new_dirname))
+        move(CLUSTER_INSTALL_DIR,
+             join(dirname(CLUSTER_INSTALL_DIR), new_dirname))
 
     os.mkdir(CLUSTER_INSTALL_DIR)
 
@@ -512,7 +998,14 @@ def _print_success_message(start_time, msg='installed'):
     m, s = divmod(running_time, 60)
     logger.info('Cloudify cluster was successfully {0} in '
                 '{1} minutes and {2} seconds'.format(msg, int(m), int(s)))
-    if msg != 'removed':
+    retry_stats.log_report()
+    remote_stats.log_report()
+    concurrency_limiter.log_report()
+    transfer_stats.log_report()
+    if msg == 'prepared':
+        logger.info('Run `cfy_cluster_manager install` to install the '
+                    'prepared cluster')
+    elif msg != 'removed':
         logger.info(
             'Please run `cfy cluster status` to verify the cluster status '
             'is healthy. It might take up to a minute for it to stabilize')
@@ -564,13 +1057,13 @@ def _validate_config_path(vm_name, config_path, errors_list):
                            'exist.'.format(expanded_path, vm_name))
 
 
-def _validate_config_paths(existing_vms_dict, using_three_nodes, errors_list):
-    if using_three_nodes:
-        config_paths = [config_path for vm_dict in existing_vms_dict.values()
-                        for config_path in vm_dict['config_path'].values()]
-    else:
-        config_paths = [vm_dict.get('config_path') for vm_dict in
-                        existing_vms_dict.values()]
+def _validate_config_paths(existing_vms_dict, errors_list):
+    config_paths = []
+    for vm_name, vm_dict in existing_vms_dict.items():
+        if _is_shared_vm(vm_name):
+            config_paths.extend((vm_dict.get('config_path') or {}).values())
+        else:
+            config_paths.append(vm_dict.get('config_path'))
 
     if all(config_paths):
         for vm_name, vm_dict in existing_vms_dict.items():
@@ -580,7 +1073,7 @@ def _validate_config_paths(existing_vms_dict, using_three_nodes, errors_list):
                     'config path was specified for it. If you wish to use '
                     'your own config path, please make sure the relevant '
                     'certificates are on each VM.'.format(vm_name))
-            if using_three_nodes:
+            if _is_shared_vm(vm_name):
                 for config_name, config_path in vm_dict['config_path'].items():
                     vm_dict['config_path'][config_name] = \
                         _validate_config_path(vm_name,
@@ -597,33 +1090,96 @@ def _validate_config_paths(existing_vms_dict, using_three_nodes, errors_list):
                            'all instances or none of them.')
 
 
+def _get_vm_node_types(vm_name):
+    return NODE_TYPES if _is_shared_vm(vm_name) else \
+        (vm_name.rsplit('-', 1)[0],)
+
+
 def _validate_vms_not_duplicated(existing_vms_dict, errors_list):
-    existing_vms_ips = set()
+    """Nodes of different types may run on the same VM, as the nodes of a
+    three nodes cluster do, but nodes of the same type may not."""
+    vm_names = {}
     for vm_name, vm_dict in existing_vms_dict.items():
         vm_private_ip = vm_dict.get('private_ip')
         if not vm_private_ip:
             errors_list.append(
                 'private_ip should be provided for {0}'.format(vm_name))
             continue
-        for vm in existing_vms_ips:
-            if vm_private_ip == vm[1]:
+        for node_type in _get_vm_node_types(vm_name):
+            other_vm_name = vm_names.setdefault(
+                (vm_private_ip, node_type), vm_name)
+            if other_vm_name != vm_name:
                 errors_list.append(
                     'The private_ips of {0} and {1} are the same. '
-                    'Please ensure all provided VMs have different '
-                    'IPs.'.format(vm[0], vm_name))
+                    'Please ensure all provided VMs of the same node type '
+                    'have different IPs.'.format(other_vm_name, vm_name))
                 break
 
-        existing_vms_ips.add((vm_name, vm_private_ip))
+
+def _validate_node_types_present(config, errors_list):
+    node_types = set(node_type for vm_name in config.get('existing_vms')
+                     for node_type in _get_vm_node_types(vm_name))
+    for node_type in _get_instances_ordered_dict(config):
+        if node_type not in node_types:
+            errors_list.append('At least one {0} node should be '
+                               'provided.'.format(node_type))
+
+
+def _validate_max_upload_rate(vm_name, vm_dict, errors_list):
+    if vm_dict.get('max_upload_rate'):
+        try:
+            parse_rate(vm_dict['max_upload_rate'])
+        except ValueError as exc:
+            errors_list.append('{0}: {1}'.format(vm_name, exc))
+
+
+def _set_host_upload_rates(config):
+    """Cap the uploads to the nodes with a `max_upload_rate`."""
+    for vm_name, vm_dict in config.get('existing_vms').items():
+        if vm_dict.get('max_upload_rate'):
+            try:
+                rate = parse_rate(vm_dict['max_upload_rate'])
+            except ValueError as exc:
+                raise ClusterInstallError('{0}: {1}'.format(vm_name, exc))
+            upload_throttle.set_host_rate(vm_dict.get('private_ip'), rate)
+
+
+def _validate_vm_names(config, using_three_nodes, errors_list):
+    """The VMs which aren't shared are named `<node type>-<number>`. In a
+    three nodes cluster, they're numbered after the shared VMs, whose
+    instances are numbered by their order."""
+    existing_vms_dict = config.get('existing_vms')
+    shared_vms_count = len([vm_name for vm_name in existing_vms_dict
+                            if _is_shared_vm(vm_name)])
+    node_types = _get_instances_ordered_dict(config).keys()
+    for vm_name in existing_vms_dict:
+        if _is_shared_vm(vm_name):
+            continue
+        node_type, number = vm_name.rsplit('-', 1)
+        if node_type not in node_types:
+            errors_list.append('{0} can not be used with an external '
+                               'DB.'.format(vm_name))
+        elif not number.isdigit() or int(number) < 1:
+            errors_list.append('{0} should be named `{1}-<number>`.'.format(
+                vm_name, node_type))
+        elif using_three_nodes and int(number) <= shared_vms_count:
+            errors_list.append(
+                'The number of {0} should be greater than {1}, since the '
+                'three nodes cluster already has a {2}-{1}.'.format(
+                    vm_name, shared_vms_count, node_type))
 
 
 def _validate_existing_vms(config, using_three_nodes, errors_list):
     existing_vms_dict = config.get('existing_vms')
-    _validate_config_paths(existing_vms_dict, using_three_nodes, errors_list)
+    _validate_vm_names(config, using_three_nodes, errors_list)
+    _validate_node_types_present(config, errors_list)
+    _validate_config_paths(existing_vms_dict, errors_list)
     _validate_vms_not_duplicated(existing_vms_dict, errors_list)
     ca_path_exists = (_using_provided_certificates(config) and
                       _check_path(config, 'ca_cert_path', errors_list))
     for vm_name, vm_dict in existing_vms_dict.items():
         logger.info('Validating %s', vm_name)
+        _validate_max_upload_rate(vm_name, vm_dict, errors_list)
         if ca_path_exists:
             ca_cert_path = config.get('ca_cert_path')
             key_path_exists = _check_path(vm_dict, 'key_path',
@@ -681,9 +1237,17 @@ def _validate_ssh_config(config, errors_list):
     _check_value_provided(config, 'ssh_user', errors_list)
 
 
+def _validate_transport(config, errors_list):
+    try:
+        get_transport_class(config.get('transport'))
+    except ClusterInstallError as exc:
+        errors_list.append(str(exc))
+
+
 def validate_config(config, using_three_nodes_cluster, override):
     errors_list = []
     _validate_ssh_config(config, errors_list)
+    _validate_transport(config, errors_list)
     _check_path(config, 'cloudify_license_path', errors_list)
     _check_value_provided(config, 'manager_rpm_path', errors_list)
     _validate_existing_vms(config, using_three_nodes_cluster, errors_list)
@@ -694,25 +1258,72 @@ def validate_config(config, using_three_nodes_cluster, override):
         raise_errors_list(errors_list)
 
 
-def _handle_cluster_config_file(cluster_config_file_name, output_path):
+def _handle_cluster_config_file(cluster_config_file_name, output_path,
+                                **template_args):
     cluster_config_files_env = Environment(
         loader=FileSystemLoader(CLUSTER_CONFIG_FILES_DIR))
     template = cluster_config_files_env.get_template(cluster_config_file_name)
     rendered_data = template.render(
-        credentials_file_path=CREDENTIALS_FILE_PATH)
+        credentials_file_path=CREDENTIALS_FILE_PATH, **template_args)
     with open(output_path, 'w') as output_file:
         output_file.write(rendered_data)
 
 
+def _validate_node_counts(managers, brokers, db_nodes, using_external_db):
+    errors_list = []
+    for count, option in ((managers, '--managers'), (brokers, '--brokers')):
+        if not count:
+            errors_list.append('Please specify `{0}`.'.format(option))
+    if using_external_db and db_nodes:
+        errors_list.append('`--db` can not be used with `--external-db`.')
+    elif not using_external_db and not db_nodes:
+        errors_list.append('Please specify `--db` or `--external-db`.')
+    if errors_list:
+        raise_errors_list(errors_list)
+    if db_nodes and db_nodes % 2 == 0:
+        logger.warning('The DB nodes keep a quorum, so %d DB nodes tolerate '
+                       'no more failures than %d do', db_nodes, db_nodes - 1)
+
+
+def _get_node_names(managers, brokers, db_nodes):
+    node_names = []
+    for node_type, count in (('manager', managers), ('rabbitmq', brokers),
+                             ('postgresql', db_nodes)):
+        node_names.extend('{0}-{1}'.format(node_type, i + 1)
+                          for i in range(count or 0))
+    return node_names
+
+
 def generate_config(output_path,
                     using_three_nodes,
                     using_nine_nodes,
-                    using_external_db):
+                    using_external_db,
+                    managers=None,
+                    brokers=None,
+                    db_nodes=None):
+    """Generate the cluster install configuration file.
+
+    :param managers: The number of managers, used with `brokers` and
+                     `db_nodes` instead of a three or nine nodes cluster.
+    :param brokers: The number of RabbitMQ nodes.
+    :param db_nodes: The number of PostgreSQL nodes, unless using an
+                     external DB.
+    """
     output_path = output_path or CLUSTER_INSTALL_CONFIG_PATH
-
-    if (not using_nine_nodes) and (not using_three_nodes):
+    using_node_counts = any(count is not None
+                            for count in (managers, brokers, db_nodes))
+
+    if using_node_counts:
+        if using_three_nodes or using_nine_nodes:
+            raise ClusterInstallError(
+                '`--managers`, `--brokers` and `--db` can not be used with '
+                '`--three-nodes` or `--nine-nodes`.')
+        _validate_node_counts(managers, brokers, db_nodes, using_external_db)
+    elif (not using_nine_nodes) and (not using_three_nodes):
         raise ClusterInstallError(
-            'Please specify `--three-nodes` or `--nine-nodes`.')
+            'Please specify `--three-nodes`, `--nine-nodes` or the number '
+            'of nodes of each type using `--managers`, `--brokers` and '
+            '`--db`.')
 
     if exists(output_path):
         override_file = input('The path {} already exists, would you like '
@@ -727,7 +1338,13 @@ def generate_config(output_path,
     if isdir(output_path):
         output_path = join(output_path, CLUSTER_CONFIG_FILE_NAME)
 
-    if using_nine_nodes:
+    if using_node_counts:
+        _handle_cluster_config_file(
+            'cfy_custom_cluster_config.yaml', output_path,
+            node_names=_get_node_names(managers, brokers, db_nodes),
+            external_db=using_external_db)
+
+    elif using_nine_nodes:
         if using_external_db:
             _handle_cluster_config_file(
                 'cfy_nine_nodes_external_db_cluster_config.yaml', output_path)
@@ -767,7 +1384,11 @@ def _handle_certificates(config, instances_dict):
                 copy(instance.provided_key_path, instance.key_path)
     else:
         _generate_certs(instances_dict)
+    _copy_ca_files(config)
 
+
+def _copy_ca_files(config):
+    """Copy the external DB and LDAP CAs to CERTS_DIR."""
     external_db_config = _get_external_db_config(config)
     if external_db_config:
         copy(external_db_config.get('ca_path'), EXTERNAL_DB_CA_PATH)
@@ -824,13 +1445,31 @@ def _are_any_services_installed(instance):
                 service_name in ['postgresql', 'rabbitmq', 'manager']])
 
 
-def _remove_cloudify_installation(instance, verbose):
+def _remove_cloudify_installation(instance, verbose, fast_reset=False):
+    try:
+        with remote_stats.phase('remove'):
+            _remove_instance(instance, verbose, fast_reset)
+    except BaseException:
+        run_metrics.set_node_result(instance.name, False)
+        raise
+    run_metrics.set_node_result(instance.name, True)
+
+
+def _remove_instance(instance, verbose, fast_reset=False):
+    """Remove Cloudify from the instance.
+
+    :param fast_reset: Keep the RPM and the uploaded files, so they can be
+                       reused by the next installation.
+    """
     instance.run_command(
         'cfy_manager remove -c {config_path} {verbose}'.format(
-            config_path=instance.config_path, verbose='-v' if verbose else ''))
+            config_path=instance.config_path, verbose='-v' if verbose else ''),
+        timeout=REMOVE_TIMEOUT)
 
     instance.run_command(
-        'rm -f {0}'.format(instance.config_path), use_sudo=True)
+        'rm -f {0} {1}'.format(instance.config_path,
+                               _get_applied_digest_path(instance)),
+        use_sudo=True, idempotent=True)
 
     if '5.1.0' in instance.get_version() and instance.type == 'manager':
         certs_paths_list = [
@@ -847,13 +1486,27 @@ def _remove_cloudify_installation(instance, verbose):
                 instance.run_command(
                     'mv {0} {1}'.format(full_path, new_path), use_sudo=True)
 
+    instance.installed = False
+    if fast_reset:
+        return
+
     if not _are_any_services_installed(instance):
         instance.run_command(
-            'yum remove -y cloudify-manager-install', use_sudo=True)
+            'yum remove -y cloudify-manager-install', use_sudo=True,
+            timeout=RPM_INSTALL_TIMEOUT, idempotent=True)
 
-    instance.run_command('rm -rf {}'.format(CLUSTER_INSTALL_DIR))
+    instance.run_command('rm -rf {}'.format(REMOTE_INSTALL_DIR),
+                         idempotent=True)
 
-    instance.installed = False
+
+def _remove_failed_installation(instance, verbose, fast_reset=False):
+    logger.info('Previous Cloudify installation of %s failed', instance.name)
+    if '5.1.0' in instance.get_version():
+        _create_installation_files(instance, verbose)
+
+    logger.info('Removing failed Cloudify installation from %s',
+                instance.name)
+    _remove_cloudify_installation(instance, verbose, fast_reset)
 
 
 def _get_reversed_instances_dict(instances_dict):
@@ -865,7 +1518,8 @@ def _get_reversed_instances_dict(instances_dict):
     return reversed_instances_dict
 
 
-def _handle_installed_instances(instances_dict, override, verbose):
+def _handle_installed_instances(instances_dict, override, verbose,
+                                fast_reset=False):
     """Checking which instances were installed in the previous installation.
 
     This function goes over each instance in the ordered instances dictionary,
@@ -886,6 +1540,8 @@ def _handle_installed_instances(instances_dict, override, verbose):
     Otherwise, the function will return once it got to a failed instance and
     removed its installation. This is the useful if the user wants to continue
     the installation from where it previously stopped.
+
+    With fast_reset, the RPM and the uploaded files are kept on the instances.
     """
     logger.info('{0} previously installed instances'.format(
         'Overriding' if override else 'Handling'))
@@ -901,23 +1557,69 @@ def _handle_installed_instances(instances_dict, override, verbose):
                                 instance.name)
                     if override:
                         logger.info('Removing Cloudify from %s', instance.name)
-                        _remove_cloudify_installation(instance, verbose)
+                        _remove_cloudify_installation(instance, verbose,
+                                                      fast_reset)
                 else:
-                    logger.info('Previous Cloudify installation of %s failed',
-                                instance.name)
-                    if '5.1.0' in instance.get_version():
-                        _create_installation_files(instance, verbose)
-
-                    logger.info('Removing failed Cloudify installation '
-                                'from %s', instance.name)
-                    _remove_cloudify_installation(instance, verbose)
+                    _remove_failed_installation(instance, verbose,
+                                                fast_reset)
                     if override:
                         continue
 
                     return
 
 
-def install(config_path, override, only_validate, verbose):
+def _get_all_instances(instances_dict):
+    return [instance for instances_list in instances_dict.values()
+            for instance in instances_list]
+
+
+def _prepared_files_exist(instances_dict):
+    """Whether a previous installation left every instance's config file in
+    CLUSTER_INSTALL_DIR."""
+    return all(exists(join(CONFIG_FILES_DIR,
+                           '{0}_config.yaml'.format(instance.name)))
+               for instance in _get_all_instances(instances_dict))
+
+
+def _get_staging_journal():
+    return StagingJournal(join(CLUSTER_INSTALL_DIR, JOURNAL_NAME))
+
+
+def _prepare_local_files(config, instances_dict):
+    """Create CLUSTER_INSTALL_DIR with the license, the RPM, the
+    certificates and the instances' config files.
+
+    :return: The credentials, if they were generated.
+    """
+    credentials = None
+    logger.info('Preparing cluster manager files')
+    _create_cluster_install_directory()
+    copy(config.get('cloudify_license_path'),
+         join(CLUSTER_INSTALL_DIR, 'license.yaml'))
+    _install_cloudify_locally(config.get('manager_rpm_path'))
+    if not _using_provided_config_files(instances_dict):
+        _handle_certificates(config, instances_dict)
+        credentials = _handle_credentials(config.get('credentials'))
+    _prepare_config_files(instances_dict, credentials, config)
+    return credentials
+
+
+def _log_credentials_warning():
+    logger.warning('The credentials file was saved to %s. '
+                   'The credentials are written there in plain text. '
+                   'Please remove it after reviewing it.',
+                   CREDENTIALS_FILE_PATH)
+
+
+def install(config_path, override, only_validate, verbose, transport=None,
+            history_path=DEFAULT_HISTORY_PATH,
+            max_parallel=DEFAULT_MAX_PARALLEL, fast_reset=False):
+    """Install the cluster.
+
+    :param fast_reset: With override, remove only the services and the
+                       state of the previous installation, and reuse its
+                       RPM, certificates, config files and uploaded files.
+    """
     if not yum_is_present():
         raise ClusterInstallError('Yum is not present.')
 
@@ -927,84 +1629,169 @@ def install(config_path, override, only_validate, verbose):
                 'Installing a Cloudify cluster')
     config_path = config_path or CLUSTER_INSTALL_CONFIG_PATH
     config = get_dict_from_yaml(config_path)
-    using_three_nodes_cluster = (len(config.get('existing_vms')) == 3)
+    if transport:
+        config['transport'] = transport
+    using_three_nodes_cluster = _using_three_nodes_cluster(config)
     validate_config(config, using_three_nodes_cluster, override)
     if only_validate:
         logger.info('The configuration file at %s was validated '
                     'successfully.', config_path)
         return
-    instances_dict = (_generate_three_nodes_cluster_dict(config)
-                      if using_three_nodes_cluster else
-                      _generate_general_cluster_dict(config))
-
-    previous_installation = _previous_installation(instances_dict)
-    if previous_installation:
-        logger.info('Cloudify cluster was previously installed')
-        _handle_installed_instances(instances_dict, override, verbose)
+    version = get_rpm_version(config.get('manager_rpm_path'))
+    step_timings.start('install', version)
+    _set_host_upload_rates(config)
+    with remote_stats.phase('connect'):
+        instances_dict = (_generate_three_nodes_cluster_dict(config)
+                          if using_three_nodes_cluster else
+                          _generate_general_cluster_dict(config))
+
+    journal = _get_staging_journal()
+    if not override and journal.is_complete(get_config_digest(config_path)):
+        logger.info('The cluster was prepared, installing the staged nodes')
+        for instance in _get_all_instances(instances_dict):
+            instance.staged = True
+        # If the install fails, it's resumed like an install that wasn't
+        # prepared
+        journal.clear()
+        _install_instances(instances_dict, verbose,
+                           TimingHistory(history_path), version, max_parallel)
+        _log_managers_connection_strings(instances_dict['manager'])
+        _print_success_message(start_time)
+        return
+    # Installing changes what the staging was done on
+    journal.clear()
+
+    with remote_stats.phase('check'):
+        previous_installation = _previous_installation(instances_dict)
+        if previous_installation:
+            logger.info('Cloudify cluster was previously installed')
+            _handle_installed_instances(instances_dict, override, verbose,
+                                        fast_reset)
     if (not previous_installation) or override:
-        logger.info('Preparing cluster manager files')
-        _create_cluster_install_directory()
-        copy(config.get('cloudify_license_path'),
-             join(CLUSTER_INSTALL_DIR, 'license.yaml'))
-        _install_cloudify_locally(config.get('manager_rpm_path'))
-        if not _using_provided_config_files(instances_dict):
-            _handle_certificates(config, instances_dict)
-            credentials = _handle_credentials(config.get('credentials'))
-        _prepare_config_files(instances_dict, credentials, config)
+        if fast_reset and _prepared_files_exist(instances_dict):
+            logger.info('Reusing the certificates and config files of the '
+                        'previous installation')
+            copy(config.get('cloudify_license_path'),
+                 join(CLUSTER_INSTALL_DIR, 'license.yaml'))
+            _install_cloudify_locally(config.get('manager_rpm_path'))
+        else:
+            credentials = _prepare_local_files(config, instances_dict)
 
-    _install_instances(instances_dict, verbose)
+    _install_instances(instances_dict, verbose, TimingHistory(history_path),
+                       version, max_parallel, _read_rpm_package(RPM_PATH),
+                       fast_reset)
     _log_managers_connection_strings(instances_dict['manager'])
     if credentials:
-        logger.warning('The credentials file was saved to %s. '
-                       'The credentials are written there in plain text. '
-                       'Please remove it after reviewing it.',
-                       CREDENTIALS_FILE_PATH)
+        _log_credentials_warning()
     _print_success_message(start_time)
 
 
-def remove(config_path, verbose):
+def prepare(config_path, verbose, transport=None,
+            history_path=DEFAULT_HISTORY_PATH,
+            max_parallel=DEFAULT_MAX_PARALLEL):
+    """Do the slow work of an install in advance, without installing.
+
+    The configuration is validated, the certificates and config files are
+    prepared, and then all the instances are staged in parallel: their
+    files are uploaded, the RPM is installed and their config files are
+    copied to /etc/cloudify. A later `install` only runs `cfy_manager
+    install` on them. Running `prepare` again after it failed resumes it.
+    """
     if not yum_is_present():
         raise ClusterInstallError('Yum is not present.')
 
+    credentials = None
     start_time = time.time()
-    logger.info('Removing Cloudify cluster')
+    logger.info('Preparing a Cloudify cluster')
     config_path = config_path or CLUSTER_INSTALL_CONFIG_PATH
     config = get_dict_from_yaml(config_path)
-    using_three_nodes_cluster = (len(config.get('existing_vms')) == 3)
-    instances_dict = (_generate_three_nodes_cluster_dict(config)
-                      if using_three_nodes_cluster else
-                      _generate_general_cluster_dict(config))
+    if transport:
+        config['transport'] = transport
+    using_three_nodes_cluster = _using_three_nodes_cluster(config)
+    validate_config(config, using_three_nodes_cluster, override=False)
+    version = get_rpm_version(config.get('manager_rpm_path'))
+    step_timings.start('prepare', version)
+    _set_host_upload_rates(config)
+    with remote_stats.phase('connect'):
+        instances_dict = (_generate_three_nodes_cluster_dict(config)
+                          if using_three_nodes_cluster else
+                          _generate_general_cluster_dict(config))
+
+    config_digest = get_config_digest(config_path)
+    journal = _get_staging_journal()
+    if journal.matches(config_digest) and \
+            _prepared_files_exist(instances_dict):
+        logger.info('Resuming the preparation of the cluster')
+    else:
+        with remote_stats.phase('check'):
+            if _previous_installation(instances_dict):
+                raise ClusterInstallError(
+                    'Cloudify was previously installed on the instances. '
+                    'Remove it, or use `install --override`.')
+        credentials = _prepare_local_files(config, instances_dict)
+        journal = _get_staging_journal()
+    journal.start(config_digest)
+    _stage_instances(instances_dict, journal, TimingHistory(history_path),
+                     version, max_parallel, _read_rpm_package(RPM_PATH))
+    journal.complete()
+    if credentials:
+        _log_credentials_warning()
+    _print_success_message(start_time, 'prepared')
+
 
-    if _previous_installation(instances_dict):
-        _handle_installed_instances(instances_dict, True, verbose)
+def remove(config_path, verbose, transport=None):
+    if not yum_is_present():
+        raise ClusterInstallError('Yum is not present.')
+
+    start_time = time.time()
+    logger.info('Removing Cloudify cluster')
+    config_path = config_path or CLUSTER_INSTALL_CONFIG_PATH
+    config = get_dict_from_yaml(config_path)
+    if transport:
+        config['transport'] = transport
+    using_three_nodes_cluster = _using_three_nodes_cluster(config)
+    with remote_stats.phase('connect'):
+        instances_dict = (_generate_three_nodes_cluster_dict(config)
+                          if using_three_nodes_cluster else
+                          _generate_general_cluster_dict(config))
+
+    with remote_stats.phase('check'):
+        previous_installation = _previous_installation(instances_dict)
+    if previous_installation:
+        with remote_stats.phase('remove'):
+            _handle_installed_instances(instances_dict, True, verbose)
         _print_success_message(start_time, 'removed')
     else:
         logger.info('No previous installation of a Cloudify cluster was '
                     'detected. Nothing to remove.')
 
 
-def _upgrade_cluster(instances_dict, verbose, upgrade_rpm_path,
-                     using_three_nodes_cluster):
-    instances_list = instances_dict['manager']
-    if not using_three_nodes_cluster:
-        instances_list += (instances_dict['rabbitmq'] +
-                           instances_dict['postgresql'])
-
-    _install_upgrade_rpm_on_nodes(instances_list, upgrade_rpm_path)
-
-    for instance_type, instances_list in instances_dict.items():
+def _get_upgrade_rpm_instances(instances_dict):
+    """The instances to install the upgrade RPM on, one per host, the
+    managers first."""
+    host_instances = OrderedDict()
+    for instances_list in reversed(list(instances_dict.values())):
         for instance in instances_list:
-            logger.info('Upgrading %s', instance.name)
-            logger.info('Running upgrade command on %s', instance.name)
-            instance.run_command(
-                'cfy_manager upgrade -c {config} {verbose}'.format(
-                    config=instance.config_path,
-                    verbose='-v' if verbose else '')
-            )
-
-
-def _install_upgrade_rpm_on_nodes(instances_list, upgrade_rpm_path):
-    rpm_file_name = time.strftime('%Y%m%d-%H%M%S_') + UPGRADE_RPM_NAME + '.rpm'
+            host_instances.setdefault(instance.private_ip, instance)
+    return list(host_instances.values())
+
+
+def _upgrade_cluster(instances_dict, verbose, upgrade_rpm_path, history,
+                     version,
+                     max_parallel=DEFAULT_MAX_PARALLEL):
+    tmp_upgrade_rpm_path = _get_upgrade_rpm(upgrade_rpm_path)
+    rpm_package = _read_rpm_package(tmp_upgrade_rpm_path)
+    steps = build_upgrade_plan(instances_dict,
+                               _get_upgrade_rpm_instances(instances_dict))
+    _run_plan(steps, lambda step: _run_upgrade_step(
+        step, verbose, tmp_upgrade_rpm_path, rpm_package), history, version,
+        max_parallel)
+
+
+def _get_upgrade_rpm(upgrade_rpm_path):
+    """Copy or download the upgrade RPM to a local temporary path."""
+    rpm_file_name = '{0}{1}_{2}.rpm'.format(
+        time.strftime('%Y%m%d-%H%M%S_'), os.getpid(), UPGRADE_RPM_NAME)
     tmp_upgrade_rpm_path = join('/tmp', rpm_file_name)
     expanded_rpm_path = expanduser(upgrade_rpm_path)
     if exists(expanded_rpm_path):
@@ -1012,46 +1799,1034 @@ def _install_upgrade_rpm_on_nodes(instances_list, upgrade_rpm_path):
     else:
         logger.info('Downloading Cloudify RPM from %s', expanded_rpm_path)
         run(['curl', '-o', tmp_upgrade_rpm_path, expanded_rpm_path])
+    return tmp_upgrade_rpm_path
+
 
-    for instance in instances_list:
+def _upgrade_rpm_installed(instance, rpm_package):
+    """Whether the instance already has the upgrade RPM installed. It's
+    never known to, if the RPM's header couldn't be read."""
+    if rpm_package is None:
+        return False
+    installed = _get_installed_rpm(instance)
+    if installed is None or not installed.matches(rpm_package):
+        return False
+    logger.info('%s already has %s installed', instance.private_ip,
+                installed)
+    return True
+
+
+def _run_upgrade_step(step, verbose, tmp_upgrade_rpm_path, rpm_package):
+    instance = step.instance
+    if step.step == 'rpm upgrade':
+        with remote_stats.phase('rpm upgrade'):
+            if _upgrade_rpm_installed(instance, rpm_package):
+                return
         logger.info('Installing upgrade RPM on %s', instance.private_ip)
-        instance.put_file(tmp_upgrade_rpm_path, tmp_upgrade_rpm_path)
-        instance.run_command(
-            'yum install -y {} --disablerepo=*'.format(tmp_upgrade_rpm_path),
-            use_sudo=True, hide_stdout=True)
+        with remote_stats.phase('rpm upgrade'), \
+                step_timings.step(instance, 'rpm upgrade'):
+            instance.put_file(tmp_upgrade_rpm_path, tmp_upgrade_rpm_path)
+            instance.run_command(
+                'yum install -y {} --disablerepo=*'.format(
+                    tmp_upgrade_rpm_path),
+                use_sudo=True, hide_stdout=True,
+                timeout=RPM_INSTALL_TIMEOUT, idempotent=True)
+
+    else:
+        logger.info('Upgrading %s', instance.name)
+        with remote_stats.phase('cfy_manager upgrade'), \
+                step_timings.step(instance, 'cfy_manager upgrade'):
+            instance.run_command(
+                'cfy_manager upgrade -c {config} {verbose}'.format(
+                    config=instance.config_path,
+                    verbose='-v' if verbose else ''),
+                timeout=UPGRADE_TIMEOUT
+            )
 
 
-def _verify_cloudify_installed(instances_dict, using_three_nodes_cluster):
+def _verify_cloudify_installed(instances_dict):
     logger.info(
         'Verifying cloudify-manager-install is installed on all instances')
-    for instance_type, instances_list in instances_dict.items():
-        for instance in instances_list:
-            logger.debug('Verifying instance %s', instance.private_ip)
-            if not _rpm_was_installed(instance):
-                raise ClusterInstallError(
-                    'cloudify-manager-install is not installed on '
-                    '{0}'.format(instance.private_ip))
-        if using_three_nodes_cluster:  # One iteration goes through all nodes
+    for host_instances in _get_host_instances(instances_dict).values():
+        instance = host_instances[0]
+        logger.debug('Verifying instance %s', instance.private_ip)
+        if not _rpm_was_installed(instance):
+            raise ClusterInstallError(
+                'cloudify-manager-install is not installed on '
+                '{0}'.format(instance.private_ip))
+
+
+def upgrade(config_path, verbose, upgrade_rpm_path, transport=None,
+            history_path=DEFAULT_HISTORY_PATH,
+            max_parallel=DEFAULT_MAX_PARALLEL):
+    if not yum_is_present():
+        raise ClusterInstallError('Yum is not present.')
+
+    start_time = time.time()
+    logger.info('Upgrading Cloudify cluster')
+    config_path = config_path or CLUSTER_INSTALL_CONFIG_PATH
+    config = get_dict_from_yaml(config_path)
+    if transport:
+        config['transport'] = transport
+    using_three_nodes_cluster = _using_three_nodes_cluster(config)
+    version = get_rpm_version(upgrade_rpm_path)
+    step_timings.start('upgrade', version)
+    _set_host_upload_rates(config)
+    with remote_stats.phase('connect'):
+        instances_dict = (_generate_three_nodes_cluster_dict(config)
+                          if using_three_nodes_cluster else
+                          _generate_general_cluster_dict(config))
+
+    with remote_stats.phase('check'):
+        _verify_cloudify_installed(instances_dict)
+    _upgrade_cluster(instances_dict, verbose, upgrade_rpm_path,
+                     TimingHistory(history_path), version, max_parallel)
+    _print_success_message(start_time, 'upgraded')
+
+
+def _fill_credentials(credentials, saved_credentials):
+    """Fill the credentials which weren't provided with the saved ones."""
+    for key, value in credentials.items():
+        saved_value = (saved_credentials or {}).get(key)
+        if isinstance(value, dict):
+            _fill_credentials(value, saved_value)
+        elif not value and saved_value:
+            credentials[key] = saved_value
+
+
+def _get_missing_credentials(credentials, prefix=''):
+    missing = []
+    for key, value in credentials.items():
+        if isinstance(value, dict):
+            missing.extend(_get_missing_credentials(
+                value, '{0}{1}.'.format(prefix, key)))
+        elif not value:
+            missing.append(prefix + key)
+    return missing
+
+
+def _get_installed_credentials(config):
+    """The credentials the cluster was installed with.
+
+    Generating new credentials, like an install does, would change them on
+    every node, so the ones which weren't provided are taken from the
+    credentials file the install saved.
+    """
+    credentials = config.get('credentials')
+    if exists(CREDENTIALS_FILE_PATH):
+        _fill_credentials(credentials,
+                          get_dict_from_yaml(CREDENTIALS_FILE_PATH))
+    missing = _get_missing_credentials(credentials)
+    if missing:
+        raise ClusterInstallError(
+            'The credentials {0} the cluster was installed with are '
+            'unknown, since the credentials file {1} does not exist. Please '
+            'fill them in the configuration file.'.format(
+                ', '.join(missing), CREDENTIALS_FILE_PATH))
+    return credentials
+
+
+def _get_remote_digests(instance, paths):
+    """The SHA256 digests of files on the instance's host, in one command.
+
+    :return: The digests by path. Missing files are left out.
+    """
+    result = instance.run_command(
+        'sha256sum {0}'.format(' '.join(paths)), use_sudo=True,
+        hide_stdout=True, ignore_failure=True, idempotent=True)
+    digests = {}
+    for line in result.stdout.splitlines():
+        fields = line.split(None, 1)
+        if len(fields) == 2:
+            digests[fields[1].strip()] = fields[0]
+    return digests
+
+
+def _get_changed_instances(instances_dict, config_files_dir):
+    """The instances whose files, with their config file in
+    `config_files_dir`, differ from the ones they were last installed or
+    configured with, in the order of `instances_dict`.
+
+    The instance's config file can't be compared to the one on the
+    instance, since `cfy_manager install` replaces it with its own merged
+    one, so the digest file recorded once the files were applied is.
+    Instances installed by older versions have no such file, so whether
+    they changed is unknown.
+
+    :return: The changed instances and the unknown ones, as two
+             dictionaries of the digests of their files, by instance.
+    """
+    changed, unknown = {}, {}
+    for host_instances in _get_host_instances(instances_dict).values():
+        remote_digests = _get_remote_digests(
+            host_instances[0],
+            [_get_applied_digest_path(instance)
+             for instance in host_instances])
+        for instance in host_instances:
+            digest = _get_node_digest(instance, join(
+                config_files_dir, '{0}_config.yaml'.format(instance.name)))
+            applied_digest = remote_digests.get(
+                _get_applied_digest_path(instance))
+            if applied_digest is None:
+                unknown[instance] = digest
+            elif applied_digest != get_marker_digest(digest):
+                changed[instance] = digest
+    instances = _get_all_instances(instances_dict)
+    return (OrderedDict((instance, changed[instance])
+                        for instance in instances if instance in changed),
+            OrderedDict((instance, unknown[instance])
+                        for instance in instances if instance in unknown))
+
+
+def _hide_secrets(line):
+    return SECRET_PATTERN.sub(r'\1<hidden>', line)
+
+
+def _log_config_diff(instance, config_path):
+    """Log the changes to the config file the instance was last applied
+    with, which is kept in CONFIG_FILES_DIR."""
+    applied_path = join(CONFIG_FILES_DIR,
+                        '{0}_config.yaml'.format(instance.name))
+    if not exists(applied_path):
+        logger.info('The config file %s (%s) was applied with is not in %s, '
+                    'so its changes are unknown', instance.name,
+                    instance.private_ip, CONFIG_FILES_DIR)
+        return
+    with open(applied_path) as config_file:
+        applied_lines = config_file.read().splitlines(True)
+    with open(config_path) as config_file:
+        new_lines = config_file.read().splitlines(True)
+    diff = difflib.unified_diff(applied_lines, new_lines, applied_path,
+                                config_path)
+    logger.info('Changes to the config file of %s (%s):\n%s', instance.name,
+                instance.private_ip,
+                ''.join(_hide_secrets(line) for line in diff).rstrip())
+
+
+def _replace_remote_file(instance, local_path, remote_path, use_sudo=False):
+    """Upload a file over the one on the instance.
+
+    The file is uploaded to a new path first, since files which exist on
+    the instance aren't uploaded again.
+    """
+    upload_path = join(TOP_DIR, time.strftime('%Y%m%d-%H%M%S_') +
+                       basename(local_path))
+    instance.put_file(local_path, upload_path)
+    instance.run_command('cp {0} {1}'.format(upload_path, remote_path),
+                         use_sudo=use_sudo, idempotent=True)
+    instance.run_command('rm -f {0}'.format(upload_path), idempotent=True)
+
+
+def _run_cfy_manager_configure(instance, verbose):
+    instance.run_command(
+        'cfy_manager configure -c {config} {verbose}'.format(
+            config=instance.config_path, verbose='-v' if verbose else ''),
+        timeout=CONFIGURE_TIMEOUT)
+
+
+def _record_applied_digest(instance, digest):
+    """Record that the instance runs with files whose digest is `digest`,
+    like `_record_applied_files` does for the uploaded ones."""
+    digest_fd, digest_path = tempfile.mkstemp(prefix=DIR_NAME + '_digest_')
+    try:
+        with os.fdopen(digest_fd, 'w') as digest_file:
+            digest_file.write(digest)
+        _replace_remote_file(instance, digest_path,
+                             _get_applied_digest_path(instance),
+                             use_sudo=True)
+    finally:
+        os.remove(digest_path)
+
+
+def _reconfigure_instance(instance, config_path, digest, verbose):
+    """Replace the instance's config file and run `cfy_manager configure`.
+    Managers also get the current external DB and LDAP CAs.
+
+    :param digest: The digest of the instance's files, with `config_path`.
+    """
+    logger.info('Reconfiguring %s (%s)', instance.name, instance.private_ip)
+    with remote_stats.phase('reconfigure'):
+        if instance.type == 'manager':
+            for ca_path in (EXTERNAL_DB_CA_PATH, LDAP_CA_PATH):
+                if exists(ca_path):
+                    _replace_remote_file(instance, ca_path,
+                                         _get_remote_path(ca_path))
+        _replace_remote_file(instance, config_path, instance.config_path,
+                             use_sudo=True)
+        _run_cfy_manager_configure(instance, verbose)
+        _record_applied_digest(instance, digest)
+    # Keep the local config files the ones the instances run with
+    if not exists(CONFIG_FILES_DIR):
+        os.makedirs(CONFIG_FILES_DIR)
+    copy(config_path, join(CONFIG_FILES_DIR, basename(config_path)))
+    run_metrics.set_node_result(instance.name, True)
+
+
+def reconfigure(config_path, verbose, transport=None, dry_run=False,
+                reconfigure_all=False):
+    """Apply a changed configuration file to an installed cluster.
+
+    The config files of all the instances are rendered again, and the
+    digests of the instances' files are compared to the ones recorded on
+    the instances when they were applied, with a single command per host.
+    The differences are logged, and then only the changed instances are
+    reconfigured, one at a time: the DB nodes first, then the queue nodes
+    and then the managers. The instances whose applied files are unknown
+    are only reconfigured with `reconfigure_all`.
+
+    :param dry_run: Only log the differences.
+    :param reconfigure_all: Reconfigure all the instances, whether or not
+                            they changed.
+    """
+    start_time = time.time()
+    logger.info('Reconfiguring Cloudify cluster')
+    config_path = config_path or CLUSTER_INSTALL_CONFIG_PATH
+    config = get_dict_from_yaml(config_path)
+    if transport:
+        config['transport'] = transport
+    using_three_nodes_cluster = _using_three_nodes_cluster(config)
+    validate_config(config, using_three_nodes_cluster, override=False)
+    with remote_stats.phase('connect'):
+        instances_dict = (_generate_three_nodes_cluster_dict(config)
+                          if using_three_nodes_cluster else
+                          _generate_general_cluster_dict(config))
+
+    with remote_stats.phase('check'):
+        if not _previous_installation(instances_dict):
+            raise ClusterInstallError(
+                'No previous installation of a Cloudify cluster was '
+                'detected. Please run `cfy_cluster_manager install`.')
+    credentials = None
+    if not _using_provided_config_files(instances_dict):
+        credentials = _get_installed_credentials(config)
+        if not dry_run:
+            _copy_ca_files(config)
+    render_dir = tempfile.mkdtemp(prefix=DIR_NAME + '_reconfigure_')
+    try:
+        config_files_dir = join(render_dir, CONFIG_FILES)
+        _prepare_config_files(instances_dict, credentials, config,
+                              config_files_dir)
+        with remote_stats.phase('check'):
+            changed_instances, unknown_instances = _get_changed_instances(
+                instances_dict, config_files_dir)
+        for instance in changed_instances:
+            _log_config_diff(instance, join(
+                config_files_dir, '{0}_config.yaml'.format(instance.name)))
+        if unknown_instances:
+            logger.warning(
+                'The files %s run with are unknown, since they were '
+                'installed by an older version of the Cloudify Cluster '
+                'Manager', ', '.join(instance.name
+                                     for instance in unknown_instances))
+        if reconfigure_all:
+            changed_instances = OrderedDict(
+                (instance, _get_node_digest(instance, join(
+                    config_files_dir,
+                    '{0}_config.yaml'.format(instance.name))))
+                for instance in _get_all_instances(instances_dict))
+        elif unknown_instances and not dry_run:
+            raise ClusterInstallError(
+                'Whether {0} changed is unknown. Please run '
+                '`cfy_cluster_manager reconfigure --all` in order to '
+                'reconfigure all the nodes'.format(
+                    ', '.join(instance.name
+                              for instance in unknown_instances)))
+        if not changed_instances:
+            logger.info('The config files of all the instances are up to '
+                        'date. Nothing to reconfigure.')
+            return
+        if dry_run:
+            logger.info('Would reconfigure %s',
+                        ', '.join(instance.name
+                                  for instance in changed_instances))
             return
+        for instance, digest in changed_instances.items():
+            _reconfigure_instance(instance, join(
+                config_files_dir, '{0}_config.yaml'.format(instance.name)),
+                digest, verbose)
+    finally:
+        shutil.rmtree(render_dir, ignore_errors=True)
+    _print_success_message(start_time, 'reconfigured')
+
+
+def _get_new_instances_dict(instances_dict, node_names):
+    """The instances named `node_names`, in an instances dictionary of
+    their own."""
+    errors_list = []
+    new_instances_dict = OrderedDict(
+        (node_type, []) for node_type in instances_dict)
+    instances = dict((instance.name, instance)
+                     for instance in _get_all_instances(instances_dict))
+    for node_name in node_names:
+        instance = instances.get(node_name)
+        if _is_shared_vm(node_name) or not instance:
+            errors_list.append(
+                '{0} is not in existing_vms. The added nodes should be '
+                'named after their node type, e.g. manager-4.'.format(
+                    node_name))
+        elif instance.type == 'postgresql':
+            errors_list.append(
+                '{0} can not be added, since the DB nodes form their '
+                'cluster when they are installed.'.format(node_name))
+        elif instance is instances_dict[instance.type][0]:
+            errors_list.append(
+                '{0} can not be added, since there is no other {1} node for '
+                'it to join.'.format(node_name, instance.type))
+        else:
+            new_instances_dict[instance.type].append(instance)
+    if errors_list:
+        raise_errors_list(errors_list)
+    return new_instances_dict
+
 
+def _prepare_new_instances_files(config, instances_dict, new_instances_dict):
+    """Add the new instances' certificates and config files to the
+    CLUSTER_INSTALL_DIR the cluster was installed from.
 
-def upgrade(config_path, verbose, upgrade_rpm_path):
+    The config files of all the instances are rendered, so the cluster
+    members in them include the new instances, but only the new instances'
+    ones are kept.
+    """
+    logger.info('Preparing the files of the new nodes')
+    credentials = None
+    if not _using_provided_config_files(instances_dict):
+        if not _using_provided_certificates(config) and \
+                not exists(join(CERTS_DIR, 'ca.key')):
+            raise ClusterInstallError(
+                'The CA the certificates of the cluster were generated with '
+                'is not in {0}.'.format(CERTS_DIR))
+        credentials = _get_installed_credentials(config)
+        _handle_certificates(config, new_instances_dict)
+    copy(config.get('cloudify_license_path'),
+         join(CLUSTER_INSTALL_DIR, 'license.yaml'))
+    if not exists(RPM_PATH):
+        _install_cloudify_locally(config.get('manager_rpm_path'))
+    if not exists(CONFIG_FILES_DIR):
+        os.makedirs(CONFIG_FILES_DIR)
+    render_dir = tempfile.mkdtemp(prefix=DIR_NAME + '_add_node_')
+    try:
+        config_files_dir = join(render_dir, CONFIG_FILES)
+        _prepare_config_files(instances_dict, credentials, config,
+                              config_files_dir)
+        for instance in _get_all_instances(new_instances_dict):
+            copy(join(config_files_dir,
+                      '{0}_config.yaml'.format(instance.name)),
+                 CONFIG_FILES_DIR)
+    finally:
+        shutil.rmtree(render_dir, ignore_errors=True)
+
+
+def add_node(config_path, node_names, verbose, transport=None,
+             history_path=DEFAULT_HISTORY_PATH,
+             max_parallel=DEFAULT_MAX_PARALLEL):
+    """Install new nodes, and join them to the installed cluster.
+
+    The new nodes are existing_vms entries named after their node type,
+    e.g. manager-4 or rabbitmq-4. Only their certificates are generated,
+    and only they are installed, so the rest of the cluster is left as it
+    is. Running `add-node` again after it failed resumes it.
+    """
     if not yum_is_present():
         raise ClusterInstallError('Yum is not present.')
 
     start_time = time.time()
-    logger.info('Upgrading Cloudify cluster')
+    logger.info('Adding %s to the Cloudify cluster', ', '.join(node_names))
     config_path = config_path or CLUSTER_INSTALL_CONFIG_PATH
     config = get_dict_from_yaml(config_path)
-    using_three_nodes_cluster = (len(config.get('existing_vms')) == 3)
-    instances_dict = (_generate_three_nodes_cluster_dict(config)
-                      if using_three_nodes_cluster else
-                      _generate_general_cluster_dict(config))
+    if transport:
+        config['transport'] = transport
+    using_three_nodes_cluster = _using_three_nodes_cluster(config)
+    validate_config(config, using_three_nodes_cluster, override=False)
+    version = get_rpm_version(config.get('manager_rpm_path'))
+    step_timings.start('install', version)
+    _set_host_upload_rates(config)
+    with remote_stats.phase('connect'):
+        instances_dict = (_generate_three_nodes_cluster_dict(config)
+                          if using_three_nodes_cluster else
+                          _generate_general_cluster_dict(config))
+    new_instances_dict = _get_new_instances_dict(instances_dict, node_names)
+
+    with remote_stats.phase('check'):
+        if not _previous_installation(instances_dict):
+            raise ClusterInstallError(
+                'No previous installation of a Cloudify cluster was '
+                'detected. Please run `cfy_cluster_manager install`.')
+        _handle_installed_instances(new_instances_dict, False, verbose)
+    _prepare_new_instances_files(config, instances_dict, new_instances_dict)
+    _install_instances(new_instances_dict, verbose,
+                       TimingHistory(history_path), version, max_parallel,
+                       _read_rpm_package(RPM_PATH))
+    if new_instances_dict['manager']:
+        _log_managers_connection_strings(new_instances_dict['manager'])
+    logger.info('The config files of the other nodes do not list the new '
+                'nodes. Run `cfy_cluster_manager reconfigure` in order to '
+                'update them')
+    _print_success_message(start_time, 'extended')
+
+
+def _observe_host(host_instances, check_units=True):
+    """The NodeStates of a host's instances.
+
+    The RPM is queried, and the digests of the instances' service markers,
+    config files and digest files are taken, with a command each. With
+    `check_units`, an instance whose installation was started, but isn't
+    installed, has its unit checked, and a running installation is waited
+    for.
+    """
+    rpm = _get_installed_rpm(host_instances[0])
+    paths = []
+    for instance in host_instances:
+        paths.extend((_get_service_path(instance), instance.config_path,
+                      _get_uploaded_digest_path(instance),
+                      _get_applied_digest_path(instance)))
+    digests = _get_remote_digests(host_instances[0], paths)
+    states = {}
+    for instance in host_instances:
+        installed = _get_service_path(instance) in digests
+        failed_install = False
+        if not installed and instance.config_path in digests:
+            installed = check_units and \
+                _cloudify_was_previously_installed_successfully(instance)
+            failed_install = not installed
+        instance.installed = installed
+        states[instance] = NodeState(
+            installed, failed_install,
+            digests.get(_get_uploaded_digest_path(instance)),
+            digests.get(_get_applied_digest_path(instance)), rpm)
+    return states
+
+
+def _observe_cluster(instances_dict, max_parallel=DEFAULT_MAX_PARALLEL,
+                     check_units=True):
+    """The NodeState of every instance, observing the hosts in parallel."""
+    logger.info('Observing the state of the instances')
+    states = {}
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        for host_states in executor.map(
+                lambda instances: _observe_host(instances, check_units),
+                _get_host_instances(instances_dict).values()):
+            states.update(host_states)
+    return states
+
+
+def _get_converge_credentials(config, any_installed):
+    """The credentials of the cluster. Missing ones are generated only as
+    long as no instance was installed with others.
+
+    :return: The credentials, and whether any were generated.
+    """
+    if any_installed:
+        return _get_installed_credentials(config), False
+    credentials = config.get('credentials')
+    if exists(CREDENTIALS_FILE_PATH):
+        _fill_credentials(credentials,
+                          get_dict_from_yaml(CREDENTIALS_FILE_PATH))
+    if not _get_missing_credentials(credentials):
+        return credentials, False
+    return _handle_credentials(credentials), True
+
+
+def _prepare_converge_certificates(config, instances_dict, any_installed):
+    """Provide the certificates of the instances which have none. Once the
+    cluster's CA is lost, the certificates are generated again only if no
+    instance was installed."""
+    if _using_provided_certificates(config):
+        _handle_certificates(config, instances_dict)
+        return
+    if exists(join(CERTS_DIR, 'ca.key')):
+        missing = [instance for instance in _get_all_instances(instances_dict)
+                   if not (exists(instance.cert_path) and
+                           exists(instance.key_path))]
+    elif any_installed:
+        raise ClusterInstallError(
+            'The CA the certificates of the cluster were generated with '
+            'is not in {0}.'.format(CERTS_DIR))
+    else:
+        missing = _get_all_instances(instances_dict)
+    if missing:
+        _generate_certs(OrderedDict(
+            (instance_type, [instance for instance in instances_list
+                             if instance in missing])
+            for instance_type, instances_list in instances_dict.items()))
+    _copy_ca_files(config)
 
-    _verify_cloudify_installed(instances_dict, using_three_nodes_cluster)
-    _upgrade_cluster(instances_dict, verbose, upgrade_rpm_path,
-                     using_three_nodes_cluster)
-    _print_success_message(start_time, 'upgraded')
+
+def _prepare_desired_files(config, instances_dict, any_installed):
+    """Bring CLUSTER_INSTALL_DIR to the state the configuration describes,
+    keeping its certificates and credentials.
+
+    :return: Whether credentials were generated.
+    """
+    if not exists(CLUSTER_INSTALL_DIR):
+        os.makedirs(CLUSTER_INSTALL_DIR)
+    copy(config.get('cloudify_license_path'),
+         join(CLUSTER_INSTALL_DIR, 'license.yaml'))
+    if not exists(RPM_PATH):
+        _install_cloudify_locally(config.get('manager_rpm_path'))
+    credentials = None
+    generated = False
+    if not _using_provided_config_files(instances_dict):
+        _prepare_converge_certificates(config, instances_dict, any_installed)
+        credentials, generated = _get_converge_credentials(config,
+                                                           any_installed)
+    if not exists(CONFIG_FILES_DIR):
+        os.makedirs(CONFIG_FILES_DIR)
+    render_dir = tempfile.mkdtemp(prefix=DIR_NAME + '_converge_')
+    try:
+        config_files_dir = join(render_dir, CONFIG_FILES)
+        _prepare_config_files(instances_dict, credentials, config,
+                              config_files_dir)
+        for file_name in os.listdir(config_files_dir):
+            copy(join(config_files_dir, file_name), CONFIG_FILES_DIR)
+    finally:
+        shutil.rmtree(render_dir, ignore_errors=True)
+    return generated
+
+
+def _configure_instance(instance, verbose):
+    """Apply the instance's uploaded config file and certificates."""
+    logger.info('Configuring %s (%s)', instance.name, instance.private_ip)
+    _copy_config_file(instance)
+    _run_cfy_manager_configure(instance, verbose)
+    _record_applied_files(instance)
+
+
+def _run_converge_step(step, verbose, host_instances, rpm_package, states):
+    instance = step.instance
+    if step.step == UPLOAD:
+        logger.info('Uploading the files of %s', instance.private_ip)
+        with remote_stats.phase(UPLOAD), step_timings.step(instance, UPLOAD):
+            _upload_bundle(instance, host_instances, rpm_package)
+    elif step.step == CONFIGURE:
+        with remote_stats.phase(CONFIGURE), \
+                step_timings.step(instance, CONFIGURE):
+            _configure_instance(instance, verbose)
+    else:
+        if step.step == INSTALL and states[instance].failed_install:
+            _remove_failed_installation(instance, verbose, fast_reset=True)
+        _run_install_step(step, verbose, host_instances, rpm_package)
+
+
+def _warn_outdated_rpms(host_instances, states, rpm_package):
+    for host, instances in host_instances.items():
+        state = states[instances[0]]
+        if all(states[instance].installed for instance in instances) and \
+                not state.rpm_matches(rpm_package):
+            logger.warning('%s has %s installed rather than %s. Run '
+                           '`cfy_cluster_manager upgrade` in order to '
+                           'upgrade it', host, state.rpm, rpm_package)
+
+
+def converge(config_path, verbose, transport=None,
+             history_path=DEFAULT_HISTORY_PATH,
+             max_parallel=DEFAULT_MAX_PARALLEL, dry_run=False):
+    """Bring the cluster to the state its configuration file describes.
+
+    The state of all the instances is observed in parallel, and compared to
+    the certificates and config files rendered from the configuration.
+    Then only the steps the differences call for run, in the order of an
+    install: instances which aren't installed are installed, and installed
+    instances whose files changed are configured. Running `converge` again
+    does nothing once the cluster is converged, and resumes it otherwise.
+
+    :param dry_run: Only print the plan of the steps.
+    """
+    if not yum_is_present():
+        raise ClusterInstallError('Yum is not present.')
+
+    start_time = time.time()
+    logger.info('Converging the Cloudify cluster')
+    config_path = config_path or CLUSTER_INSTALL_CONFIG_PATH
+    config = get_dict_from_yaml(config_path)
+    if transport:
+        config['transport'] = transport
+    using_three_nodes_cluster = _using_three_nodes_cluster(config)
+    validate_config(config, using_three_nodes_cluster, override=False)
+    version = get_rpm_version(config.get('manager_rpm_path'))
+    step_timings.start('converge', version)
+    _set_host_upload_rates(config)
+    with remote_stats.phase('connect'):
+        instances_dict = (_generate_three_nodes_cluster_dict(config)
+                          if using_three_nodes_cluster else
+                          _generate_general_cluster_dict(config))
+
+    with remote_stats.phase('check'):
+        states = _observe_cluster(instances_dict, max_parallel)
+    generated_credentials = _prepare_desired_files(
+        config, instances_dict,
+        any(state.installed for state in states.values()))
+    rpm_package = _read_rpm_package(RPM_PATH)
+    for instance, state in states.items():
+        instance.rpm_up_to_date = state.rpm_matches(rpm_package)
+    host_instances = _get_host_instances(instances_dict)
+    digests = dict((instance, _get_node_digest(instance))
+                   for instance in states)
+    actions = get_actions(host_instances, states, digests, rpm_package)
+    _warn_outdated_rpms(host_instances, states, rpm_package)
+    logger.info('The state of the instances:\n%s', format_actions(
+        _get_all_instances(instances_dict), actions))
+    if not actions:
+        logger.info('The cluster is converged. Nothing to do.')
+        return
+    steps = build_converge_plan(instances_dict, actions)
+    history = TimingHistory(history_path)
+    if dry_run:
+        estimate_plan(steps, history, version)
+        logger.info(format_plan(steps, 'convergence', version,
+                                max_parallel))
+        return
+    for instance in set(states) - set(actions):
+        run_metrics.set_node_result(instance.name, True)
+    _run_plan(steps, lambda step: _run_converge_step(
+        step, verbose, host_instances[step.instance.private_ip],
+        rpm_package, states), history, version, max_parallel)
+    new_managers = [instance for instance in instances_dict['manager']
+                    if actions.get(instance, [None])[-1] == INSTALL]
+    if new_managers:
+        _log_managers_connection_strings(new_managers)
+    if generated_credentials:
+        _log_credentials_warning()
+    _print_success_message(start_time, 'converged')
+
+
+def fleet(config_paths, operation, verbose, fleet_dir=None,
+          max_clusters=DEFAULT_MAX_CLUSTERS,
+          max_parallel=DEFAULT_MAX_PARALLEL * DEFAULT_MAX_CLUSTERS,
+          max_upload_rate=None, max_host_upload_rate=None,
+          upgrade_rpm_path=DEFAULT_RPM, transport=None, timeout=None,
+          history_path=DEFAULT_HISTORY_PATH,
+          rpm_cache_dir=DEFAULT_RPM_CACHE_DIR,
+          run_cluster=run_cluster_process):
+    """Run an operation on the cluster of each configuration file, up to
+    `max_clusters` clusters at a time.
+
+    The parallel steps and the upload rate are limited for the whole fleet,
+    each running cluster getting an even share. Each cluster works in a
+    directory of its own in `fleet_dir`, and the report of all the clusters
+    is saved there as well.
+
+    :param run_cluster: A function running a cluster's command and
+                        returning its exit code.
+    """
+    start_time = time.time()
+    fleet_dir = abspath(fleet_dir or join(os.getcwd(), DEFAULT_FLEET_DIR))
+    missing = [config_path for config_path in config_paths
+               if not exists(expanduser(config_path))]
+    if missing:
+        raise ClusterInstallError('The configuration files {0} do not '
+                                  'exist'.format(', '.join(missing)))
+    logger.info('Running the %s of %d Cloudify clusters, %d at a time',
+                operation, len(config_paths), max_clusters)
+    clusters = get_clusters(config_paths, fleet_dir)
+    for cluster in clusters:
+        prepare_cluster(cluster, rpm_cache_dir)
+    if operation == 'upgrade':
+        upgrade_rpm_path = get_cached_rpm(upgrade_rpm_path, rpm_cache_dir)
+
+    running_clusters = min(max_clusters, len(clusters))
+    cluster_max_parallel = split_budget(max_parallel, running_clusters)
+    commands = dict(
+        (cluster, get_cluster_command(
+            cluster, operation, cluster_max_parallel, DEFAULT_MIN_PARALLEL,
+            history_path, split_budget(max_upload_rate, running_clusters),
+            max_host_upload_rate,
+            upgrade_rpm_path if operation == 'upgrade' else None,
+            transport, timeout, verbose))
+        for cluster in clusters)
+    run_fleet(clusters, commands, max_clusters, run_cluster)
+
+    logger.info(format_report(clusters, operation))
+    report_path = join(fleet_dir, FLEET_REPORT_NAME)
+    write_report(clusters, operation, report_path)
+    logger.info('The fleet report was saved to %s', report_path)
+    failed = [cluster.name for cluster in clusters if not cluster.succeeded]
+    if failed:
+        raise ClusterInstallError('The {0} of the clusters {1} failed'.format(
+            operation, ', '.join(failed)))
+    logger.info('The %s of all the clusters finished successfully in %s',
+                operation, format_duration(time.time() - start_time))
+
+
+def plan(config_path, operation='install', upgrade_rpm_path=DEFAULT_RPM,
+         history_path=DEFAULT_HISTORY_PATH,
+         max_parallel=DEFAULT_MAX_PARALLEL):
+    """Print the steps of an install, prepare or upgrade and their
+    estimated times.
+
+    The estimates are based on the timing history. Nothing is done on the
+    instances, and they are not connected to, so the plan assumes none of
+    them was installed yet.
+    """
+    config_path = config_path or CLUSTER_INSTALL_CONFIG_PATH
+    config = get_dict_from_yaml(config_path)
+    using_three_nodes_cluster = _using_three_nodes_cluster(config)
+    if operation in ('install', 'prepare'):
+        validate_config(config, using_three_nodes_cluster, override=False)
+    instances_dict = (
+        _generate_three_nodes_cluster_dict(config, validate_connection=False)
+        if using_three_nodes_cluster else
+        _generate_general_cluster_dict(config, validate_connection=False))
+    if operation in ('install', 'prepare'):
+        version = get_rpm_version(config.get('manager_rpm_path'))
+        steps = (build_install_plan(instances_dict) if operation == 'install'
+                 else build_prepare_plan(instances_dict))
+    else:
+        version = get_rpm_version(upgrade_rpm_path)
+        steps = build_upgrade_plan(
+            instances_dict, _get_upgrade_rpm_instances(instances_dict))
+    estimate_plan(steps, TimingHistory(history_path), version)
+    logger.info(format_plan(steps, operation, version, max_parallel))
+    return steps
+
+
+def status(config_path, transport=None, max_parallel=DEFAULT_MAX_PARALLEL):
+    """Log the state of the instances: whether they're installed, their
+    RPM, and whether they run with their files in CLUSTER_INSTALL_DIR.
+
+    Nothing is changed on the instances, and running installations aren't
+    waited for, so it takes two commands per host.
+    """
+    config_path = config_path or CLUSTER_INSTALL_CONFIG_PATH
+    config = get_dict_from_yaml(config_path)
+    if transport:
+        config['transport'] = transport
+    using_three_nodes_cluster = _using_three_nodes_cluster(config)
+    instances_dict = (
+        _generate_three_nodes_cluster_dict(config, validate_connection=False)
+        if using_three_nodes_cluster else
+        _generate_general_cluster_dict(config, validate_connection=False))
+    with remote_stats.phase('check'):
+        states = _observe_cluster(instances_dict, max_parallel,
+                                  check_units=False)
+    digests = dict(
+        (instance, _get_node_digest(instance)) for instance in states
+        if exists(join(CONFIG_FILES_DIR,
+                       '{0}_config.yaml'.format(instance.name))))
+    logger.info('The state of the instances:\n%s', format_status(
+        _get_all_instances(instances_dict), states, digests))
+
+
+def _reset_run_state():
+    """Start a run afresh in a process which ran others, i.e. the daemon."""
+    remote_stats.reset()
+    retry_budget.reset()
+    retry_stats.reset()
+    reset_circuit_breakers()
+    transfer_stats.reset()
+    concurrency_limiter.configure(DEFAULT_MIN_PARALLEL, DEFAULT_MAX_PARALLEL)
+    upload_throttle.configure()
+    run_deadline.start(None)
+
+
+def _run_argv(argv):
+    """Run a command in this process, for the daemon.
+
+    :return: The command's exit code.
+    """
+    parser = get_parser(RequestArgumentParser)
+    try:
+        args = parser.parse_args(argv)
+        if args.action not in SERVED_ACTIONS:
+            raise ClusterInstallError(
+                'The daemon serves only the {0} commands'.format(
+                    ', '.join(SERVED_ACTIONS)))
+        _reset_run_state()
+        run_args(parser, args)
+    except SystemExit as exc:
+        # The command's exit, which must not end the daemon's thread
+        if exc.code is None or isinstance(exc.code, int):
+            return exc.code or 0
+        logger.error(exc.code)
+        return 1
+    except Exception:
+        _exception_handler(*sys.exc_info())
+        return 1
+    return 0
+
+
+def serve(socket_path=None):
+    """Serve the commands of the clients in this working directory, until
+    interrupted.
+
+    The parsed configuration files and the transports of the hosts are
+    kept between the commands.
+    """
+    socket_path = socket_path or get_socket_path()
+    yaml_cache.enabled = True
+    transport_pool.enabled = True
+    daemon = ClusterManagerDaemon(socket_path, _run_argv)
+
+    def _stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, and the handler
+        # runs in the thread serving, so it's called from another one
+        threading.Thread(target=daemon.shutdown).start()
+
+    previous_handler = signal.signal(signal.SIGTERM, _stop)
+    logger.info('Serving the cluster manager commands of %s on %s',
+                os.getcwd(), socket_path)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        daemon.server_close()
+        transport_pool.close_all()
+        logger.info('The cluster manager daemon stopped')
+
+
+def attach(config_path, transport=None):
+    """Reattach to the `cfy_manager install` units running on the nodes.
+
+    The installations run as detached systemd units, so they survive a lost
+    SSH connection. This goes over all nodes, finds the in-flight units and
+    resumes monitoring them until they finish. The failed units are reported
+    together once the in-flight ones finished.
+    """
+    start_time = time.time()
+    logger.info('Attaching to in-flight Cloudify installations')
+    config_path = config_path or CLUSTER_INSTALL_CONFIG_PATH
+    config = get_dict_from_yaml(config_path)
+    if transport:
+        config['transport'] = transport
+    using_three_nodes_cluster = _using_three_nodes_cluster(config)
+    with remote_stats.phase('connect'):
+        instances_dict = (_generate_three_nodes_cluster_dict(config)
+                          if using_three_nodes_cluster else
+                          _generate_general_cluster_dict(config))
+
+    status_codes = OrderedDict(
+        (instance, _get_service_status_code(instance))
+        for instances_list in instances_dict.values()
+        for instance in instances_list)
+    errors = []
+    for instance, status_code in status_codes.items():
+        if status_code == 3:
+            errors.append('The installation of {0} failed. Last lines of '
+                          'its installation log:\n{1}'.format(
+                              instance.name, _get_unit_logs(instance)))
+            logger.error('The installation of %s (%s) failed',
+                         instance.name, instance.private_ip)
+        elif status_code not in (0, 4):
+            logger.warning('The status of %s on %s is unknown (exit code '
+                           '%d), not attaching to it', instance.unit_name,
+                           instance.name, status_code)
+
+    in_flight_instances = [instance for instance, status_code
+                           in status_codes.items() if status_code == 0]
+    if not in_flight_instances and not errors:
+        logger.info('No in-flight installations were found')
+        return
+
+    for instance in in_flight_instances:
+        logger.info('Attaching to the installation of %s (%s)',
+                    instance.name, instance.private_ip)
+        try:
+            _monitor_cloudify_installation(instance)
+        except ClusterInstallError as exc:
+            errors.append(str(exc))
+
+    if errors:
+        raise ClusterInstallError(
+            '{0}\nPlease run `cfy_cluster_manager install` in order to '
+            'continue the installation'.format('\n'.join(errors)))
+    running_time = time.time() - start_time
+    logger.info('The in-flight installations finished successfully after '
+                '%d seconds. Please run `cfy_cluster_manager install` in '
+                'order to continue with the rest of the cluster installation',
+                running_time)
+
+
+def add_metrics_args(parser):
+    parser.add_argument(
+        '--metrics-file',
+        action='store',
+        help='Write the run metrics to this file, in the OpenMetrics text '
+             'format (e.g. for the node_exporter textfile collector). The '
+             'file is updated periodically during the run, and at its end')
+
+    parser.add_argument(
+        '--metrics-interval',
+        action='store',
+        type=int,
+        default=METRICS_INTERVAL,
+        help='The interval, in seconds, of updating the metrics file during '
+             'the run. Default: {0}'.format(METRICS_INTERVAL))
+
+
+def add_profile_arg(parser):
+    parser.add_argument(
+        '--profile',
+        action='store',
+        metavar='PATH',
+        help='Profile the cluster manager itself, and save the profile to '
+             'this path as folded stacks (e.g. for flamegraph.pl or '
+             'speedscope). Each remote operation\'s wall and CPU time are '
+             'saved to PATH{0}'.format(SPANS_SUFFIX))
+
+
+def add_history_arg(parser):
+    parser.add_argument(
+        '--history-db',
+        action='store',
+        default=DEFAULT_HISTORY_PATH,
+        help='The SQLite database the duration of each step is recorded in, '
+             'and estimated from. Default: {0}'.format(DEFAULT_HISTORY_PATH))
+
+
+def _positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+    return value
+
+
+def add_max_parallel_arg(parser):
+    parser.add_argument(
+        '--max-parallel',
+        action='store',
+        type=_positive_int,
+        default=DEFAULT_MAX_PARALLEL,
+        help='The maximal number of steps (e.g. uploads or installations) '
+             'running on the instances at the same time, and the ceiling of '
+             'the adaptive limit on the remote operations running at the '
+             'same time. The steps most of the cluster waits on are started '
+             'first. Default: {0}'.format(DEFAULT_MAX_PARALLEL))
+
+
+def add_min_parallel_arg(parser):
+    parser.add_argument(
+        '--min-parallel',
+        action='store',
+        type=_positive_int,
+        default=DEFAULT_MIN_PARALLEL,
+        help='The floor of the adaptive limit on the remote operations '
+             'running at the same time. The limit starts there, grows while '
+             'the operations are fast, and shrinks when SSH connections fail '
+             'or the latency grows. Default: {0}'.format(DEFAULT_MIN_PARALLEL))
+
+
+def _rate(value):
+    try:
+        return parse_rate(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+
+
+def add_upload_rate_args(parser):
+    parser.add_argument(
+        '--max-upload-rate',
+        action='store',
+        type=_rate,
+        help='The maximal rate of all the uploads together, in bytes per '
+             'second, e.g. 500K or 10M. The parallel uploads share it. '
+             'Default: no limit')
+    parser.add_argument(
+        '--max-host-upload-rate',
+        action='store',
+        type=_rate,
+        help='The maximal rate of the uploads to each instance. An '
+             'instance\'s `max_upload_rate` in the configuration file '
+             'overrides it. Default: no limit')
 
 
 def add_verbose_arg(parser):
@@ -1072,9 +2847,30 @@ def add_config_arg(parser):
     )
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='Setting up a Cloudify cluster')
+def add_transport_arg(parser):
+    parser.add_argument(
+        '--transport',
+        action='store',
+        choices=TRANSPORTS,
+        help='The SSH implementation used to operate the instances. '
+             'asyncssh runs all remote operations on a single event loop, '
+             'and requires the asyncssh package. Default: the `transport` '
+             'value in the configuration file, or fabric'
+    )
+
+
+def add_timeout_arg(parser):
+    parser.add_argument(
+        '--timeout',
+        action='store',
+        type=int,
+        help='A deadline for the whole run, in seconds. Every remote command '
+             'is bounded by it. Default: no deadline'
+    )
+
+
+def get_parser(parser_class=argparse.ArgumentParser):
+    parser = parser_class(description='Setting up a Cloudify cluster')
 
     subparsers = parser.add_subparsers(help='Cloudify cluster manager action',
                                        dest='action')
@@ -1104,12 +2900,34 @@ def main():
         help='Using a nine nodes cluster. In case of using an external DB, '
              'Only 6 nodes will need to be provided')
 
+    generate_config_args.add_argument(
+        '--managers',
+        action='store',
+        type=_positive_int,
+        help='The number of managers. Used with `--brokers` and `--db` '
+             'instead of `--three-nodes` or `--nine-nodes`, e.g. '
+             '`--managers 5 --brokers 5 --db 3`')
+
+    generate_config_args.add_argument(
+        '--brokers',
+        action='store',
+        type=_positive_int,
+        help='The number of RabbitMQ nodes')
+
+    generate_config_args.add_argument(
+        '--db',
+        action='store',
+        type=_positive_int,
+        dest='db_nodes',
+        help='The number of PostgreSQL nodes, unless using an external DB')
+
     generate_config_args.add_argument(
         '--external-db',
         action='store_true',
         default=False,
         help='Using an external DB')
 
+    add_profile_arg(generate_config_args)
     add_verbose_arg(generate_config_args)
 
     install_args = subparsers.add_parser(
@@ -1127,6 +2945,15 @@ def main():
              'instances will be removed'
     )
 
+    install_args.add_argument(
+        '--fast-reset',
+        action='store_true',
+        default=False,
+        help='With --override, remove only the services and the state of '
+             'the previous installation. The installed RPM, and the '
+             'certificates and config files, are reused'
+    )
+
     install_args.add_argument(
         '--validate',
         action='store_true',
@@ -1134,14 +2961,51 @@ def main():
         help='Validate the provided configuration file'
     )
 
+    install_args.add_argument(
+        '--dry-run',
+        action='store_true',
+        default=False,
+        help='Only print the installation plan, with the estimated duration '
+             'of each step. Same as `plan`'
+    )
+
+    add_transport_arg(install_args)
+    add_timeout_arg(install_args)
+    add_metrics_args(install_args)
+    add_history_arg(install_args)
+    add_max_parallel_arg(install_args)
+    add_min_parallel_arg(install_args)
+    add_upload_rate_args(install_args)
+    add_profile_arg(install_args)
     add_verbose_arg(install_args)
 
+    prepare_args = subparsers.add_parser(
+        'prepare',
+        help='Stage the instances for a later install: upload the files, '
+             'install the RPM and copy the config files, without installing '
+             'Cloudify')
+
+    add_config_arg(prepare_args)
+    add_transport_arg(prepare_args)
+    add_timeout_arg(prepare_args)
+    add_metrics_args(prepare_args)
+    add_history_arg(prepare_args)
+    add_max_parallel_arg(prepare_args)
+    add_min_parallel_arg(prepare_args)
+    add_upload_rate_args(prepare_args)
+    add_profile_arg(prepare_args)
+    add_verbose_arg(prepare_args)
+
     remove_args = subparsers.add_parser(
         'remove',
         help='Remove a Cloudify cluster based on the specified '
              'configuration file')
 
     add_config_arg(remove_args)
+    add_transport_arg(remove_args)
+    add_timeout_arg(remove_args)
+    add_metrics_args(remove_args)
+    add_profile_arg(remove_args)
     add_verbose_arg(remove_args)
 
     upgrade_args = subparsers.add_parser(
@@ -1158,25 +3022,366 @@ def main():
              'Default: {0}'.format(DEFAULT_RPM)
     )
 
+    add_transport_arg(upgrade_args)
+    add_timeout_arg(upgrade_args)
+    add_metrics_args(upgrade_args)
+    add_history_arg(upgrade_args)
+    add_max_parallel_arg(upgrade_args)
+    add_min_parallel_arg(upgrade_args)
+    add_upload_rate_args(upgrade_args)
+    add_profile_arg(upgrade_args)
     add_verbose_arg(upgrade_args)
 
+    reconfigure_args = subparsers.add_parser(
+        'reconfigure',
+        help='Apply a changed configuration file to an installed cluster. '
+             'Only the nodes whose config file changed are reconfigured')
+
+    add_config_arg(reconfigure_args)
+    reconfigure_args.add_argument(
+        '--dry-run',
+        action='store_true',
+        default=False,
+        help='Only print the changes to the config files of the nodes'
+    )
+
+    reconfigure_args.add_argument(
+        '--all',
+        action='store_true',
+        default=False,
+        help='Reconfigure all the nodes, whether or not they changed. '
+             'Needed when the files some of the nodes run with are unknown, '
+             'since an older version installed them'
+    )
+
+    add_transport_arg(reconfigure_args)
+    add_timeout_arg(reconfigure_args)
+    add_metrics_args(reconfigure_args)
+    add_profile_arg(reconfigure_args)
+    add_verbose_arg(reconfigure_args)
+
+    add_node_args = subparsers.add_parser(
+        'add-node',
+        help='Install new nodes of the configuration file, and join them to '
+             'the installed cluster')
+
+    add_node_args.add_argument(
+        'nodes',
+        nargs='+',
+        metavar='NODE',
+        help='The existing_vms entries of the new nodes, named after their '
+             'node type, e.g. manager-4 or rabbitmq-4'
+    )
+
+    add_config_arg(add_node_args)
+    add_transport_arg(add_node_args)
+    add_timeout_arg(add_node_args)
+    add_metrics_args(add_node_args)
+    add_history_arg(add_node_args)
+    add_max_parallel_arg(add_node_args)
+    add_min_parallel_arg(add_node_args)
+    add_upload_rate_args(add_node_args)
+    add_profile_arg(add_node_args)
+    add_verbose_arg(add_node_args)
+
+    converge_args = subparsers.add_parser(
+        'converge',
+        help='Bring the cluster to the state of the configuration file. '
+             'Only the steps the nodes need run, so running it again does '
+             'nothing once the cluster is converged')
+
+    add_config_arg(converge_args)
+    converge_args.add_argument(
+        '--dry-run',
+        action='store_true',
+        default=False,
+        help='Only print the state of the nodes and the plan of the steps '
+             'they need'
+    )
+
+    add_transport_arg(converge_args)
+    add_timeout_arg(converge_args)
+    add_metrics_args(converge_args)
+    add_history_arg(converge_args)
+    add_max_parallel_arg(converge_args)
+    add_min_parallel_arg(converge_args)
+    add_upload_rate_args(converge_args)
+    add_profile_arg(converge_args)
+    add_verbose_arg(converge_args)
+
+    fleet_args = subparsers.add_parser(
+        'fleet',
+        help='Run an install, prepare, upgrade or converge on many clusters '
+             'at once, under a budget of parallel steps and upload bandwidth '
+             'shared by all of them')
+
+    fleet_args.add_argument(
+        'config_paths',
+        nargs='+',
+        metavar='CONFIG_PATH',
+        help='The configuration files of the clusters'
+    )
+    fleet_args.add_argument(
+        '--operation',
+        action='store',
+        choices=FLEET_OPERATIONS,
+        default='install',
+        help='The operation to run on each cluster. Default: install'
+    )
+    fleet_args.add_argument(
+        '--fleet-dir',
+        action='store',
+        help='The directory of the clusters\' work directories and of the '
+             'fleet report. Default: ./{0}'.format(DEFAULT_FLEET_DIR)
+    )
+    fleet_args.add_argument(
+        '--max-clusters',
+        action='store',
+        type=_positive_int,
+        default=DEFAULT_MAX_CLUSTERS,
+        help='The maximal number of clusters running at the same time. '
+             'Default: {0}'.format(DEFAULT_MAX_CLUSTERS)
+    )
+    fleet_args.add_argument(
+        '--max-parallel',
+        action='store',
+        type=_positive_int,
+        default=DEFAULT_MAX_PARALLEL * DEFAULT_MAX_CLUSTERS,
+        help='The maximal number of steps, and of remote operations, '
+             'running on all the clusters at the same time. Each running '
+             'cluster gets an even share. Default: {0}'.format(
+                 DEFAULT_MAX_PARALLEL * DEFAULT_MAX_CLUSTERS)
+    )
+    # The fleet's own process uploads nothing, so its upload rates have
+    # destinations of their own, which don't configure its upload throttle
+    fleet_args.add_argument(
+        '--max-upload-rate',
+        action='store',
+        type=_rate,
+        dest='fleet_upload_rate',
+        help='The maximal rate of the uploads of all the clusters together, '
+             'e.g. 10M. Each running cluster gets an even share. Default: '
+             'no limit'
+    )
+    fleet_args.add_argument(
+        '--max-host-upload-rate',
+        action='store',
+        type=_rate,
+        dest='cluster_host_upload_rate',
+        help='The maximal rate of the uploads to each instance. Default: no '
+             'limit'
+    )
+    fleet_args.add_argument(
+        '--upgrade-rpm',
+        action='store',
+        default=DEFAULT_RPM,
+        help='With `--operation upgrade`, the upgrade RPM, downloaded once '
+             'for all the clusters. Default: {0}'.format(DEFAULT_RPM)
+    )
+    fleet_args.add_argument(
+        '--rpm-cache-dir',
+        action='store',
+        default=DEFAULT_RPM_CACHE_DIR,
+        help='The directory the RPMs downloaded for the clusters are cached '
+             'in. Default: {0}'.format(DEFAULT_RPM_CACHE_DIR)
+    )
+    fleet_args.add_argument(
+        '--timeout',
+        action='store',
+        type=int,
+        dest='cluster_timeout',
+        help='A deadline for the run of each cluster, in seconds. Default: '
+             'no deadline'
+    )
+
+    add_transport_arg(fleet_args)
+    add_history_arg(fleet_args)
+    add_profile_arg(fleet_args)
+    add_verbose_arg(fleet_args)
+
+    status_args = subparsers.add_parser(
+        'status',
+        help='Show whether each node is installed, its RPM, and whether it '
+             'runs with the files prepared for it, without changing it')
+
+    add_config_arg(status_args)
+    add_transport_arg(status_args)
+    add_timeout_arg(status_args)
+    add_max_parallel_arg(status_args)
+    add_metrics_args(status_args)
+    add_profile_arg(status_args)
+    add_verbose_arg(status_args)
+
+    serve_args = subparsers.add_parser(
+        'serve',
+        help='Run a daemon serving the status, install and reconfigure '
+             'commands run in this directory, keeping the parsed '
+             'configuration files and the SSH connections between them')
+
+    serve_args.add_argument(
+        '--socket',
+        action='store',
+        help='The Unix socket to listen on. Clients find it in the '
+             '{0} environment variable. Default: ./{1}'.format(
+                 SOCKET_ENV, SOCKET_NAME)
+    )
+
+    add_profile_arg(serve_args)
+    add_verbose_arg(serve_args)
+
+    attach_args = subparsers.add_parser(
+        'attach',
+        help='Reattach to in-flight Cloudify installations on the cluster '
+             'nodes and wait for them to finish')
+
+    add_config_arg(attach_args)
+    add_transport_arg(attach_args)
+    add_timeout_arg(attach_args)
+    add_metrics_args(attach_args)
+    add_profile_arg(attach_args)
+    add_verbose_arg(attach_args)
+
+    plan_args = subparsers.add_parser(
+        'plan',
+        help='Print the steps of an install, prepare or upgrade, with '
+             'estimated durations based on the previous runs, the critical '
+             'path and the expected total time')
+
+    add_config_arg(plan_args)
+    plan_args.add_argument(
+        '--operation',
+        action='store',
+        choices=('install', 'prepare', 'upgrade'),
+        default='install',
+        help='The operation to plan. Default: install'
+    )
+    plan_args.add_argument(
+        '--upgrade-rpm',
+        action='store',
+        default=DEFAULT_RPM,
+        help='The upgrade RPM, whose version the upgrade estimates are '
+             'based on. Default: {0}'.format(DEFAULT_RPM)
+    )
+
+    add_history_arg(plan_args)
+    add_max_parallel_arg(plan_args)
+    add_profile_arg(plan_args)
+    add_verbose_arg(plan_args)
+
+    return parser
+
+
+def main():
+    parser = get_parser()
     args = parser.parse_args()
 
     if hasattr(args, 'verbose'):
         setup_logger(args.verbose)
 
+    run_args(parser, args)
+
+
+def run_args(parser, args):
+    """Run the parsed command, with the run wide settings it sets."""
+    if hasattr(args, 'min_parallel'):
+        if args.min_parallel > args.max_parallel:
+            parser.error('--min-parallel must not be greater than '
+                         '--max-parallel')
+        concurrency_limiter.configure(args.min_parallel, args.max_parallel)
+
+    if getattr(args, 'fast_reset', False) and not args.override:
+        parser.error('--fast-reset requires --override')
+
+    if hasattr(args, 'max_upload_rate'):
+        upload_throttle.configure(args.max_upload_rate,
+                                  args.max_host_upload_rate)
+
+    if getattr(args, 'timeout', None):
+        run_deadline.start(args.timeout)
+
+    metrics_writer = None
+    if getattr(args, 'metrics_file', None):
+        metrics_writer = MetricsFileWriter(args.metrics_file,
+                                           args.metrics_interval)
+    run_metrics.start(args.action)
+    if metrics_writer:
+        metrics_writer.start()
+    if getattr(args, 'profile', None):
+        start_profiling()
+    try:
+        _run_action(args)
+    except BaseException:
+        run_metrics.finish(success=False)
+        raise
+    else:
+        run_metrics.finish(success=True)
+    finally:
+        if getattr(args, 'profile', None):
+            stop_profiling(args.profile)
+        if getattr(args, 'history_db', None):
+            save_step_timings(args.history_db)
+        if metrics_writer:
+            metrics_writer.stop()
+
+
+def _run_action(args):
     if args.action == 'generate-config':
         generate_config(args.output, args.three_nodes, args.nine_nodes,
-                        args.external_db)
+                        args.external_db, args.managers, args.brokers,
+                        args.db_nodes)
 
     elif args.action == 'install':
-        install(args.config_path, args.override, args.validate, args.verbose)
+        if args.dry_run:
+            plan(args.config_path, 'install',
+                 history_path=args.history_db,
+                 max_parallel=args.max_parallel)
+        else:
+            install(args.config_path, args.override, args.validate,
+                    args.verbose, args.transport, args.history_db,
+                    args.max_parallel, args.fast_reset)
+
+    elif args.action == 'prepare':
+        prepare(args.config_path, args.verbose, args.transport,
+                args.history_db, args.max_parallel)
 
     elif args.action == 'remove':
-        remove(args.config_path, args.verbose)
+        remove(args.config_path, args.verbose, args.transport)
 
     elif args.action == 'upgrade':
-        upgrade(args.config_path, args.verbose, args.upgrade_rpm)
+        upgrade(args.config_path, args.verbose, args.upgrade_rpm,
+                args.transport, args.history_db, args.max_parallel)
+
+    elif args.action == 'reconfigure':
+        reconfigure(args.config_path, args.verbose, args.transport,
+                    args.dry_run, args.all)
+
+    elif args.action == 'add-node':
+        add_node(args.config_path, args.nodes, args.verbose, args.transport,
+                 args.history_db, args.max_parallel)
+
+    elif args.action == 'converge':
+        converge(args.config_path, args.verbose, args.transport,
+                 args.history_db, args.max_parallel, args.dry_run)
+
+    elif args.action == 'fleet':
+        fleet(args.config_paths, args.operation, args.verbose,
+              args.fleet_dir, args.max_clusters, args.max_parallel,
+              args.fleet_upload_rate, args.cluster_host_upload_rate,
+              args.upgrade_rpm, args.transport, args.cluster_timeout,
+              args.history_db, args.rpm_cache_dir)
+
+    elif args.action == 'status':
+        status(args.config_path, args.transport, args.max_parallel)
+
+    elif args.action == 'serve':
+        serve(args.socket)
+
+    elif args.action == 'attach':
+        attach(args.config_path, args.transport)
+
+    elif args.action == 'plan':
+        plan(args.config_path, args.operation, args.upgrade_rpm,
+             args.history_db, args.max_parallel)
 
     else:
         raise RuntimeError('Invalid action specified in parser.')
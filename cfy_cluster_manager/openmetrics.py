@@ -0,0 +1,180 @@
+"""Export the run's metrics to an OpenMetrics textfile.
+
+The file is meant for node_exporter's textfile collector, so automation
+running the cluster manager gets its metrics on the dashboards without
+running any service. It's written atomically, periodically during the run
+and once more when the run ends.
+"""
+import os
+import re
+import time
+import threading
+from collections import Counter, OrderedDict
+from os.path import dirname, exists
+
+from .remote_stats import remote_stats
+from .retry import retry_stats
+
+METRICS_INTERVAL = 30
+PREFIX = 'cfy_cluster_manager_'
+SAMPLE_PATTERN = re.compile(r'^(\w+)\{(.*)\} (\S+)$')
+LABEL_PATTERN = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+class RunMetrics(object):
+    """The run's outcome: the operation, its timing and each node's result.
+    """
+    def __init__(self):
+        self.operation = None
+        self.start_time = None
+        self.end_time = None
+        self.success = None
+        self.node_results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, operation):
+        self.operation = operation
+        self.start_time = time.time()
+        self.end_time = self.success = None
+        with self._lock:
+            self.node_results.clear()
+
+    def finish(self, success):
+        self.end_time = time.time()
+        self.success = success
+
+    def set_node_result(self, node, success):
+        with self._lock:
+            self.node_results[node] = success
+
+    @property
+    def duration(self):
+        if self.start_time is None:
+            return 0
+        return (self.end_time or time.time()) - self.start_time
+
+
+run_metrics = RunMetrics()
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def _unescape(value):
+    return re.sub(r'\\(.)', lambda match: '\n' if match.group(1) == 'n'
+                  else match.group(1), value)
+
+
+def _metric(lines, name, help_text, samples):
+    """Add a gauge and its samples, given as (labels dict, value) pairs."""
+    name = PREFIX + name
+    lines.append('# HELP {0} {1}'.format(name, help_text))
+    lines.append('# TYPE {0} gauge'.format(name))
+    for labels, value in samples:
+        labels_str = ','.join('{0}="{1}"'.format(key, _escape(labels[key]))
+                              for key in sorted(labels))
+        lines.append('{0}{{{1}}} {2}'.format(name, labels_str, value))
+
+
+def format_metrics(metrics=run_metrics, stats=remote_stats,
+                   retries=retry_stats):
+    """Format the run's metrics in the OpenMetrics text format."""
+    operation = {'operation': metrics.operation or ''}
+    lines = []
+    _metric(lines, 'run_start_time_seconds',
+            'When the run started, as a Unix timestamp',
+            [(operation, metrics.start_time or 0)])
+    _metric(lines, 'run_duration_seconds',
+            'How long the run took, or has been running for',
+            [(operation, round(metrics.duration, 3))])
+    _metric(lines, 'run_in_progress', 'Whether the run is still running',
+            [(operation, int(metrics.success is None))])
+    if metrics.success is not None:
+        _metric(lines, 'run_success', 'Whether the run succeeded',
+                [(operation, int(metrics.success))])
+    with metrics._lock:
+        node_results = list(metrics.node_results.items())
+    if node_results:
+        _metric(lines, 'node_success',
+                'Whether the operation succeeded on the node',
+                [(dict(operation, node=node), int(success))
+                 for node, success in node_results])
+
+    with stats._lock:
+        records = list(stats.records.items())
+    for counter, name, help_text in (
+            ('wait_time', 'remote_wait_seconds',
+             'Time spent waiting on remote operations'),
+            ('connections', 'ssh_connections', 'SSH connections opened'),
+            ('commands', 'remote_commands', 'Remote commands run'),
+            ('files', 'uploaded_files', 'Files uploaded'),
+            ('bytes', 'uploaded_bytes', 'Bytes uploaded')):
+        _metric(lines, name, help_text + ', per host and phase',
+                [(dict(operation, host=host, phase=phase),
+                  round(counters[counter], 3))
+                 for (host, phase), counters in records])
+
+    host_retries = Counter()
+    for (_, host), (count, _) in list(retries.records.items()):
+        host_retries[host or 'local'] += count
+    _metric(lines, 'retries', 'Operations retried, per host',
+            [(dict(operation, host=host), count)
+             for host, count in sorted(host_retries.items())])
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def parse_metrics(text):
+    """Parse the samples of a metrics file written by format_metrics.
+
+    :return: The samples of each metric, without the prefix, as (labels
+             dict, value) pairs.
+    """
+    samples = {}
+    for line in text.splitlines():
+        match = SAMPLE_PATTERN.match(line)
+        if not match or not match.group(1).startswith(PREFIX):
+            continue
+        labels = dict((key, _unescape(value)) for key, value in
+                      LABEL_PATTERN.findall(match.group(2)))
+        samples.setdefault(match.group(1)[len(PREFIX):], []).append(
+            (labels, float(match.group(3))))
+    return samples
+
+
+def write_metrics_file(path):
+    """Write the metrics atomically, so a scrape never sees a partial file.
+    """
+    directory = dirname(path)
+    if directory and not exists(directory):
+        os.makedirs(directory)
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as metrics_file:
+        metrics_file.write(format_metrics())
+    os.rename(tmp_path, path)
+
+
+class MetricsFileWriter(object):
+    """Write the metrics file every `interval` seconds in the background,
+    and once more when stopped."""
+    def __init__(self, path, interval=METRICS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            write_metrics_file(self.path)
+
+    def start(self):
+        write_metrics_file(self.path)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        write_metrics_file(self.path)
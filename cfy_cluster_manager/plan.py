@@ -0,0 +1,315 @@
+"""The steps of an install or upgrade, their dependencies and their timing.
+
+A plan is a list of PlanSteps in a topological order: every step comes
+after the steps it depends on. Each node is uploaded to, has its RPM
+installed and then runs `cfy_manager`. The steps of a host run one at a
+time, a tier (DB, queue, managers) runs `cfy_manager` only after the tier
+before it finished, and the nodes of a tier run it one at a time: the
+first one forms the tier's cluster and the others join it, and Patroni and
+RabbitMQ nodes joining their cluster at the same time isn't known to be
+safe. So only the uploads and the RPM installations of a tier run in
+parallel. Preparing a cluster stages the nodes the same way, but copies
+their config files rather than running `cfy_manager`, so no node waits on
+another host. Converging a cluster runs only the steps its nodes need, in
+the same order, except that the installed nodes of a tier, which don't
+join it, are configured in parallel once its first node ran.
+
+When fewer steps than are ready may run at once, the ready step with the
+longest remaining critical path starts first, so the steps the rest of the
+cluster waits on are never left behind.
+"""
+import heapq
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .concurrency import DEFAULT_MAX_PARALLEL
+from .timing_history import UNKNOWN_VERSION
+
+INSTALL_STEPS = ('upload', 'rpm install', 'cfy_manager install')
+PREPARE_STEPS = ('upload', 'rpm install', 'config copy')
+
+
+class PlanStep(object):
+    def __init__(self, instance, step, dependencies=()):
+        self.instance = instance
+        self.step = step
+        self.dependencies = [dependency for dependency in dependencies
+                             if dependency is not None]
+        self.duration = 0
+        self.source = None
+        self.priority = 0
+        self.start = None
+        self.finish = None
+
+    @property
+    def name(self):
+        return '{0} {1}'.format(self.instance.name, self.step)
+
+    def __repr__(self):
+        return 'PlanStep({0})'.format(self.name)
+
+
+def _tier_dependencies(previous_tier, tier):
+    """The steps a node's `cfy_manager` step waits for: the previous tier,
+    and the node of its tier before it."""
+    return previous_tier + tier[-1:]
+
+
+def build_install_plan(instances_dict):
+    steps = []
+    last_host_steps = {}
+    previous_tier = []
+    for instances_list in instances_dict.values():
+        tier = []
+        for instance in instances_list:
+            upload = PlanStep(instance, 'upload',
+                              [last_host_steps.get(instance.private_ip)])
+            rpm_install = PlanStep(instance, 'rpm install', [upload])
+            cfy_install = PlanStep(
+                instance, 'cfy_manager install',
+                [rpm_install] + _tier_dependencies(previous_tier, tier))
+            steps.extend((upload, rpm_install, cfy_install))
+            tier.append(cfy_install)
+            last_host_steps[instance.private_ip] = cfy_install
+        previous_tier = tier or previous_tier
+    return steps
+
+
+def build_prepare_plan(instances_dict):
+    steps = []
+    last_host_steps = {}
+    for instances_list in instances_dict.values():
+        for instance in instances_list:
+            dependency = last_host_steps.get(instance.private_ip)
+            for step_name in PREPARE_STEPS:
+                dependency = PlanStep(instance, step_name, [dependency])
+                steps.append(dependency)
+            last_host_steps[instance.private_ip] = dependency
+    return steps
+
+
+def build_converge_plan(instances_dict, actions):
+    """The plan of the steps in `actions`, the steps of each instance."""
+    steps = []
+    last_host_steps = {}
+    previous_tier = []
+    for instances_list in instances_dict.values():
+        tier = []
+        joins = []
+        for instance in instances_list:
+            if instance not in actions:
+                continue
+            # The last step of an instance is its `cfy_manager` step
+            for step_name in actions[instance][:-1]:
+                step = PlanStep(instance, step_name,
+                                [last_host_steps.get(instance.private_ip)])
+                steps.append(step)
+                last_host_steps[instance.private_ip] = step
+            joining = actions[instance][-1] == 'cfy_manager install'
+            cfy_manager = PlanStep(
+                instance, actions[instance][-1],
+                [last_host_steps.get(instance.private_ip)] +
+                (_tier_dependencies(previous_tier, joins or tier[:1])
+                 if joining else previous_tier + tier[:1]))
+            steps.append(cfy_manager)
+            tier.append(cfy_manager)
+            if joining:
+                joins.append(cfy_manager)
+            last_host_steps[instance.private_ip] = cfy_manager
+        previous_tier = tier or previous_tier
+    return steps
+
+
+def build_upgrade_plan(instances_dict, rpm_instances):
+    """The upgrade: the RPM is first upgraded on `rpm_instances`, and then
+    `cfy_manager upgrade` runs on all the nodes."""
+    steps = []
+    last_host_steps = {}
+    for instance in rpm_instances:
+        rpm_upgrade = PlanStep(instance, 'rpm upgrade',
+                               [last_host_steps.get(instance.private_ip)])
+        steps.append(rpm_upgrade)
+        last_host_steps[instance.private_ip] = rpm_upgrade
+    previous_tier = []
+    for instances_list in instances_dict.values():
+        tier = []
+        for instance in instances_list:
+            cfy_upgrade = PlanStep(
+                instance, 'cfy_manager upgrade',
+                [last_host_steps.get(instance.private_ip)] +
+                _tier_dependencies(previous_tier, tier))
+            steps.append(cfy_upgrade)
+            tier.append(cfy_upgrade)
+            last_host_steps[instance.private_ip] = cfy_upgrade
+        previous_tier = tier or previous_tier
+    return steps
+
+
+def estimate_plan(steps, history, version=UNKNOWN_VERSION):
+    for step in steps:
+        step.duration, step.source = history.estimate(
+            step.instance.type, step.step, version, step.instance.private_ip)
+
+
+def _get_dependents(steps):
+    dependents = dict((step, []) for step in steps)
+    for step in steps:
+        for dependency in step.dependencies:
+            dependents[dependency].append(step)
+    return dependents
+
+
+def set_priorities(steps):
+    """Set each step's priority to its remaining critical path: its own
+    duration and the longest chain of steps waiting on it."""
+    dependents = _get_dependents(steps)
+    for step in reversed(steps):
+        step.priority = step.duration + max(
+            [dependent.priority for dependent in dependents[step]] or [0])
+
+
+class _ReadySteps(object):
+    """The steps whose dependencies finished, by priority and then by their
+    order in the plan."""
+    def __init__(self, steps):
+        self._order = dict((step, i) for i, step in enumerate(steps))
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, step):
+        heapq.heappush(self._heap,
+                       (-step.priority, self._order[step], step))
+
+    def pop(self):
+        return heapq.heappop(self._heap)[-1]
+
+
+def schedule_plan(steps, max_parallel=None):
+    """Set each step's start and finish, starting steps as soon as their
+    dependencies finished, and at most `max_parallel` at a time.
+
+    :return: The total time.
+    """
+    if not max_parallel:
+        for step in steps:
+            step.start = max([dependency.finish for dependency in
+                              step.dependencies] or [0])
+            step.finish = step.start + step.duration
+        return max([step.finish for step in steps] or [0])
+
+    set_priorities(steps)
+    dependents = _get_dependents(steps)
+    waiting_on = dict((step, len(step.dependencies)) for step in steps)
+    ready = _ReadySteps(steps)
+    for step in steps:
+        if not step.dependencies:
+            ready.push(step)
+    running = []
+    current_time = 0
+    while ready or running:
+        while ready and len(running) < max_parallel:
+            step = ready.pop()
+            step.start = current_time
+            step.finish = current_time + step.duration
+            running.append(step)
+        current_time = min(step.finish for step in running)
+        for step in [step for step in running
+                     if step.finish <= current_time]:
+            running.remove(step)
+            for dependent in dependents[step]:
+                waiting_on[dependent] -= 1
+                if not waiting_on[dependent]:
+                    ready.push(dependent)
+    return current_time
+
+
+def run_plan(steps, run_step, max_parallel=DEFAULT_MAX_PARALLEL, done=()):
+    """Run the plan's steps, at most `max_parallel` at a time.
+
+    Once a step fails, no more steps are started, and the failure is raised
+    after the running steps finished.
+
+    :param run_step: A function running a PlanStep.
+    :param done: Steps which don't need to run, e.g. of installed nodes.
+    """
+    set_priorities(steps)
+    dependents = _get_dependents(steps)
+    done = set(done)
+    waiting_on = dict((step, len(set(step.dependencies) - done))
+                      for step in steps)
+    ready = _ReadySteps(steps)
+    for step in steps:
+        if step not in done and not waiting_on[step]:
+            ready.push(step)
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        while ready or running:
+            while ready and len(running) < max_parallel and not error:
+                step = ready.pop()
+                running[executor.submit(run_step, step)] = step
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                for dependent in dependents[step]:
+                    waiting_on[dependent] -= 1
+                    if not waiting_on[dependent] and dependent not in done:
+                        ready.push(dependent)
+    if error:
+        raise error
+
+
+def critical_path(steps):
+    """The chain of steps which determines the total time."""
+    if not steps:
+        return []
+    step = max(steps, key=lambda plan_step: plan_step.finish)
+    path = [step]
+    while step.dependencies:
+        step = max(step.dependencies,
+                   key=lambda dependency: dependency.finish)
+        path.append(step)
+    return path[::-1]
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+    return '{0}:{1:02d}'.format(minutes, seconds)
+
+
+def format_plan(steps, operation, version=UNKNOWN_VERSION,
+                max_parallel=DEFAULT_MAX_PARALLEL):
+    unlimited_time = schedule_plan(steps)
+    path = critical_path(steps)
+    total_time = schedule_plan(steps, max_parallel)
+    rows = [('node', 'host', 'step', 'start', 'duration', 'estimate')]
+    for step in sorted(steps, key=lambda plan_step: plan_step.start):
+        rows.append((step.instance.name, step.instance.private_ip,
+                     step.step, format_duration(step.start),
+                     format_duration(step.duration),
+                     step.source if step.source == 'default'
+                     else '{0} history'.format(step.source)))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = ['Execution plan of the {0} of Cloudify {1}:'.format(
+        operation, version)]
+    lines.extend('  '.join(value.ljust(width)
+                           for value, width in zip(row, widths)).rstrip()
+                 for row in rows)
+    lines.append('Critical path: {0}'.format(
+        ' -> '.join(step.name for step in path)))
+    lines.append(
+        'Expected total time: {0} running up to {1} steps in parallel '
+        '({2} with no limit, {3} running the steps one at a time)'.format(
+            format_duration(total_time), max_parallel,
+            format_duration(unlimited_time),
+            format_duration(sum(step.duration for step in steps))))
+    return '\n'.join(lines)
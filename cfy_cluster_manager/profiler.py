@@ -0,0 +1,177 @@
+"""A sampling profiler telling the orchestrator's own work from remote waits.
+
+The profiler samples the stacks of all the threads at a fixed interval and
+writes them in the folded format flamegraph tools read (e.g.
+`flamegraph.pl profile.folded > profile.svg`, or speedscope). Samples
+taken while a thread is inside a remote operation get a `remote: ...`
+frame at their root, and each remote operation is also recorded as a span
+with its wall and CPU time.
+"""
+import sys
+import json
+import time
+import threading
+from os.path import basename
+from collections import Counter
+from contextlib import contextmanager, ExitStack
+
+from .logger import get_cfy_cluster_manager_logger
+
+logger = get_cfy_cluster_manager_logger()
+
+SAMPLE_INTERVAL = 0.005
+SPANS_SUFFIX = '.spans.json'
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{0} ({1}:{2})'.format(code.co_name, basename(code.co_filename),
+                                  code.co_firstlineno)
+
+
+def _clean(name):
+    # `;` separates the frames and the last space the count
+    return name.replace(';', ':').replace('\n', ' ')
+
+
+class Span(object):
+    """A remote operation, and the time it took.
+
+    The CPU time is the whole process' CPU time during the operation, since
+    SSH clients do their work on threads of their own.
+    """
+    def __init__(self, host, operation, start_time, wall_time, cpu_time):
+        self.host = host
+        self.operation = operation
+        self.start_time = start_time
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+
+    def to_dict(self):
+        return {'host': self.host,
+                'operation': self.operation,
+                'start_time': round(self.start_time, 6),
+                'wall_time': round(self.wall_time, 6),
+                'cpu_time': round(self.cpu_time, 6)}
+
+
+class SamplingProfiler(object):
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+        self.spans = []
+        self.wall_time = self.cpu_time = 0
+        self._active_spans = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='cfy-cluster-manager-profiler')
+        self._thread.daemon = True
+
+    def start(self):
+        self._start_time = time.time()
+        self._start_cpu_time = time.process_time()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.wall_time = time.time() - self._start_time
+        self.cpu_time = time.process_time() - self._start_cpu_time
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        own_thread = threading.current_thread().ident
+        thread_names = dict((thread.ident, thread.name)
+                            for thread in threading.enumerate())
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_clean(_frame_name(frame)))
+                frame = frame.f_back
+            root = [_clean(thread_names.get(thread_id, 'thread'))]
+            span = self._active_spans.get(thread_id)
+            if span:
+                root.append(_clean('remote: ' + span))
+            stack.extend(reversed(root))
+            with self._lock:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    @contextmanager
+    def span(self, host, operation):
+        thread_id = threading.current_thread().ident
+        outer_span = self._active_spans.get(thread_id)
+        self._active_spans[thread_id] = '{0} {1}'.format(host, operation)
+        start_time = time.time()
+        start_cpu_time = time.process_time()
+        try:
+            yield
+        finally:
+            if outer_span:
+                self._active_spans[thread_id] = outer_span
+            else:
+                del self._active_spans[thread_id]
+            span = Span(host, operation, start_time,
+                        time.time() - start_time,
+                        time.process_time() - start_cpu_time)
+            with self._lock:
+                self.spans.append(span)
+
+    def write_folded(self, path):
+        with self._lock, open(path, 'w') as folded_file:
+            for stack, count in sorted(self.samples.items()):
+                folded_file.write('{0} {1}\n'.format(stack, count))
+
+    def write_spans(self, path):
+        with self._lock, open(path, 'w') as spans_file:
+            json.dump([span.to_dict() for span in self.spans], spans_file,
+                      indent=2)
+
+    def log_report(self):
+        with self._lock:
+            remote_wall_time = sum(span.wall_time for span in self.spans)
+            remote_cpu_time = sum(span.cpu_time for span in self.spans)
+            spans_count = len(self.spans)
+        logger.info(
+            'Profile: %.1f seconds of wall time, %.1f seconds of CPU time. '
+            '%d remote operations took %.1f seconds of wall time and %.1f '
+            'seconds of CPU time, so %.1f seconds of CPU time were spent '
+            'outside of them', self.wall_time, self.cpu_time, spans_count,
+            remote_wall_time, remote_cpu_time,
+            self.cpu_time - remote_cpu_time)
+
+
+# The running profilers, e.g. a daemon's and the one of a command it serves
+_profilers = []
+
+
+def start_profiling(interval=SAMPLE_INTERVAL):
+    profiler = SamplingProfiler(interval)
+    profiler.start()
+    _profilers.append(profiler)
+
+
+def stop_profiling(path):
+    """Stop the last started profiler and write the folded stacks to `path`
+    and the remote operations' spans next to it."""
+    profiler = _profilers.pop()
+    profiler.stop()
+    profiler.write_folded(path)
+    profiler.write_spans(path + SPANS_SUFFIX)
+    profiler.log_report()
+    logger.info('The profile was saved to %s and the remote operations to '
+                '%s', path, path + SPANS_SUFFIX)
+
+
+@contextmanager
+def remote_span(host, operation):
+    """Mark a remote operation for the running profilers, if any."""
+    with ExitStack() as spans:
+        for profiler in list(_profilers):
+            spans.enter_context(profiler.span(host, operation))
+        yield
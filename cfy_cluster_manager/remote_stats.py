@@ -0,0 +1,90 @@
+import threading
+from contextlib import contextmanager
+from collections import Counter, OrderedDict
+
+from .logger import get_cfy_cluster_manager_logger
+
+logger = get_cfy_cluster_manager_logger()
+
+DEFAULT_PHASE = 'other'
+COUNTERS = ('connections', 'commands', 'sudo_commands', 'files', 'bytes',
+            'wait_time')
+COLUMN_TITLES = ('connections', 'commands', 'sudo', 'files', 'bytes',
+                 'wait (s)')
+
+
+class RemoteStats(object):
+    """The cost of the remote operations in this run, per node and phase.
+
+    `VM` records every remote operation under the current phase, which the
+    orchestration sets using `phase`. This tells whether a slow run waited
+    on the network, on sshd, or on the remote commands themselves. The phase
+    is per thread, since the nodes' steps run in parallel.
+    """
+    def __init__(self):
+        self.records = OrderedDict()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def current_phase(self):
+        return getattr(self._local, 'phase', DEFAULT_PHASE)
+
+    @current_phase.setter
+    def current_phase(self, phase):
+        self._local.phase = phase
+
+    def record(self, node, **counters):
+        key = (node, self.current_phase)
+        with self._lock:
+            self.records.setdefault(key, Counter()).update(counters)
+
+    @contextmanager
+    def phase(self, name):
+        previous_phase, self.current_phase = self.current_phase, name
+        try:
+            yield
+        finally:
+            self.current_phase = previous_phase
+
+    def totals(self):
+        totals = Counter()
+        with self._lock:
+            for counters in self.records.values():
+                totals.update(counters)
+        return totals
+
+    def reset(self):
+        with self._lock:
+            self.records.clear()
+        self.current_phase = DEFAULT_PHASE
+
+    def format_table(self):
+        rows = [('node', 'phase') + COLUMN_TITLES]
+        with self._lock:
+            # Each node's phases are kept in the order they ran
+            records = sorted(self.records.items(),
+                             key=lambda item: item[0][0])
+        for (node, phase), counters in records:
+            rows.append((node, phase) + _format_counters(counters))
+        rows.append(('total', '') + _format_counters(self.totals()))
+        widths = [max(len(row[i]) for row in rows)
+                  for i in range(len(rows[0]))]
+        return '\n'.join(
+            '  '.join(value.ljust(width) if i < 2 else value.rjust(width)
+                      for i, (value, width) in enumerate(zip(row, widths)))
+            for row in rows)
+
+    def log_report(self):
+        if not self.records:
+            return
+        logger.info('Remote operations:\n%s', self.format_table())
+
+
+def _format_counters(counters):
+    return tuple(
+        '{0:.1f}'.format(counters[counter]) if counter == 'wait_time'
+        else str(counters[counter]) for counter in COUNTERS)
+
+
+remote_stats = RemoteStats()
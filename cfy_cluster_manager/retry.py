@@ -0,0 +1,204 @@
+import time
+import random
+import threading
+from collections import OrderedDict
+
+from .exceptions import CircuitOpenError
+from .logger import get_cfy_cluster_manager_logger
+
+logger = get_cfy_cluster_manager_logger()
+
+RETRY_BUDGET = 100
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
+
+
+class RetryPolicy(object):
+    """How many times an operation is attempted, and how long to back off.
+
+    The delay before retry number `n` grows exponentially from `base_delay`
+    up to `max_delay`. With jitter, a random half of it is dropped so
+    parallel callers that failed together don't retry together.
+    """
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=30.0,
+                 jitter=True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def get_delay(self, retry_number):
+        delay = min(self.max_delay,
+                    self.base_delay * (2 ** (retry_number - 1)))
+        if self.jitter:
+            delay = delay / 2 + random.uniform(0, delay / 2)
+        return delay
+
+
+NO_RETRIES = RetryPolicy(max_attempts=1)
+REMOTE_RETRY_POLICY = RetryPolicy(max_attempts=4, base_delay=2, max_delay=30)
+LOCAL_RETRY_DELAY = 1
+
+
+class RetryBudget(object):
+    """A cap on the number of retries in a whole run.
+
+    This keeps a systemic failure (e.g. the network is down) from turning
+    into a retry storm across all operations.
+    """
+    def __init__(self, max_retries=RETRY_BUDGET):
+        self.max_retries = max_retries
+        self.remaining = max_retries
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Refill the budget, for a new run."""
+        with self._lock:
+            self.remaining = self.max_retries
+
+    def consume(self):
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+class CircuitBreaker(object):
+    """Fail fast on a host after too many consecutive connection failures.
+
+    Once `failure_threshold` consecutive failures are recorded the circuit
+    opens, and calls fail immediately for `reset_timeout` seconds. After that
+    a single trial call is let through, and the other calls keep failing
+    until it ends: its success closes the circuit and its failure opens it
+    again.
+    """
+    def __init__(self, host,
+                 failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.half_open_trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.half_open_trial_in_flight:
+                raise CircuitOpenError(
+                    'Too many consecutive connection failures to {0}, not '
+                    'trying to connect to it until a trial connection '
+                    'ends'.format(self.host))
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(
+                    'Too many consecutive connection failures to {0}, not '
+                    'trying to connect to it for {1} seconds'.format(
+                        self.host, self.reset_timeout))
+            # Half open: let this call through as a trial.
+            self.half_open_trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.half_open_trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.half_open_trial_in_flight = False
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning('Opening the circuit breaker of %s',
+                                   self.host)
+                self.opened_at = time.time()
+
+
+class RetryStats(object):
+    """The retries made in this run, for the run report."""
+    def __init__(self):
+        self.records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record_retry(self, operation, host, delay):
+        key = (operation, host)
+        with self._lock:
+            retries, total_delay = self.records.get(key, (0, 0))
+            self.records[key] = (retries + 1, total_delay + delay)
+
+    def total_retries(self):
+        return sum(retries for retries, _ in self.records.values())
+
+    def reset(self):
+        with self._lock:
+            self.records.clear()
+
+    def log_report(self):
+        if not self.records:
+            logger.debug('No operations were retried')
+            return
+        lines = ['  {0}{1}: {2} retries, {3:.1f} seconds of back-off'.format(
+                 operation, ' on {0}'.format(host) if host else '',
+                 retries, total_delay)
+                 for (operation, host), (retries, total_delay)
+                 in self.records.items()]
+        logger.info('Retried operations:\n%s', '\n'.join(lines))
+
+
+retry_budget = RetryBudget()
+retry_stats = RetryStats()
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(host):
+    with _circuit_breakers_lock:
+        if host not in _circuit_breakers:
+            _circuit_breakers[host] = CircuitBreaker(host)
+        return _circuit_breakers[host]
+
+
+def reset_circuit_breakers():
+    with _circuit_breakers_lock:
+        _circuit_breakers.clear()
+
+
+def call_with_retries(func, operation, policy, is_retryable, host=None,
+                      deadline=None):
+    """Call `func`, retrying it according to `policy`.
+
+    :param func: A callable that takes no arguments.
+    :param operation: The operation's name, for the logs and the report.
+    :param policy: A RetryPolicy.
+    :param is_retryable: A callable that gets the raised exception and
+                         returns True if the operation may be retried. This
+                         is where the operation's idempotency is taken into
+                         account.
+    :param host: The host the operation runs on, if it's a remote one.
+    :param deadline: A Deadline. No retry is made past it.
+    """
+    attempt = 1
+    while True:
+        try:
+            return func()
+        except Exception as exc:
+            if attempt >= policy.max_attempts or not is_retryable(exc):
+                raise
+            delay = policy.get_delay(attempt)
+            remaining = deadline.remaining() if deadline else None
+            if remaining is not None and remaining < delay:
+                raise
+            if not retry_budget.consume():
+                logger.warning('The retry budget of this run is exhausted')
+                raise
+            retry_stats.record_retry(operation, host, delay)
+            logger.warning('%s%s failed (attempt %d of %d), retrying in '
+                           '%.1f seconds: %s', operation,
+                           ' on {0}'.format(host) if host else '',
+                           attempt, policy.max_attempts, delay, exc)
+            time.sleep(delay)
+            attempt += 1
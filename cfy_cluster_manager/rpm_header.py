@@ -0,0 +1,153 @@
+"""Read the package an RPM file holds, without the `rpm` binary.
+
+An RPM starts with a 96 bytes lead, followed by the signature header,
+padded to 8 bytes, and then the main header. Both headers are an index of
+(tag, type, offset, count) entries and a store of the entries' data. The
+name, epoch, version, release and arch are in the main header, and its
+SHA1 digest, which `rpm -q --queryformat '%{SHA1HEADER}'` reports for an
+installed package, is in the signature header.
+"""
+import struct
+import hashlib
+
+from .exceptions import ClusterInstallError
+
+LEAD_SIZE = 96
+LEAD_MAGIC = b'\xed\xab\xee\xdb'
+HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+HEADER_INTRO = struct.Struct('>4s4xII')
+INDEX_ENTRY = struct.Struct('>iiii')
+
+INT32_TYPE = 4
+STRING_TYPE = 6
+I18NSTRING_TYPE = 9
+
+SIGTAG_SHA1 = 269
+TAG_NAME = 1000
+TAG_VERSION = 1001
+TAG_RELEASE = 1002
+TAG_EPOCH = 1003
+TAG_ARCH = 1022
+
+# The query whose output parse_query_output parses
+QUERY_FORMAT = r'%{NAME} %{EPOCH} %{VERSION} %{RELEASE} %{ARCH} ' \
+               r'%{SHA1HEADER}\n'
+QUERY_NONE = '(none)'
+
+
+class RpmHeaderError(ClusterInstallError):
+    pass
+
+
+class RpmPackage(object):
+    def __init__(self, name, version, release, epoch=None, arch=None,
+                 digest=None):
+        self.name = name
+        self.version = version
+        self.release = release
+        self.epoch = epoch
+        self.arch = arch
+        self.digest = digest
+
+    def matches(self, other):
+        """Whether both are the same build of the same package.
+
+        The digests are compared only if both are known, so a rebuild of
+        the same version is told apart where possible.
+        """
+        if (self.name, self.epoch, self.version, self.release, self.arch) != \
+                (other.name, other.epoch, other.version, other.release,
+                 other.arch):
+            return False
+        return not (self.digest and other.digest) or \
+            self.digest == other.digest
+
+    def __str__(self):
+        return '{0}-{1}{2}-{3}{4}'.format(
+            self.name, '{0}:'.format(self.epoch) if self.epoch else '',
+            self.version, self.release,
+            '.{0}'.format(self.arch) if self.arch else '')
+
+    def __repr__(self):
+        return 'RpmPackage({0})'.format(self)
+
+
+def _read(rpm_file, size):
+    data = rpm_file.read(size)
+    if len(data) != size:
+        raise RpmHeaderError('Unexpected end of file')
+    return data
+
+
+def _read_header(rpm_file):
+    """Read a header.
+
+    :return: The header's raw bytes, and its entries by tag.
+    """
+    intro = _read(rpm_file, HEADER_INTRO.size)
+    magic, index_length, store_size = HEADER_INTRO.unpack(intro)
+    if magic != HEADER_MAGIC:
+        raise RpmHeaderError('Bad header magic')
+    index = _read(rpm_file, index_length * INDEX_ENTRY.size)
+    store = _read(rpm_file, store_size)
+    entries = {}
+    for i in range(index_length):
+        tag, type_, offset, count = INDEX_ENTRY.unpack_from(
+            index, i * INDEX_ENTRY.size)
+        if not 0 <= offset < store_size:
+            raise RpmHeaderError('Bad offset of tag {0}'.format(tag))
+        if type_ in (STRING_TYPE, I18NSTRING_TYPE):
+            end = store.find(b'\0', offset)
+            entries[tag] = store[offset:end if end >= 0 else None].decode(
+                'utf-8', 'replace')
+        elif type_ == INT32_TYPE and count:
+            entries[tag] = struct.unpack_from('>i', store, offset)[0]
+    return intro + index + store, entries
+
+
+def read_rpm_header(rpm_path):
+    """Read the package an RPM file holds.
+
+    :return: An RpmPackage.
+    :raises RpmHeaderError: If the file isn't an RPM.
+    """
+    with open(rpm_path, 'rb') as rpm_file:
+        try:
+            if _read(rpm_file, LEAD_SIZE)[:4] != LEAD_MAGIC:
+                raise RpmHeaderError('Bad lead magic')
+            signature, signature_entries = _read_header(rpm_file)
+            # The signature header is padded to a multiple of 8 bytes
+            _read(rpm_file, -len(signature) % 8)
+            header, entries = _read_header(rpm_file)
+        except (RpmHeaderError, struct.error) as exc:
+            raise RpmHeaderError('{0} is not a valid RPM: {1}'.format(
+                rpm_path, exc))
+    missing = [tag for tag in (TAG_NAME, TAG_VERSION, TAG_RELEASE)
+               if tag not in entries]
+    if missing:
+        raise RpmHeaderError('The header of {0} lacks the tags {1}'.format(
+            rpm_path, missing))
+    digest = signature_entries.get(SIGTAG_SHA1) or \
+        hashlib.sha1(header).hexdigest()
+    return RpmPackage(entries[TAG_NAME], entries[TAG_VERSION],
+                      entries[TAG_RELEASE], entries.get(TAG_EPOCH),
+                      entries.get(TAG_ARCH), digest)
+
+
+def parse_query_output(output):
+    """Parse the output of `rpm -q --queryformat QUERY_FORMAT`.
+
+    :return: The first package queried, or None if the output is empty.
+    """
+    lines = output.strip().splitlines()
+    if not lines:
+        return None
+    fields = [None if value == QUERY_NONE else value
+              for value in lines[0].split()]
+    if len(fields) != 6:
+        raise RpmHeaderError('Unexpected rpm query output: {0}'.format(
+            lines[0]))
+    name, epoch, version, release, arch, digest = fields
+    return RpmPackage(name, version, release,
+                      int(epoch) if epoch is not None else None, arch,
+                      digest)
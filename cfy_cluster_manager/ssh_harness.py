@@ -0,0 +1,384 @@
+"""An in-process SSH/SFTP server for measuring the `VM` layer.
+
+The server accepts any credentials, serves SFTP from a local directory and
+runs commands using the `fake` transport's command emulator, so the real
+`VM.run_command`, `put_file` and `put_dir` code can be run over loopback.
+A delay can be injected into the connection in order to simulate a network
+round trip time, and the server counts the handshakes, channels, commands,
+SFTP requests and bytes it served.
+"""
+import os
+import time
+import shlex
+import socket
+import threading
+from collections import Counter
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import paramiko
+from paramiko import (SFTPAttributes, SFTPHandle, SFTPServer,
+                      SFTPServerInterface)
+from paramiko.common import MSG_CHANNEL_REQUEST
+from paramiko.sftp import SFTP_OK
+
+from .fake_transport import FakeHost
+
+SERVER_KEY_BITS = 2048
+LINK_BUFFER_SIZE = 65536
+EXEC_ANSWER_TIMEOUT = 10
+
+_server_key = None
+_server_key_lock = threading.Lock()
+
+
+def _get_server_key():
+    """The server's host key. Generating it is slow, so it's shared."""
+    global _server_key
+    with _server_key_lock:
+        if _server_key is None:
+            _server_key = paramiko.RSAKey.generate(SERVER_KEY_BITS)
+        return _server_key
+
+
+def strip_sudo(command):
+    """Remove the `sudo` prefix fabric and asyncssh add to a command.
+
+    :return: The command and whether it was run using sudo.
+    """
+    args = shlex.split(command)
+    if not args or args[0] != 'sudo':
+        return command, False
+    args = args[1:]
+    while args and args[0].startswith('-'):
+        option = args.pop(0)
+        if option in ('-p', '-u'):
+            args.pop(0)
+    return ' '.join(shlex.quote(arg) for arg in args), True
+
+
+class _DelayedLink(object):
+    """Forward a socket's data to another socket after a delay.
+
+    Data is read as soon as it arrives and written once its delay passed,
+    so the link adds latency without limiting the throughput, like a long
+    network link does.
+    """
+    def __init__(self, source, destination, delay, on_data):
+        self.source = source
+        self.destination = destination
+        self.delay = delay
+        self.on_data = on_data
+        self._queue = Queue()
+        for target in (self._read, self._write):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def _read(self):
+        while True:
+            try:
+                data = self.source.recv(LINK_BUFFER_SIZE)
+            except socket.error:
+                data = None
+            if not data:
+                self._queue.put(None)
+                return
+            self.on_data(len(data))
+            self._queue.put((time.time() + self.delay, data))
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    self.destination.shutdown(socket.SHUT_WR)
+                    return
+                due_time, data = item
+                time.sleep(max(0, due_time - time.time()))
+                self.destination.sendall(data)
+            except socket.error:
+                return
+
+
+def _handle_channel_request(channel, message):
+    paramiko.Channel._handle_request(channel, message)
+    answered = getattr(channel, 'exec_request_answered', None)
+    if answered:
+        answered.set()
+
+
+class _Transport(paramiko.Transport):
+    """A server transport that tells when a channel's exec request was
+    answered.
+
+    The command runs in its own thread, and closing the channel before the
+    answer was sent fails the client.
+    """
+    _channel_handler_table = dict(paramiko.Transport._channel_handler_table)
+    _channel_handler_table[MSG_CHANNEL_REQUEST] = _handle_channel_request
+
+
+class _SFTPHandle(SFTPHandle):
+    def __init__(self, harness, flags=0):
+        super(_SFTPHandle, self).__init__(flags)
+        self.harness = harness
+
+    def write(self, offset, data):
+        self.harness.record(sftp_bytes=len(data))
+        return super(_SFTPHandle, self).write(offset, data)
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+
+    def chattr(self, attr):
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+            return SFTP_OK
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+
+
+class _SFTPInterface(SFTPServerInterface):
+    """Serve SFTP from the simulated host's directory."""
+    def __init__(self, server, harness):
+        super(_SFTPInterface, self).__init__(server)
+        self.harness = harness
+
+    def _path(self, path):
+        return self.harness.path(path)
+
+    def list_folder(self, path):
+        local_path = self._path(path)
+        try:
+            attributes = []
+            for file_name in os.listdir(local_path):
+                attr = SFTPAttributes.from_stat(
+                    os.stat(os.path.join(local_path, file_name)))
+                attr.filename = file_name
+                attributes.append(attr)
+            return attributes
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+
+    def open(self, path, flags, attr):
+        local_path = self._path(path)
+        try:
+            fd = os.open(local_path, flags, getattr(attr, 'st_mode', None)
+                         or 0o666)
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _SFTPHandle(self.harness, flags)
+        handle.filename = local_path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        return self._call(os.remove, self._path(path))
+
+    def rename(self, oldpath, newpath):
+        return self._call(os.rename, self._path(oldpath), self._path(newpath))
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, self._path(path))
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, self._path(path))
+
+    def chattr(self, path, attr):
+        return self._call(SFTPServer.set_file_attr, self._path(path), attr)
+
+    def _call(self, func, *args):
+        try:
+            func(*args)
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+        return SFTP_OK
+
+
+class _CountingSFTPServer(SFTPServer):
+    def __init__(self, channel, name, server, sftp_si, harness):
+        super(_CountingSFTPServer, self).__init__(channel, name, server,
+                                                  sftp_si, harness)
+        self.harness = harness
+
+    def _process(self, t, request_number, msg):
+        self.harness.record(sftp_requests=1)
+        return super(_CountingSFTPServer, self)._process(t, request_number,
+                                                         msg)
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, harness):
+        self.harness = harness
+
+    def get_allowed_auths(self, username):
+        return 'publickey,password'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind != 'session':
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        self.harness.record(channels=1)
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_env_request(self, channel, name, value):
+        return True
+
+    def check_channel_pty_request(self, channel, term, width, height,
+                                  pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        if isinstance(command, bytes):
+            command = command.decode('utf-8')
+        channel.exec_request_answered = threading.Event()
+        thread = threading.Thread(target=self.harness.execute,
+                                  args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class SSHServerHarness(object):
+    """An SSH/SFTP server listening on loopback.
+
+    Use it as a context manager, and connect to it using `host` and `port`
+    with any username and key or password:
+
+        with SSHServerHarness(root_dir, delay=0.05) as server:
+            vm = VM(server.host, server.host, key_path, 'centos',
+                    transport_options={'port': server.port})
+            vm.run_command('test -e /tmp')
+            server.stats['commands']  # 1
+
+    :param root_dir: Where the simulated host's filesystem is kept.
+    :param delay: The round trip time added to the connections, in seconds.
+    :param host_options: Options of the command emulator, see FakeCluster.
+    """
+    def __init__(self, root_dir, delay=0, host='127.0.0.1',
+                 **host_options):
+        self.host = host
+        self.delay = delay
+        self.fake_host = FakeHost(root_dir, host, host_options)
+        self._stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._transports = []
+        self._socket = None
+        self.port = None
+
+    @property
+    def stats(self):
+        with self._stats_lock:
+            return Counter(self._stats)
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats.clear()
+
+    def record(self, **counters):
+        with self._stats_lock:
+            self._stats.update(counters)
+
+    def path(self, remote_path):
+        """The local path of a path on the simulated host."""
+        return self.fake_host.path(remote_path)
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, 0))
+        self._socket.listen(100)
+        self.port = self._socket.getsockname()[1]
+        _get_server_key()
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, client):
+        """Run the SSH server side of a connection.
+
+        The connection goes through a pair of delayed links, which count
+        the bytes moved and add the round trip time.
+        """
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.record(handshakes=1)
+        server_side, link_side = socket.socketpair()
+        one_way_delay = self.delay / 2.0
+        _DelayedLink(client, link_side, one_way_delay,
+                     lambda size: self.record(bytes_received=size))
+        _DelayedLink(link_side, client, one_way_delay,
+                     lambda size: self.record(bytes_sent=size))
+        transport = _Transport(server_side)
+        transport.add_server_key(_get_server_key())
+        transport.set_subsystem_handler(
+            'sftp', _CountingSFTPServer, _SFTPInterface, self)
+        self._transports.append(transport)
+        try:
+            transport.start_server(server=_ServerInterface(self))
+        except (paramiko.SSHException, EOFError, socket.error):
+            transport.close()
+
+    def execute(self, channel, command):
+        """Run a command on behalf of an SSH channel."""
+        command, use_sudo = strip_sudo(command)
+        self.record(commands=1, sudo_commands=1 if use_sudo else 0)
+        stdout, stderr, return_code = self.fake_host.execute(command)
+        if stdout:
+            channel.sendall(stdout.encode('utf-8'))
+        if stderr:
+            channel.sendall_stderr(stderr.encode('utf-8'))
+        channel.send_exit_status(return_code)
+        channel.exec_request_answered.wait(EXEC_ANSWER_TIMEOUT)
+        channel.close()
@@ -0,0 +1,184 @@
+"""Cap the upload rate, and report the throughput of each upload.
+
+All the uploads share a token bucket of `--max-upload-rate` bytes per
+second, and each host may have a bucket of its own, so parallel uploads to
+many instances don't saturate a shared link. A transport reserves the
+bytes it's about to send, and waits for as long as the buckets tell it to.
+"""
+import re
+import time
+import threading
+
+from .logger import get_cfy_cluster_manager_logger
+
+logger = get_cfy_cluster_manager_logger()
+
+# The bytes a bucket may send at once, after being idle, in seconds of rate
+BURST_SECONDS = 0.1
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(rate):
+    """Parse a rate in bytes per second, e.g. 500K, 10M or 1.5G."""
+    match = re.match(r'^\s*(\d+(\.\d+)?)\s*([KMG]?)(i?B)?(/s)?\s*$',
+                     str(rate), re.IGNORECASE)
+    if not match:
+        raise ValueError('Invalid rate {0}, expected a number of bytes per '
+                         'second, e.g. 500K, 10M or 1G'.format(rate))
+    value = int(float(match.group(1)) * UNITS[match.group(3).upper()])
+    if value <= 0:
+        raise ValueError('The rate {0} must be positive'.format(rate))
+    return value
+
+
+def format_size(size):
+    for unit in ('', 'K', 'M'):
+        if size < 1024:
+            return '{0:.1f} {1}B'.format(size, unit + 'i' if unit else '')
+        size /= 1024.0
+    return '{0:.1f} GiB'.format(size)
+
+
+class TokenBucket(object):
+    """A token bucket which may go into debt.
+
+    Reserving more tokens than there are is allowed, and returns how long
+    the caller must wait for the debt to be paid, so concurrent callers
+    are served in the order they reserved.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else rate * BURST_SECONDS
+        self.tokens = self.burst
+        self._last_time = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Take `amount` tokens, and return the seconds to wait for them."""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self._last_time) * self.rate)
+            self._last_time = now
+            self.tokens -= amount
+            return max(0, -self.tokens / self.rate)
+
+
+class UploadThrottle(object):
+    def __init__(self):
+        self.configure()
+
+    def configure(self, max_rate=None, max_host_rate=None, host_rates=None):
+        """Set the rates, in bytes per second. None means no limit.
+
+        :param max_rate: The rate of all the uploads together.
+        :param max_host_rate: The rate of the uploads to each host.
+        :param host_rates: Per host rates, overriding `max_host_rate`.
+        """
+        self.max_host_rate = max_host_rate
+        self.host_rates = dict(host_rates or {})
+        self._bucket = TokenBucket(max_rate) if max_rate else None
+        self._host_buckets = {}
+        self._lock = threading.Lock()
+
+    def set_host_rate(self, host, rate):
+        with self._lock:
+            self.host_rates[host] = rate
+            self._host_buckets.pop(host, None)
+
+    @property
+    def enabled(self):
+        return bool(self._bucket or self.max_host_rate or self.host_rates)
+
+    def _get_host_bucket(self, host):
+        with self._lock:
+            if host not in self._host_buckets:
+                rate = self.host_rates.get(host, self.max_host_rate)
+                self._host_buckets[host] = TokenBucket(rate) if rate else None
+            return self._host_buckets[host]
+
+    def reserve(self, host, amount):
+        """Reserve sending `amount` bytes to `host`.
+
+        :return: The seconds to wait before sending them.
+        """
+        delays = [bucket.reserve(amount)
+                  for bucket in (self._bucket, self._get_host_bucket(host))
+                  if bucket]
+        return max(delays or [0])
+
+    def wait(self, host, amount):
+        delay = self.reserve(host, amount)
+        if delay:
+            time.sleep(delay)
+
+
+upload_throttle = UploadThrottle()
+
+
+class ThrottledFile(object):
+    """A file object whose reads wait for the upload throttle."""
+    def __init__(self, file_obj, host, throttle=upload_throttle):
+        self.file_obj = file_obj
+        self.host = host
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.file_obj.read(size)
+        self.throttle.wait(self.host, len(data))
+        return data
+
+
+class Transfer(object):
+    def __init__(self, host, path, size, duration):
+        self.host = host
+        self.path = path
+        self.size = size
+        self.duration = duration
+
+    @property
+    def throughput(self):
+        return self.size / self.duration if self.duration else 0
+
+
+class TransferStats(object):
+    """The uploads of this run, and the throughput each achieved."""
+    def __init__(self):
+        self.transfers = []
+        self._lock = threading.Lock()
+
+    def record(self, host, path, size, duration):
+        transfer = Transfer(host, path, size, duration)
+        logger.debug('Uploaded %s (%s) to %s in %.1f seconds, %s/s', path,
+                     format_size(size), host, duration,
+                     format_size(transfer.throughput))
+        with self._lock:
+            self.transfers.append(transfer)
+
+    def reset(self):
+        with self._lock:
+            self.transfers = []
+
+    def format_table(self):
+        rows = [('node', 'path', 'size', 'time (s)', 'throughput')]
+        with self._lock:
+            transfers = list(self.transfers)
+        for transfer in transfers:
+            rows.append((transfer.host, transfer.path,
+                         format_size(transfer.size),
+                         '{0:.1f}'.format(transfer.duration),
+                         format_size(transfer.throughput) + '/s'))
+        widths = [max(len(row[i]) for row in rows)
+                  for i in range(len(rows[0]))]
+        return '\n'.join(
+            '  '.join(value.ljust(width) if i < 2 else value.rjust(width)
+                      for i, (value, width) in enumerate(zip(row, widths)))
+            for row in rows)
+
+    def log_report(self):
+        if not self.transfers:
+            return
+        logger.info('Uploads:\n%s', self.format_table())
+
+
+transfer_stats = TransferStats()
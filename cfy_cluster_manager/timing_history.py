@@ -0,0 +1,193 @@
+"""Record how long each step of a run took, and estimate the next runs.
+
+Every prepare, install and upgrade step (uploading, installing the RPM,
+copying the config file, running `cfy_manager`) is timed per node, and the
+timings are saved to a local SQLite database once the run ends. The
+estimates are based on the recent successful runs of the same step, on the
+same host if possible, and otherwise of any host with the same role.
+"""
+import re
+import time
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
+from os import makedirs
+from os.path import basename, dirname, exists, expanduser, join
+
+from .logger import get_cfy_cluster_manager_logger
+
+logger = get_cfy_cluster_manager_logger()
+
+DEFAULT_HISTORY_PATH = join(expanduser('~'), '.cfy_cluster_manager',
+                            'timing_history.db')
+HISTORY_SAMPLES = 10
+UNKNOWN_VERSION = 'unknown'
+
+# Used when a step never ran before, in seconds
+DEFAULT_STEP_DURATIONS = {
+    'upload': 30,
+    'rpm install': 120,
+    'config copy': 5,
+    'cfy_manager install': 300,
+    'rpm upgrade': 120,
+    'cfy_manager upgrade': 300,
+    'cfy_manager configure': 120,
+}
+DEFAULT_ROLE_STEP_DURATIONS = {
+    ('manager', 'cfy_manager install'): 600,
+    ('manager', 'cfy_manager upgrade'): 600,
+}
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS step_timings (
+    run_started_at REAL NOT NULL,
+    operation TEXT NOT NULL,
+    role TEXT NOT NULL,
+    version TEXT NOT NULL,
+    host TEXT NOT NULL,
+    node TEXT NOT NULL,
+    step TEXT NOT NULL,
+    duration REAL NOT NULL,
+    success INTEGER NOT NULL
+)"""
+CREATE_INDEX = """
+CREATE INDEX IF NOT EXISTS step_timings_role_step
+ON step_timings (role, step, version, host)"""
+
+# The estimate sources, from the most specific to the least, and the
+# columns they match
+ESTIMATE_SOURCES = (
+    ('host', ('role', 'step', 'version', 'host')),
+    ('version', ('role', 'step', 'version')),
+    ('role', ('role', 'step')),
+)
+# These steps take the same time whatever role the node has
+ROLE_INDEPENDENT_STEPS = ('upload', 'rpm install', 'config copy',
+                          'rpm upgrade')
+
+
+def get_rpm_version(rpm_path):
+    """The Cloudify version in an RPM's file name, e.g. 5.1.2."""
+    match = re.search(r'(\d+\.\d+(\.\d+)*)', basename(rpm_path or ''))
+    return match.group(1) if match else UNKNOWN_VERSION
+
+
+def get_default_duration(role, step):
+    return DEFAULT_ROLE_STEP_DURATIONS.get(
+        (role, step), DEFAULT_STEP_DURATIONS.get(step, 0))
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class StepTiming(object):
+    def __init__(self, node, role, host, step, duration, success):
+        self.node = node
+        self.role = role
+        self.host = host
+        self.step = step
+        self.duration = duration
+        self.success = success
+
+
+class StepTimings(object):
+    """The timings of the steps in this run."""
+    def __init__(self):
+        self.operation = None
+        self.version = UNKNOWN_VERSION
+        self.start_time = None
+        self.timings = []
+        self._lock = threading.Lock()
+
+    def start(self, operation, version=UNKNOWN_VERSION):
+        self.operation = operation
+        self.version = version
+        self.start_time = time.time()
+        with self._lock:
+            self.timings = []
+
+    @contextmanager
+    def step(self, instance, name):
+        start_time = time.time()
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            timing = StepTiming(instance.name, instance.type,
+                                instance.private_ip, name,
+                                time.time() - start_time, success)
+            with self._lock:
+                self.timings.append(timing)
+
+
+step_timings = StepTimings()
+
+
+class TimingHistory(object):
+    def __init__(self, path=DEFAULT_HISTORY_PATH):
+        self.path = path
+
+    def _connect(self):
+        directory = dirname(self.path)
+        if directory and not exists(directory):
+            makedirs(directory)
+        connection = sqlite3.connect(self.path)
+        connection.execute(CREATE_TABLE)
+        connection.execute(CREATE_INDEX)
+        return connection
+
+    def save(self, timings):
+        """Save a run's StepTimings."""
+        with timings._lock:
+            rows = [(timings.start_time, timings.operation, timing.role,
+                     timings.version, timing.host, timing.node, timing.step,
+                     timing.duration, int(timing.success))
+                    for timing in timings.timings]
+        if not rows:
+            return
+        with closing(self._connect()) as connection, connection:
+            connection.executemany(
+                'INSERT INTO step_timings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows)
+
+    def estimate(self, role, step, version=UNKNOWN_VERSION, host=None):
+        """Estimate a step's duration.
+
+        The uploads and RPM installs are estimated from the same step of
+        any role.
+
+        :return: The duration in seconds, and what it's based on: 'host',
+                 'version' or 'role' history, or 'default'.
+        """
+        if exists(self.path):
+            values = {'role': role, 'step': step, 'version': version,
+                      'host': host}
+            with closing(self._connect()) as connection:
+                for source, columns in ESTIMATE_SOURCES:
+                    if step in ROLE_INDEPENDENT_STEPS:
+                        columns = columns[1:]
+                    durations = [row[0] for row in connection.execute(
+                        'SELECT duration FROM step_timings WHERE success '
+                        'AND {0} ORDER BY run_started_at DESC '
+                        'LIMIT ?'.format(' AND '.join(
+                            '{0} = ?'.format(column) for column in columns)),
+                        tuple(values[column] for column in columns) +
+                        (HISTORY_SAMPLES,))]
+                    if durations:
+                        return _median(durations), source
+        return get_default_duration(role, step), 'default'
+
+
+def save_step_timings(path=DEFAULT_HISTORY_PATH):
+    """Save this run's step timings. Failing to do so doesn't fail the run.
+    """
+    try:
+        TimingHistory(path).save(step_timings)
+    except (sqlite3.Error, OSError) as exc:
+        logger.warning('Could not save the step timings to %s: %s', path, exc)
@@ -0,0 +1,399 @@
+import os
+import json
+import stat
+import socket
+import threading
+from os.path import basename, expanduser, isdir, isfile, join
+from socket import error as socket_error
+
+from fabric import Connection
+from invoke.exceptions import CommandTimedOut
+from paramiko import (AuthenticationException, SSHException,
+                      Transport as SSHTransport)
+
+from .exceptions import (ClusterInstallError, CommandTimeoutError,
+                         RemoteTransportError, SSHConnectionError)
+from .throttle import ThrottledFile
+
+SSH_PORT = 22
+KEEPALIVE_INTERVAL = 5
+# The commands which may run for longer than this are watched by probing
+# their host, every WATCHDOG_INTERVAL seconds, and their connection is
+# broken once WATCHDOG_PROBES probes in a row failed.
+WATCHDOG_MIN_TIMEOUT = 600
+WATCHDOG_INTERVAL = 30
+WATCHDOG_PROBES = 3
+WATCHDOG_PROBE_TIMEOUT = 5
+# The SSH channel window and packet size the client offers. A large window
+# keeps the connection busy over links with a long round trip time.
+DEFAULT_WINDOW_SIZE = 16 * 1024 * 1024
+DEFAULT_MAX_PACKET_SIZE = 64 * 1024
+# The data of a single SFTP write. paramiko sends 32KiB writes, and OpenSSH's
+# sftp-server accepts messages of up to 256KiB.
+DEFAULT_SFTP_REQUEST_SIZE = 128 * 1024
+
+DEFAULT_TRANSPORT = 'fabric'
+TRANSPORTS = ('fabric', 'asyncssh', 'fake')
+
+
+class CommandResult(object):
+    """The result of a remote command, in the form fabric returns it."""
+    def __init__(self, command, stdout, stderr, return_code):
+        self.command = command
+        self.stdout = stdout
+        self.stderr = stderr
+        self.return_code = return_code
+
+    @property
+    def failed(self):
+        return self.return_code != 0
+
+
+def ssh_banner_probe(host, port, timeout):
+    """Check the host's SSH server answers, without authenticating."""
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except socket_error:
+        return False
+    try:
+        sock.settimeout(timeout)
+        return sock.recv(4) == b'SSH-'
+    except socket_error:
+        return False
+    finally:
+        sock.close()
+
+
+class LivenessWatchdog(object):
+    """Probe a host in a thread while a command runs on it, and call
+    `on_dead` once the host missed `probes` probes in a row.
+
+    :param is_alive: A callable that gets a timeout and returns whether the
+                     host answered, such as `Transport.is_alive`.
+    :param interval: The seconds between the probes, or None for a watchdog
+                     which doesn't watch.
+    """
+    def __init__(self, is_alive, on_dead, interval,
+                 probes=WATCHDOG_PROBES, probe_timeout=WATCHDOG_PROBE_TIMEOUT):
+        self.fired = False
+        self._is_alive = is_alive
+        self._on_dead = on_dead
+        self._interval = interval
+        self._probes = probes
+        self._probe_timeout = probe_timeout
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self._interval is not None:
+            self._thread = threading.Thread(target=self._watch)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def _watch(self):
+        missed = 0
+        while not self._stopped.wait(self._interval):
+            if self._is_alive(self._probe_timeout):
+                missed = 0
+                continue
+            missed += 1
+            if missed >= self._probes:
+                self.fired = True
+                self._on_dead()
+                return
+
+
+class Transport(object):
+    """The way `VM` reaches its host.
+
+    A transport only moves commands and files. Retries, deadlines and
+    logging are the `VM`'s business. Failing to connect must raise
+    SSHConnectionError, a connection breaking in the middle of an operation
+    must raise RemoteTransportError, and a command running for longer than
+    its timeout must raise CommandTimeoutError.
+
+    A transport counts the SSH connections it opened in `connections`.
+
+    :param options: Transport specific options, taken from the
+                    `transport_options` section of the configuration file.
+    """
+    name = None
+
+    def __init__(self, host, username, key_file_path=None, password=None,
+                 port=SSH_PORT, **options):
+        self.host = host
+        self.username = username
+        self.key_file_path = key_file_path
+        self.password = password
+        self.port = port
+        self.options = options
+        self.connections = 0
+
+    def test_connection(self, connect_timeout):
+        raise NotImplementedError()
+
+    def is_alive(self, timeout):
+        """A cheap check that the host is up, used to tell a dead host from
+        a failure of a single SSH session."""
+        return ssh_banner_probe(self.host, self.port, timeout)
+
+    def run(self, command, use_sudo, hide_stdout, connect_timeout, timeout):
+        """Run a command and return its result.
+
+        :return: An object with `stdout`, `stderr`, `return_code` and
+                 `failed` attributes, such as CommandResult.
+        """
+        raise NotImplementedError()
+
+    def put_file(self, local_path, remote_path, connect_timeout):
+        raise NotImplementedError()
+
+    def put_dir(self, local_dir_path, remote_dir_path, connect_timeout):
+        """Copy the content of a local directory into a remote one,
+        creating it if needed."""
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+def prefer(preferred, supported):
+    """Order the supported algorithms with the preferred ones first.
+
+    The algorithms which aren't preferred are kept, so the negotiation
+    succeeds even if the server supports none of the preferred ones.
+    """
+    preferred = [name for name in preferred or () if name in supported]
+    return preferred + [name for name in supported if name not in preferred]
+
+
+class FabricTransport(Transport):
+    """Run remote operations using fabric.
+
+    A new SSH connection is opened for each operation. Uploads are sent over
+    SFTP with pipelined writes.
+
+    :param window_size: The SSH channel window, in bytes.
+    :param max_packet_size: The SSH channel's maximal packet size, in bytes.
+    :param sftp_request_size: The size of the SFTP writes, in bytes.
+    :param ciphers: The ciphers to prefer, e.g. ['aes128-gcm@openssh.com'].
+    :param compression: Whether to compress the SSH connection.
+    :param watchdog_interval: The seconds between the probes of the host
+                              while a long command runs on it.
+    """
+    name = 'fabric'
+
+    def __init__(self, host, username, key_file_path=None, password=None,
+                 port=SSH_PORT, **options):
+        super(FabricTransport, self).__init__(
+            host, username, key_file_path, password, port, **options)
+        self.window_size = options.get('window_size', DEFAULT_WINDOW_SIZE)
+        self.max_packet_size = options.get('max_packet_size',
+                                           DEFAULT_MAX_PACKET_SIZE)
+        self.sftp_request_size = options.get('sftp_request_size',
+                                             DEFAULT_SFTP_REQUEST_SIZE)
+        self.ciphers = options.get('ciphers')
+        self.compression = options.get('compression', False)
+        self.watchdog_interval = options.get('watchdog_interval',
+                                             WATCHDOG_INTERVAL)
+
+    def _create_ssh_transport(self, sock, **kwargs):
+        transport = SSHTransport(
+            sock, default_window_size=self.window_size,
+            default_max_packet_size=self.max_packet_size, **kwargs)
+        if self.ciphers:
+            security_options = transport.get_security_options()
+            security_options.ciphers = prefer(self.ciphers,
+                                              security_options.ciphers)
+        return transport
+
+    def _get_connection(self, connect_timeout):
+        connect_kwargs = ({'key_filename': [self.key_file_path]} if
+                          self.key_file_path else {'password': self.password})
+        connect_kwargs.update(transport_factory=self._create_ssh_transport,
+                              compress=self.compression)
+        connection = Connection(
+            host=self.host, user=self.username, port=self.port,
+            connect_timeout=connect_timeout, connect_kwargs=connect_kwargs)
+        try:
+            connection.open()
+        except (socket_error, SSHException) as exc:
+            raise SSHConnectionError(
+                "SSH: could not connect to {host} (username: {user}, "
+                "key: {key}): {exc}".format(
+                    host=self.host, user=self.username,
+                    key=self.key_file_path, exc=exc),
+                # Bad credentials won't get better by retrying
+                transient=not isinstance(exc, AuthenticationException))
+        self.connections += 1
+        # Keepalives keep idle NAT and firewall mappings open. paramiko
+        # doesn't wait for their replies though, so they don't detect a
+        # dead host: the watchdog of the long commands does.
+        connection.transport.set_keepalive(KEEPALIVE_INTERVAL)
+        return connection
+
+    def _watch(self, connection, timeout):
+        """A watchdog breaking the connection once the host stops
+        answering, for commands which may run for long."""
+        long_command = timeout is None or timeout > WATCHDOG_MIN_TIMEOUT
+        return LivenessWatchdog(
+            self.is_alive, connection.transport.close,
+            self.watchdog_interval if long_command else None)
+
+    def test_connection(self, connect_timeout):
+        self._get_connection(connect_timeout).close()
+
+    def run(self, command, use_sudo, hide_stdout, connect_timeout, timeout):
+        hide = True if hide_stdout else 'stderr'
+        with self._get_connection(connect_timeout) as connection, \
+                self._watch(connection, timeout) as watchdog:
+            try:
+                result = (connection.sudo(command, warn=True, hide=hide,
+                                          timeout=timeout)
+                          if use_sudo else
+                          connection.run(command, warn=True, hide=hide,
+                                         timeout=timeout))
+            except CommandTimedOut:
+                raise CommandTimeoutError(
+                    'The command `{0}` on host {1} timed out after {2} '
+                    'seconds'.format(command, self.host, int(timeout)))
+            except (socket_error, SSHException, EOFError) as exc:
+                if not watchdog.fired:
+                    raise RemoteTransportError(
+                        'The connection to {0} broke while running `{1}`: '
+                        '{2}'.format(self.host, command, exc))
+            if watchdog.fired:
+                # The closed channel may also look like a finished command
+                raise RemoteTransportError(
+                    'The host {0} stopped answering while running '
+                    '`{1}`'.format(self.host, command))
+            return result
+
+    def put_file(self, local_path, remote_path, connect_timeout):
+        with self._get_connection(connect_timeout) as connection:
+            try:
+                self._sftp_put(connection.sftp(), expanduser(local_path),
+                               remote_path)
+            except (socket_error, SSHException, EOFError) as exc:
+                raise RemoteTransportError(
+                    'Failed copying {0} to {1}: {2}'.format(
+                        local_path, self.host, exc))
+
+    def put_dir(self, local_dir_path, remote_dir_path, connect_timeout):
+        """Copy a directory's content over a single connection."""
+        with self._get_connection(connect_timeout) as connection:
+            try:
+                self._put_dir(connection, local_dir_path, remote_dir_path)
+            except (socket_error, SSHException, EOFError) as exc:
+                raise RemoteTransportError(
+                    'Failed copying {0} to {1}: {2}'.format(
+                        local_dir_path, self.host, exc))
+
+    def _sftp_put(self, sftp, local_path, remote_path, check_dir=True):
+        """Upload a file through the upload throttle, keeping its mode.
+
+        The writes are pipelined, and every request costs a round trip, so
+        the remote path is only checked for being a directory if needed,
+        and the upload isn't confirmed by another `stat`: closing the file
+        already fails if a write did.
+        """
+        if check_dir:
+            try:
+                if stat.S_ISDIR(sftp.stat(remote_path).st_mode):
+                    remote_path = join(remote_path, basename(local_path))
+            except IOError:
+                pass
+        with open(local_path, 'rb') as local_file, \
+                sftp.open(remote_path, 'wb') as remote_file:
+            remote_file.set_pipelined(True)
+            # paramiko splits the writes into requests of this size
+            remote_file.MAX_REQUEST_SIZE = self.sftp_request_size
+            throttled_file = ThrottledFile(local_file, self.host)
+            while True:
+                data = throttled_file.read(self.sftp_request_size)
+                if not data:
+                    break
+                remote_file.write(data)
+        sftp.chmod(remote_path, stat.S_IMODE(os.stat(local_path).st_mode))
+
+    def _put_dir(self, connection, local_dir_path, remote_dir_path):
+        connection.run('mkdir -p {}'. format(remote_dir_path), warn=True,
+                       hide='stderr')
+        for file_name in os.listdir(local_dir_path):
+            object_path = join(local_dir_path, file_name)
+            if isfile(object_path):
+                self._sftp_put(connection.sftp(), expanduser(object_path),
+                               join(remote_dir_path, file_name),
+                               check_dir=False)
+            elif isdir(object_path):
+                self._put_dir(connection, object_path,
+                              join(remote_dir_path, file_name))
+
+
+def get_transport_class(name):
+    """Return a transport class by its name (one of TRANSPORTS)."""
+    name = name or DEFAULT_TRANSPORT
+    if name == 'fabric':
+        return FabricTransport
+    elif name == 'asyncssh':
+        # asyncssh is an optional dependency, so it's only imported if used
+        from .asyncssh_transport import asyncssh, AsyncSSHTransport
+        if asyncssh is None:
+            raise ClusterInstallError(
+                'The asyncssh transport requires the asyncssh package. '
+                'Install it using `pip install asyncssh`')
+        return AsyncSSHTransport
+    elif name == 'fake':
+        from .fake_transport import FakeTransport
+        return FakeTransport
+    raise ClusterInstallError(
+        'Unknown transport {0}. Please use one of: {1}'.format(
+            name, ', '.join(TRANSPORTS)))
+
+
+class TransportPool(object):
+    """The transports of the hosts, kept across runs by a long running
+    process (the daemon), so transports which keep their connection open,
+    like asyncssh's, don't connect again on every run.
+
+    The instances of a host with the same settings share its transport.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._transports = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, host, username, key_file_path, password, options):
+        key = (name or DEFAULT_TRANSPORT, host, username, key_file_path,
+               password, json.dumps(options or {}, sort_keys=True))
+        with self._lock:
+            if key not in self._transports:
+                self._transports[key] = get_transport_class(name)(
+                    host, username, key_file_path, password,
+                    **(options or {}))
+            return self._transports[key]
+
+    def close_all(self):
+        with self._lock:
+            transports = list(self._transports.values())
+            self._transports.clear()
+        for transport in transports:
+            transport.close()
+
+
+transport_pool = TransportPool()
+
+
+def get_transport(name, host, username, key_file_path=None, password=None,
+                  options=None):
+    if transport_pool.enabled:
+        return transport_pool.get(name, host, username, key_file_path,
+                                  password, options)
+    return get_transport_class(name)(host, username, key_file_path, password,
+                                     **(options or {}))
@@ -1,31 +1,72 @@
 import os
 import re
+import time
 import shlex
+import threading
 import subprocess
-from os.path import dirname, exists, expanduser, isdir, isfile, join
-from socket import error as socket_error
+from copy import deepcopy
+from os.path import (abspath, dirname, exists, expanduser, getsize, isdir,
+                     isfile, join)
 
 import yaml
-from fabric import Connection
-from paramiko import AuthenticationException
 
+from .exceptions import (CircuitOpenError,  # noqa: F401
+                         ClusterInstallError,
+                         CommandTimeoutError,
+                         DeadlineExceededError,
+                         NodeUnreachableError,
+                         ProcessExecutionError,
+                         RemoteTransportError,
+                         SSHConnectionError,
+                         ValidationError)
+from .concurrency import concurrency_limiter
 from .logger import get_cfy_cluster_manager_logger
+from .profiler import remote_span
+from .remote_stats import remote_stats
+from .retry import (call_with_retries, get_circuit_breaker, LOCAL_RETRY_DELAY,
+                    REMOTE_RETRY_POLICY, RetryPolicy)
+from .throttle import transfer_stats
+from .transport import get_transport
 
 logger = get_cfy_cluster_manager_logger()
 
+CONNECT_TIMEOUT = 10
+LIVENESS_TIMEOUT = 3
+COMMAND_TIMEOUT = 300
 
-class ClusterInstallError(Exception):
-    pass
 
+class Deadline(object):
+    """A deadline for the whole run, shared by all local and remote calls.
 
-class ProcessExecutionError(ClusterInstallError):
-    def __init__(self, message, return_code=None):
-        self.return_code = return_code
-        super(ProcessExecutionError, self).__init__(message)
+    Every call bounds its own timeout by the time left until the deadline,
+    so a run never outlives it by more than a single connection attempt.
+    """
+    def __init__(self):
+        self.expires_at = None
 
+    def start(self, seconds):
+        self.expires_at = (time.time() + seconds) if seconds else None
 
-class ValidationError(ClusterInstallError):
-    pass
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return self.expires_at - time.time()
+
+    def check(self):
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceededError('The run deadline was exceeded')
+
+    def bound(self, timeout):
+        """Return `timeout` limited by the time left until the deadline."""
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+
+run_deadline = Deadline()
 
 
 def run(command, retries=0, stdin=u'', ignore_failures=False):
@@ -33,26 +74,46 @@ def run(command, retries=0, stdin=u'', ignore_failures=False):
         command = shlex.split(command)
     if isinstance(stdin, str):
         stdin = stdin.encode('utf-8')
+    policy = RetryPolicy(max_attempts=retries + 1,
+                         base_delay=LOCAL_RETRY_DELAY)
+    try:
+        return call_with_retries(
+            lambda: _run_process(command, stdin),
+            'Running {0}'.format(command), policy,
+            lambda exc: isinstance(exc, ProcessExecutionError),
+            deadline=run_deadline)
+    except ProcessExecutionError as err:
+        if ignore_failures:
+            return err.proc
+        raise
+
+
+def _run_process(command, stdin):
     logger.debug('Running: {0}'.format(command))
+    timeout = run_deadline.bound(None)
     proc = subprocess.Popen(command, stdin=subprocess.PIPE,
                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    proc.aggr_stdout, proc.aggr_stderr = proc.communicate(input=stdin)
+    try:
+        proc.aggr_stdout, proc.aggr_stderr = proc.communicate(
+            input=stdin, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise DeadlineExceededError(
+            'The run deadline was exceeded while running: {0}'.format(
+                command))
     if proc.aggr_stdout is not None:
         proc.aggr_stdout = proc.aggr_stdout.decode('utf-8')
     if proc.aggr_stderr is not None:
         proc.aggr_stderr = proc.aggr_stderr.decode('utf-8')
     if proc.returncode != 0:
-        if retries:
-            logger.warn('Failed running command: %s. Retrying. '
-                        '(%s left)', command, retries)
-            proc = run(command, retries - 1)
-        elif not ignore_failures:
-            msg = 'Failed running command: {0} ({1}).'.format(
-                command, proc.aggr_stderr)
-            err = ProcessExecutionError(msg, proc.returncode)
-            err.aggr_stdout = proc.aggr_stdout
-            err.aggr_stderr = proc.aggr_stderr
-            raise err
+        msg = 'Failed running command: {0} ({1}).'.format(
+            command, proc.aggr_stderr)
+        err = ProcessExecutionError(msg, proc.returncode)
+        err.aggr_stdout = proc.aggr_stdout
+        err.aggr_stderr = proc.aggr_stderr
+        err.proc = proc
+        raise err
     return proc
 
 
@@ -80,64 +141,135 @@ def move(source, destination):
 
 
 class VM(object):
+    # The type of the node on the host, if it's known
+    type = None
+
     def __init__(self,
                  private_ip,
                  public_ip,
                  key_file_path,
                  username,
-                 password=None):
+                 password=None,
+                 transport=None,
+                 transport_options=None):
         self.username = username
         self.private_ip = private_ip
         self.public_ip = public_ip or private_ip
         self.key_file_path = (expanduser(key_file_path) if key_file_path
                               else None)
         self.password = password if password else None
+        self.transport = get_transport(transport, self.private_ip,
+                                       self.username, self.key_file_path,
+                                       self.password, transport_options)
+
+    def _call_with_retries(self, func, operation, idempotent,
+                           retry_policy=None, metered=True, **counters):
+        """Call `func`, retrying it on transient SSH failures.
+
+        A failure to connect is always retried, since nothing ran on the
+        host yet. A failure in the middle of an operation is retried only if
+        the operation is idempotent.
+
+        Each attempt waits for room under the adaptive concurrency limit,
+        unless it's not `metered`.
+        The operation's cost is recorded in `remote_stats`, along with the
+        given counters, and it's marked as a remote span for the profiler.
+        """
+        circuit_breaker = get_circuit_breaker(self.private_ip)
+
+        def attempt():
+            circuit_breaker.before_call()
+            try:
+                if metered:
+                    with concurrency_limiter.slot(
+                            operation, counters.get('bytes', 0), self.type):
+                        result = func()
+                else:
+                    result = func()
+            except Exception as exc:
+                if isinstance(exc, SSHConnectionError) and exc.transient:
+                    circuit_breaker.record_failure()
+                else:
+                    # The host was reached, and a trial call must end
+                    circuit_breaker.record_success()
+                raise
+            circuit_breaker.record_success()
+            return result
 
-    def _get_connection(self):
-        connect_kwargs = ({'key_filename': [self.key_file_path]} if
-                          self.key_file_path else {'password': self.password})
-        connection = Connection(
-            host=self.private_ip, user=self.username, port=22,
-            connect_kwargs=connect_kwargs)
-        self.test_connection(connection)
-
-        return connection
+        def is_retryable(exc):
+            if isinstance(exc, SSHConnectionError):
+                return exc.transient
+            return idempotent and isinstance(exc, RemoteTransportError)
 
-    def test_connection(self, connection=None):
-        """ Connection is lazy, so **we** need to check it can be opened."""
-        connect_kwargs = ({'key_filename': [self.key_file_path]} if
-                          self.key_file_path else {'password': self.password})
-        connection = connection or Connection(
-            host=self.private_ip, user=self.username, port=22,
-            connect_kwargs=connect_kwargs)
+        connections = self.transport.connections
+        start_time = time.time()
         try:
-            connection.open()
-        except (socket_error, AuthenticationException) as exc:
-            raise ClusterInstallError(
-                "SSH: could not connect to {host} (username: {user}, "
-                "key: {key}): {exc}".format(
-                    host=self.private_ip, user=self.username,
-                    key=self.key_file_path, exc=exc))
+            with remote_span(self.private_ip, operation):
+                return call_with_retries(attempt, operation,
+                                         retry_policy or REMOTE_RETRY_POLICY,
+                                         is_retryable, host=self.private_ip,
+                                         deadline=run_deadline)
         finally:
-            connection.close()
+            remote_stats.record(
+                self.private_ip, wait_time=time.time() - start_time,
+                connections=self.transport.connections - connections,
+                **counters)
+
+    def test_connection(self):
+        """ Connection is lazy, so **we** need to check it can be opened."""
+        self._call_with_retries(
+            lambda: self.transport.test_connection(
+                run_deadline.bound(CONNECT_TIMEOUT)),
+            'Connecting', True)
+
+    def is_alive(self, timeout=LIVENESS_TIMEOUT):
+        """Check the host is up, without authenticating.
+
+        This is a cheap probe used to tell a dead or partitioned host from a
+        failure of a single SSH session.
+        """
+        return self.transport.is_alive(timeout)
 
     def run_command(self,
                     command,
                     hide_stdout=False,
                     use_sudo=False,
-                    ignore_failure=False):
-        hide = True if hide_stdout else 'stderr'
-        with self._get_connection() as connection:
-            logger.debug('Running `%s` on %s', command, self.private_ip)
-            result = (connection.sudo(command, warn=True, hide=hide)
-                      if use_sudo else
-                      connection.run(command, warn=True, hide=hide))
-            if result.failed and not ignore_failure:
-                raise ClusterInstallError(
-                    'The command `{0}` on host {1} failed with the error '
-                    '{2}'.format(command, self.private_ip, result.stderr))
+                    ignore_failure=False,
+                    timeout=COMMAND_TIMEOUT,
+                    idempotent=False,
+                    retry_policy=None):
+        """Run a command on the host.
+
+        :param timeout: The number of seconds the command may run for. It is
+                        bounded by the run deadline. None means no timeout.
+        :param idempotent: Whether the command can safely run again if the
+                           connection breaks while it's running.
+        :param retry_policy: A RetryPolicy overriding the default one.
+
+        The commands which may run for longer than COMMAND_TIMEOUT, such as
+        `cfy_manager install`, mostly wait for the host, so they don't take
+        a slot of the concurrency limit, and their latency isn't taken for
+        a sign of overload.
+        """
+        return self._call_with_retries(
+            lambda: self._run_command(command, hide_stdout, use_sudo,
+                                      ignore_failure, timeout),
+            'Running `{0}`'.format(command), idempotent, retry_policy,
+            metered=timeout is not None and timeout <= COMMAND_TIMEOUT,
+            commands=1, sudo_commands=1 if use_sudo else 0)
+
+    def _run_command(self, command, hide_stdout, use_sudo, ignore_failure,
+                     timeout):
+        logger.debug('Running `%s` on %s', command, self.private_ip)
+        result = self.transport.run(command, use_sudo, hide_stdout,
+                                    run_deadline.bound(CONNECT_TIMEOUT),
+                                    run_deadline.bound(timeout))
+        if result.failed and not ignore_failure:
+            raise ClusterInstallError(
+                'The command `{0}` on host {1} failed with the error '
+                '{2}'.format(command, self.private_ip, result.stderr))
 
-            return result
+        return result
 
     def put_file(self, local_path, remote_path):
         if not isfile(local_path):
@@ -148,16 +280,19 @@ class VM(object):
                          self.private_ip)
 
         else:
-            with self._get_connection() as connection:
-                logger.debug('Copying %s to %s on host %s',
-                             local_path, remote_path, self.private_ip)
-                connection.put(expanduser(local_path), remote_path)
+            logger.debug('Copying %s to %s on host %s',
+                         local_path, remote_path, self.private_ip)
+            self._upload(
+                lambda: self.transport.put_file(
+                    local_path, remote_path,
+                    run_deadline.bound(CONNECT_TIMEOUT)),
+                local_path, files=1, bytes=getsize(local_path))
 
     def put_dir(self, local_dir_path, remote_dir_path):
         """Copy a local directory to a remote host.
 
-        This function wraps the recursive function _put_dir(). This way
-        we open a connection only once instead of in each recursion step.
+        The transport copies the whole directory in a single operation. This
+        way we open a connection only once instead of once per file.
 
         :param local_dir_path: An existing local directory path.
         :param remote_dir_path: A directory path on the remote host. If the
@@ -173,31 +308,71 @@ class VM(object):
         else:
             logger.debug('Copying %s to %s on host %s',
                          local_dir_path, remote_dir_path, self.private_ip)
-            self._put_dir(self._get_connection(), local_dir_path,
-                          remote_dir_path)
-
-    def _put_dir(self, connection, local_dir_path, remote_dir_path):
-        connection.run('mkdir -p {}'. format(remote_dir_path), warn=True,
-                       hide='stderr')
-        for file_name in os.listdir(local_dir_path):
-            object_path = join(local_dir_path, file_name)
-            if isfile(object_path):
-                connection.put(expanduser(join(local_dir_path, file_name)),
-                               remote_dir_path)
-            elif isdir(object_path):
-                self._put_dir(connection, object_path,
-                              join(remote_dir_path, file_name))
+            self._upload(
+                lambda: self.transport.put_dir(
+                    local_dir_path, remote_dir_path,
+                    run_deadline.bound(CONNECT_TIMEOUT)),
+                local_dir_path, **_get_dir_size(local_dir_path))
+
+    def _upload(self, func, local_path, **counters):
+        """Upload with retries, and record the throughput achieved."""
+        start_time = time.time()
+        self._call_with_retries(func, 'Copying {0}'.format(local_path), True,
+                                **counters)
+        transfer_stats.record(self.private_ip, local_path, counters['bytes'],
+                              time.time() - start_time)
 
     def file_exists(self, file_path):
         result = self.run_command(
-            'test -e {}'.format(file_path), ignore_failure=True)
+            'test -e {}'.format(file_path), ignore_failure=True,
+            idempotent=True)
         return not result.failed
 
 
-def get_dict_from_yaml(yaml_path):
+def _get_dir_size(dir_path):
+    files = size = 0
+    for path, _, file_names in os.walk(dir_path):
+        files += len(file_names)
+        size += sum(getsize(join(path, file_name))
+                    for file_name in file_names)
+    return {'files': files, 'bytes': size}
+
+
+class YamlCache(object):
+    """The YAML files parsed by a long running process (the daemon), kept
+    as long as the file's modification time and size are the same.
+
+    Each caller gets a copy, since the callers change the dicts.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, yaml_path, load):
+        file_stat = os.stat(yaml_path)
+        key = (file_stat.st_mtime_ns, file_stat.st_size)
+        with self._lock:
+            entry = self._entries.get(yaml_path)
+        if entry is None or entry[0] != key:
+            entry = (key, load(yaml_path))
+            with self._lock:
+                self._entries[yaml_path] = entry
+        return deepcopy(entry[1])
+
+
+yaml_cache = YamlCache()
+
+
+def _load_yaml(yaml_path):
     with open(yaml_path) as yaml_file:
-        yaml_dict = yaml.load(yaml_file, yaml.Loader)
-    return yaml_dict
+        return yaml.load(yaml_file, yaml.Loader)
+
+
+def get_dict_from_yaml(yaml_path):
+    if yaml_cache.enabled:
+        return yaml_cache.get(abspath(yaml_path), _load_yaml)
+    return _load_yaml(yaml_path)
 
 
 def write_dict_to_yaml_file(content, yaml_path):
@@ -37,12 +37,18 @@ setup(
     description="Install a Cloudify cluster",
     entry_points={
         'console_scripts': [
-            'cfy_cluster_manager = cfy_cluster_manager.main:main'
+            'cfy_cluster_manager = cfy_cluster_manager.client:main',
+            'cfy_cluster_manager_bench = cfy_cluster_manager.benchmark:main'
         ]
     },
     install_requires=[
         'pyyaml>=5.3.0,<5.4.0',
         'jinja2>=2.11.0,<2.12.0',
-        'fabric>=2.5.0,<2.6.0'
-    ]
+        'fabric>=2.5.0,<2.6.0',
+        # The SSH transport's factory is passed to paramiko's connect()
+        'paramiko>=3.2'
+    ],
+    extras_require={
+        'asyncssh': ['asyncssh>=2.5.0,<3.0.0']
+    }
 )
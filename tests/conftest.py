@@ -1,3 +1,4 @@
+import struct
 from os.path import dirname, join
 
 import yaml
@@ -76,6 +77,38 @@ def external_db_ca_path(tmp_certs_dir):
     return str(external_db_ca_path)
 
 
+def _rpm_header(entries):
+    """An RPM header of (tag, type, value) entries, each a string or an
+    int32."""
+    index, store = b'', b''
+    for tag, type_, value in entries:
+        index += struct.pack('>iiii', tag, type_, len(store), 1)
+        store += (struct.pack('>i', value) if type_ == 4
+                  else value.encode('utf-8') + b'\0')
+    return (b'\x8e\xad\xe8\x01\0\0\0\0' +
+            struct.pack('>II', len(index) // 16, len(store)) + index + store)
+
+
+def _write_rpm(path, version='5.1.2', release='ga', epoch=None,
+               name='cloudify-manager-install', sha1=None, payload=b''):
+    entries = [(1000, 6, name), (1001, 6, version), (1002, 6, release),
+               (1022, 6, 'x86_64')]
+    if epoch is not None:
+        entries.append((1003, 4, epoch))
+    signature = _rpm_header([(269, 6, sha1)] if sha1 else [])
+    with open(str(path), 'wb') as rpm_file:
+        rpm_file.write(b'\xed\xab\xee\xdb' + b'\0' * 92)
+        rpm_file.write(signature + b'\0' * (-len(signature) % 8))
+        rpm_file.write(_rpm_header(entries) + payload)
+    return str(path)
+
+
+@pytest.fixture()
+def write_rpm():
+    """Write a minimal RPM of a package to a path."""
+    return _write_rpm
+
+
 @pytest.fixture()
 def three_nodes_config_dict(basic_config_dict):
     return _get_config_dict('three_nodes_config.yaml', basic_config_dict)
@@ -0,0 +1,105 @@
+import asyncio
+import subprocess
+
+import pytest
+
+from cfy_cluster_manager.exceptions import (CommandTimeoutError,
+                                            SSHConnectionError)
+
+asyncssh = pytest.importorskip('asyncssh')
+
+from cfy_cluster_manager.asyncssh_transport import (  # noqa: E402
+    AsyncSSHTransport, get_event_loop_thread, run_concurrently)
+
+
+class _Server(asyncssh.SSHServer):
+    def begin_auth(self, username):
+        return True
+
+    def password_auth_supported(self):
+        return True
+
+    def validate_password(self, username, password):
+        return password == 'password'
+
+
+async def _handle_process(process):
+    proc = await asyncio.create_subprocess_shell(
+        process.command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    process.stdout.write(stdout.decode('utf-8'))
+    process.stderr.write(stderr.decode('utf-8'))
+    process.exit(proc.returncode)
+
+
+@pytest.fixture()
+def ssh_port():
+    async def _start_server():
+        server = await asyncssh.create_server(
+            _Server, '127.0.0.1', 0,
+            server_host_keys=[asyncssh.generate_private_key('ssh-ed25519')],
+            process_factory=_handle_process, sftp_factory=True)
+        return server
+
+    async def _stop_server():
+        # The server belongs to the event loop's thread
+        server.close()
+        await server.wait_closed()
+
+    server = get_event_loop_thread().run(_start_server())
+    yield server.sockets[0].getsockname()[1]
+    get_event_loop_thread().run(_stop_server())
+
+
+def _get_transport(port, password='password'):
+    return AsyncSSHTransport('127.0.0.1', 'user', password=password,
+                             port=port)
+
+
+def test_run(ssh_port):
+    transport = _get_transport(ssh_port)
+    result = transport.run('echo hello', False, True, 5, 5)
+    assert result.stdout == 'hello\n'
+    assert not result.failed
+    assert transport.run('exit 3', False, True, 5, 5).return_code == 3
+    transport.close()
+
+
+def test_put_dir(ssh_port, tmp_path):
+    local_dir = tmp_path / 'local'
+    (local_dir / 'sub').mkdir(parents=True)
+    (local_dir / 'a.txt').write_text(u'a')
+    (local_dir / 'sub' / 'b.txt').write_text(u'b')
+    remote_dir = tmp_path / 'remote'
+
+    transport = _get_transport(ssh_port)
+    transport.put_dir(str(local_dir), str(remote_dir), 5)
+    assert (remote_dir / 'a.txt').read_text() == u'a'
+    assert (remote_dir / 'sub' / 'b.txt').read_text() == u'b'
+    transport.close()
+
+
+def test_concurrent_operations_share_a_connection(ssh_port):
+    transport = _get_transport(ssh_port)
+    results = run_concurrently(
+        [transport.async_run('echo {0}'.format(i), timeout=5)
+         for i in range(20)])
+    assert [result.stdout for result in results] == [
+        '{0}\n'.format(i) for i in range(20)]
+    transport.close()
+
+
+def test_bad_credentials_are_not_transient(ssh_port):
+    transport = _get_transport(ssh_port, password='wrong')
+    with pytest.raises(SSHConnectionError) as excinfo:
+        transport.test_connection(5)
+    assert not excinfo.value.transient
+
+
+def test_timeout(ssh_port):
+    transport = _get_transport(ssh_port)
+    with pytest.raises(CommandTimeoutError):
+        transport.run('sleep 5', False, True, 5, 0.5)
+    # The connection is still usable after a command timed out
+    assert not transport.run('true', False, True, 5, 5).failed
+    transport.close()
@@ -0,0 +1,58 @@
+import io
+import json
+from os.path import dirname, join
+
+from cfy_cluster_manager.benchmark import (COUNTERS, compare_results,
+                                           run_benchmarks,
+                                           run_protocol_scenario,
+                                           run_throughput_scenario)
+
+BASELINE_PATH = join(dirname(dirname(__file__)), 'benchmarks',
+                     'baseline.json')
+
+
+def test_orchestration_cost_did_not_regress():
+    """The remote operations count doesn't depend on the latency, so it's
+    checked against the baseline without simulating any."""
+    with open(BASELINE_PATH) as baseline_file:
+        baseline = json.load(baseline_file)
+    results = run_benchmarks(['three-nodes'], ['validate', 'install'],
+                             latency=0, bandwidth=None, rpm_size=1024 * 1024,
+                             poll_interval=0.01)
+
+    assert compare_results(results, baseline, metrics=COUNTERS) == []
+
+
+def test_compare_results():
+    baseline = {'results': {'three-nodes/install': {'commands': 10,
+                                                    'handshakes': 10}}}
+    results = {'results': {'three-nodes/install': {'commands': 12,
+                                                   'handshakes': 10}}}
+
+    regressions = compare_results(results, baseline, tolerance=0.1,
+                                  metrics=('commands', 'handshakes'))
+
+    assert regressions == [
+        'three-nodes/install: commands went up from 10 to 12']
+
+
+def test_protocol_scenario(monkeypatch):
+    monkeypatch.setattr('sys.stdin', io.StringIO())
+    result = run_protocol_scenario('fabric', latency=0, file_size=100,
+                                   commands=2, files=2)
+
+    # Every fabric operation opens its own connection: 2 commands, 2 checks
+    # whether the uploaded paths exist and 2 uploads
+    assert result['handshakes'] == 6
+    assert result['sftp_bytes'] == 300
+
+
+def test_throughput_scenario(monkeypatch):
+    monkeypatch.setattr('sys.stdin', io.StringIO())
+    result = run_throughput_scenario('fabric', latency=0.01,
+                                     file_size=1024 ** 2)
+
+    # 8 writes of 128KiB, checking whether the remote path is a directory,
+    # and opening, closing and setting the mode of the file
+    assert result['sftp_requests'] == 8 + 4
+    assert result['throughput'] > 0
@@ -0,0 +1,124 @@
+import time
+import threading
+
+import pytest
+
+from cfy_cluster_manager.concurrency import AdaptiveLimiter
+from cfy_cluster_manager.exceptions import SSHConnectionError
+
+
+def _run(limiter, operation='Running `test -e /tmp`', duration=0, size=0,
+         error=None, node_type=None):
+    try:
+        with limiter.slot(operation, size, node_type):
+            time.sleep(duration)
+            if error:
+                raise error
+    except SSHConnectionError:
+        pass
+
+
+def test_additive_increase_up_to_the_ceiling():
+    limiter = AdaptiveLimiter(floor=1, ceiling=3)
+    for _ in range(10):
+        _run(limiter)
+
+    assert limiter.limit == 3
+    assert [(decision.old_limit, decision.new_limit)
+            for decision in limiter.decisions] == [(1, 2), (2, 3)]
+
+
+def test_multiplicative_decrease_on_connection_failures():
+    limiter = AdaptiveLimiter(floor=1, ceiling=8)
+    limiter.limit = 8
+    started = threading.Event()
+    release = threading.Event()
+
+    def in_flight_failure():
+        with pytest.raises(SSHConnectionError):
+            with limiter.slot('Connecting'):
+                started.set()
+                release.wait()
+                raise SSHConnectionError('Connection reset by peer')
+
+    thread = threading.Thread(target=in_flight_failure)
+    thread.start()
+    started.wait()
+    _run(limiter, 'Connecting', error=SSHConnectionError('MaxStartups'))
+    assert limiter.limit == 4
+    # A failure of an operation started before the decrease is ignored
+    release.set()
+    thread.join()
+    assert limiter.limit == 4
+
+    _run(limiter, 'Connecting', error=SSHConnectionError('MaxStartups'))
+    assert limiter.limit == 2
+    assert 'SSH connection failed' in limiter.decisions[-1].reason
+    # Failures which aren't a sign of overload are ignored
+    _run(limiter, 'Connecting', error=SSHConnectionError(
+        'Authentication failed', transient=False))
+    assert limiter.limit == 2
+
+
+def test_decrease_on_latency_growth():
+    limiter = AdaptiveLimiter(floor=1, ceiling=8)
+    limiter.limit = 4
+    for _ in range(4):
+        _run(limiter, 'Running `systemctl status unit`')
+    assert limiter.limit == 5
+    for _ in range(5):
+        _run(limiter, 'Running `systemctl status unit`', duration=0.2)
+
+    assert limiter.limit == 2
+    assert 'latency' in limiter.decisions[-1].reason
+
+
+def test_latency_is_compared_per_node_type():
+    limiter = AdaptiveLimiter(floor=1, ceiling=8)
+    limiter.limit = 4
+    for _ in range(4):
+        _run(limiter, 'Running `cfy_manager status`', node_type='postgresql')
+    for _ in range(5):
+        _run(limiter, 'Running `cfy_manager status`', duration=0.2,
+             node_type='manager')
+
+    assert limiter.limit == 6
+    assert not any('latency grew' in decision.reason
+                   for decision in limiter.decisions)
+
+
+def test_saturated_uploads_stop_the_growth():
+    limiter = AdaptiveLimiter(floor=1, ceiling=8)
+    limiter._best_throughput = 10 ** 9
+    limiter._best_limit = 1
+    limiter.limit = 2
+    for _ in range(6):
+        _run(limiter, 'Copying /tmp/rpm', duration=0.01, size=1000)
+
+    assert limiter.limit == 2
+    assert not limiter.decisions
+
+
+def test_limit_is_respected():
+    limiter = AdaptiveLimiter(floor=2, ceiling=2)
+    in_flight = []
+    lock = threading.Lock()
+
+    def operation():
+        with limiter.slot('Running `sleep`'):
+            with lock:
+                in_flight.append(limiter.in_flight)
+            time.sleep(0.02)
+
+    threads = [threading.Thread(target=operation) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(in_flight) == 2
+
+
+def test_configure_validates_the_bounds():
+    with pytest.raises(ValueError):
+        AdaptiveLimiter(floor=4, ceiling=2)
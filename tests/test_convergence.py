@@ -0,0 +1,92 @@
+from collections import OrderedDict
+
+import mock
+
+from cfy_cluster_manager.convergence import (get_actions, get_marker_digest,
+                                             NodeState)
+from cfy_cluster_manager.rpm_header import RpmPackage
+
+RPM = RpmPackage('cloudify-manager-install', '5.1.2', 'ga')
+OLD_RPM = RpmPackage('cloudify-manager-install', '5.1.1', 'ga')
+
+
+def _host_instances(names_per_host):
+    host_instances = OrderedDict()
+    for host, names in names_per_host:
+        host_instances[host] = []
+        for name in names:
+            instance = mock.Mock(private_ip=host)
+            instance.name = name
+            host_instances[host].append(instance)
+    return host_instances
+
+
+def _converged_state(digest, rpm=RPM):
+    marker_digest = get_marker_digest(digest)
+    return NodeState(installed=True, uploaded_digest=marker_digest,
+                     applied_digest=marker_digest, rpm=rpm)
+
+
+def test_converged_nodes_need_nothing():
+    host_instances = _host_instances((('10.0.0.1', ['manager-1']),))
+    instance = host_instances['10.0.0.1'][0]
+    states = {instance: _converged_state('digest')}
+
+    assert get_actions(host_instances, states, {instance: 'digest'},
+                       RPM) == {}
+
+
+def test_new_host_is_installed():
+    host_instances = _host_instances((
+        ('10.0.0.1', ['postgresql-1', 'rabbitmq-1', 'manager-1']),))
+    states = dict((instance, NodeState())
+                  for instance in host_instances['10.0.0.1'])
+    digests = dict((instance, 'digest') for instance in states)
+
+    actions = get_actions(host_instances, states, digests, RPM)
+
+    # The host is uploaded to and has the RPM installed once
+    assert [(instance.name, steps) for instance, steps in actions.items()] \
+        == [('postgresql-1',
+             ['upload', 'rpm install', 'cfy_manager install']),
+            ('rabbitmq-1', ['cfy_manager install']),
+            ('manager-1', ['cfy_manager install'])]
+
+
+def test_changed_node_is_configured():
+    host_instances = _host_instances((('10.0.0.1', ['manager-1']),
+                                      ('10.0.0.2', ['manager-2'])))
+    first, second = [instances[0] for instances in host_instances.values()]
+    states = {first: _converged_state('old'),
+              second: _converged_state('digest')}
+    digests = {first: 'digest', second: 'digest'}
+
+    assert get_actions(host_instances, states, digests, RPM) == {
+        first: ['upload', 'cfy_manager configure']}
+
+
+def test_failed_configure_is_retried():
+    host_instances = _host_instances((('10.0.0.1', ['manager-1']),))
+    instance = host_instances['10.0.0.1'][0]
+    # The new files were uploaded, but weren't applied
+    state = _converged_state('digest')
+    state.applied_digest = get_marker_digest('old')
+
+    assert get_actions(host_instances, {instance: state},
+                       {instance: 'digest'}, RPM) == {
+        instance: ['cfy_manager configure']}
+
+
+def test_installed_nodes_keep_their_rpm():
+    host_instances = _host_instances((('10.0.0.1', ['manager-1']),
+                                      ('10.0.0.2', ['manager-2'])))
+    first, second = [instances[0] for instances in host_instances.values()]
+    states = {first: _converged_state('digest', OLD_RPM),
+              second: NodeState(rpm=OLD_RPM)}
+    digests = {first: 'digest', second: 'digest'}
+
+    assert get_actions(host_instances, states, digests, RPM) == {
+        second: ['upload', 'rpm install', 'cfy_manager install']}
+    # Any version is accepted if the RPM's header couldn't be read
+    assert get_actions(host_instances, states, digests, None) == {
+        second: ['upload', 'cfy_manager install']}
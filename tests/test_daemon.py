@@ -0,0 +1,166 @@
+import io
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import threading
+
+import pytest
+
+from cfy_cluster_manager import main
+from cfy_cluster_manager.client import send_command
+from cfy_cluster_manager.daemon import ClusterManagerDaemon
+from cfy_cluster_manager.logger import get_cfy_cluster_manager_logger
+from cfy_cluster_manager.retry import (call_with_retries, retry_budget,
+                                       RetryPolicy)
+from cfy_cluster_manager.utils import ClusterInstallError, YamlCache
+
+logger = get_cfy_cluster_manager_logger()
+
+
+def _run_argv(argv):
+    logger.info('Running %s', ' '.join(argv))
+    logger.debug('Verbose output')
+    return 3 if 'fail' in argv else 0
+
+
+@pytest.fixture()
+def socket_path(tmp_path, monkeypatch, caplog):
+    caplog.set_level(logging.DEBUG)
+    monkeypatch.chdir(tmp_path)
+    return str(tmp_path / 'daemon.sock')
+
+
+def _start_daemon(socket_path, run_argv):
+    daemon = ClusterManagerDaemon(socket_path, run_argv)
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    return daemon, thread
+
+
+def _stop_daemon(daemon, thread):
+    daemon.shutdown()
+    thread.join()
+    daemon.server_close()
+
+
+@pytest.fixture()
+def daemon(socket_path):
+    daemon, thread = _start_daemon(socket_path, _run_argv)
+    yield daemon
+    _stop_daemon(daemon, thread)
+
+
+def test_command_runs_on_daemon(daemon, socket_path):
+    output = io.StringIO()
+
+    assert send_command(['status', '--config-path', 'cluster.yaml'],
+                        socket_path, output) == 0
+    assert 'INFO - Running status --config-path cluster.yaml' in \
+        output.getvalue()
+    assert 'Verbose output' not in output.getvalue()
+
+    output = io.StringIO()
+    assert send_command(['install', 'fail', '-v'], socket_path, output) == 3
+    assert 'DEBUG - Verbose output' in output.getvalue()
+
+
+def test_commands_run_locally(daemon, socket_path, tmp_path, monkeypatch):
+    # Commands the daemon doesn't serve
+    assert send_command(['remove'], socket_path) is None
+    assert send_command(['install', '--help'], socket_path) is None
+    assert send_command([], socket_path) is None
+    # No daemon is listening
+    assert send_command(['status'], str(tmp_path / 'other.sock')) is None
+    # The daemon serves the directory it was started in only
+    other_dir = tmp_path / 'other'
+    other_dir.mkdir()
+    monkeypatch.chdir(other_dir)
+    assert send_command(['status'], socket_path) is None
+
+
+def test_each_command_has_its_retry_budget(socket_path, monkeypatch):
+    def run_args(parser, args):
+        failures = [ValueError('flaky')]
+
+        def flaky():
+            if failures:
+                raise failures.pop()
+
+        call_with_retries(flaky, 'Flaky', RetryPolicy(2, base_delay=0),
+                          lambda exc: True)
+        # The command spends the rest of the budget
+        while retry_budget.consume():
+            pass
+
+    monkeypatch.setattr(main, 'run_args', run_args)
+    daemon, thread = _start_daemon(socket_path, main._run_argv)
+    try:
+        assert send_command(['status'], socket_path, io.StringIO()) == 0
+        assert send_command(['status'], socket_path, io.StringIO()) == 0
+    finally:
+        _stop_daemon(daemon, thread)
+        retry_budget.reset()
+
+
+def test_command_exit_is_its_exit_code(socket_path, monkeypatch):
+    monkeypatch.setattr(main, 'run_args', lambda parser, args: sys.exit(4))
+    daemon, thread = _start_daemon(socket_path, main._run_argv)
+    try:
+        assert send_command(['status'], socket_path, io.StringIO()) == 4
+        # The daemon's thread survived it
+        assert send_command(['status'], socket_path, io.StringIO()) == 4
+    finally:
+        _stop_daemon(daemon, thread)
+
+
+def test_serve_stops_on_sigterm(socket_path, monkeypatch):
+    # Enabled by serve
+    monkeypatch.setattr(main.yaml_cache, 'enabled', False)
+    monkeypatch.setattr(main.transport_pool, 'enabled', False)
+
+    def terminate():
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    threading.Thread(target=terminate).start()
+    main.serve(socket_path)
+
+    assert not os.path.exists(socket_path)
+    assert signal.getsignal(signal.SIGTERM) == previous_handler
+
+
+def test_stale_socket_is_replaced(socket_path):
+    stale_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale_socket.bind(socket_path)
+    stale_socket.close()
+
+    daemon = ClusterManagerDaemon(socket_path, _run_argv)
+    try:
+        with pytest.raises(ClusterInstallError, match='already listening'):
+            ClusterManagerDaemon(socket_path, _run_argv)
+    finally:
+        daemon.server_close()
+
+
+def test_yaml_cache(tmp_path):
+    yaml_path = tmp_path / 'config.yaml'
+    yaml_path.write_text(u'nodes: [a]\n')
+    loads = []
+
+    def load(path):
+        loads.append(path)
+        return {'nodes': ['a']}
+
+    cache = YamlCache()
+    first = cache.get(str(yaml_path), load)
+    first['nodes'].append('b')
+    assert cache.get(str(yaml_path), load) == {'nodes': ['a']}
+    assert len(loads) == 1
+    yaml_path.write_text(u'nodes: [a, c]\n')
+    cache.get(str(yaml_path), load)
+    assert len(loads) == 2
@@ -0,0 +1,914 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from os.path import exists, join, relpath
+
+import mock
+import pytest
+import yaml
+
+from cfy_cluster_manager import main, profiler
+from cfy_cluster_manager.concurrency import (concurrency_limiter,
+                                             DEFAULT_MAX_PARALLEL,
+                                             DEFAULT_MIN_PARALLEL)
+from cfy_cluster_manager.fake_transport import (FakeTransport,
+                                                get_fake_cluster)
+from cfy_cluster_manager.journal import get_config_digest, JOURNAL_NAME
+from cfy_cluster_manager.remote_stats import remote_stats
+from cfy_cluster_manager.throttle import transfer_stats, upload_throttle
+from cfy_cluster_manager.timing_history import step_timings, TimingHistory
+from cfy_cluster_manager.utils import (ClusterInstallError,
+                                       SSHConnectionError,
+                                       write_dict_to_yaml_file)
+
+
+@pytest.fixture()
+def fake_root_dir(tmp_path):
+    return str(tmp_path / 'fake_cluster')
+
+
+@pytest.fixture(autouse=True)
+def local_environment(monkeypatch, tmp_path):
+    """Redirect the local side of the cluster manager to a temp directory."""
+    install_dir = tmp_path / 'cloudify_cluster_manager'
+    certs_dir = install_dir / main.CERTS_DIR_NAME
+    paths = {
+        'CLUSTER_INSTALL_DIR': str(install_dir),
+        'RPM_PATH': str(install_dir / main.RPM_NAME),
+        'CERTS_DIR': str(certs_dir),
+        'CONFIG_FILES_DIR': str(install_dir / main.CONFIG_FILES),
+        'CA_PATH': str(certs_dir / 'ca.pem'),
+        'EXTERNAL_DB_CA_PATH': str(certs_dir / 'external_db_ca.pem'),
+        'LDAP_CA_PATH': str(certs_dir / 'ldap_ca.pem'),
+        'CREDENTIALS_FILE_PATH': str(tmp_path / 'secret_credentials.yaml'),
+    }
+    for name, path in paths.items():
+        monkeypatch.setattr(main, name, path)
+    monkeypatch.setattr(main, 'UNIT_POLL_INTERVAL', 0.01)
+    monkeypatch.setattr(main, 'yum_is_present', mock.Mock(return_value=True))
+    monkeypatch.setattr(main, '_install_cloudify_locally', mock.Mock(
+        side_effect=lambda rpm_path: open(main.RPM_PATH, 'wb').close()))
+    monkeypatch.setattr(main, '_generate_certs', mock.Mock())
+    remote_stats.reset()
+    concurrency_limiter.configure(DEFAULT_MIN_PARALLEL, DEFAULT_MAX_PARALLEL)
+    upload_throttle.configure()
+    transfer_stats.reset()
+
+
+def _write_config(config_dict, tmp_path, **transport_options):
+    config_dict['transport'] = 'fake'
+    config_dict['transport_options'] = transport_options
+    config_path = str(tmp_path / 'cluster_config.yaml')
+    write_dict_to_yaml_file(config_dict, config_path)
+    return config_path
+
+
+def _get_cluster(config_path):
+    """The fake cluster that runs of a configuration file operate."""
+    with open(config_path) as config_file:
+        return get_fake_cluster(
+            **yaml.safe_load(config_file)['transport_options'])
+
+
+def _installed_services(cluster, host):
+    fake_host = cluster.get_host(host)
+    return fake_host._get_services('/etc/cloudify/config.yaml')
+
+
+@pytest.mark.parametrize('config_fixture', ['three_nodes_config_dict',
+                                            'nine_nodes_config_dict'])
+def test_install_and_remove(config_fixture, request, tmp_path,
+                            fake_root_dir):
+    config_dict = request.getfixturevalue(config_fixture)
+    config_path = _write_config(config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+
+    cluster = _get_cluster(config_path)
+    for node_dict in config_dict['existing_vms'].values():
+        host = cluster.get_host(node_dict['private_ip'])
+        assert host._load_state()['rpm_version'] == '5.1.2'
+        assert _installed_services(cluster, node_dict['private_ip'])
+    # Every remote operation is accounted for in the run summary
+    totals = cluster.totals()
+    summary_totals = remote_stats.totals()
+    assert totals['handshakes'] == summary_totals['connections']
+    for counter in 'commands', 'sudo_commands', 'files', 'bytes':
+        assert totals[counter] == summary_totals[counter]
+
+    main.remove(config_path, verbose=False)
+    for node_dict in config_dict['existing_vms'].values():
+        host = cluster.get_host(node_dict['private_ip'])
+        assert host._load_state()['rpm_version'] is None
+
+
+def test_profiled_install(three_nodes_config_dict, tmp_path, fake_root_dir):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir, latency=0.01)
+    profile_path = str(tmp_path / 'install.folded')
+    profiler.start_profiling()
+    try:
+        main.install(config_path, override=False, only_validate=False,
+                     verbose=False)
+    finally:
+        profiler.stop_profiling(profile_path)
+
+    with open(profile_path + profiler.SPANS_SUFFIX) as spans_file:
+        spans = json.load(spans_file)
+    node_ips = set(node_dict['private_ip'] for node_dict in
+                   three_nodes_config_dict['existing_vms'].values())
+    assert set(span['host'] for span in spans) == node_ips
+    assert (sum(span['wall_time'] for span in spans) <=
+            remote_stats.totals()['wait_time'] + 0.01)
+    with open(profile_path) as profile_file:
+        assert ';remote: ' in profile_file.read()
+
+
+def test_plan_from_history(three_nodes_config_dict, tmp_path, fake_root_dir):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    history_path = str(tmp_path / 'history.db')
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+    TimingHistory(history_path).save(step_timings)
+    # The RPM is installed once per host
+    assert len(step_timings.timings) == 9 * 2 + 3
+
+    steps = main.plan(config_path, history_path=history_path)
+    assert len(steps) == 9 * 3
+    assert set(step.source for step in steps) == {'host'}
+
+
+def test_upgrade(three_nodes_config_dict, tmp_path, fake_root_dir):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+    upgrade_rpm_path = tmp_path / 'upgrade.rpm'
+    upgrade_rpm_path.write_bytes(b'rpm' * 100)
+
+    main.upgrade(config_path, verbose=False,
+                 upgrade_rpm_path=str(upgrade_rpm_path))
+
+    cluster = _get_cluster(config_path)
+    assert cluster.totals()['bytes'] >= 3 * 300
+
+
+def _generate_certs(instances_dict):
+    _write_generated_ca()
+    for path in [
+            path for instances_list in instances_dict.values()
+            for instance in instances_list
+            for path in (instance.cert_path, instance.key_path)]:
+        open(path, 'w').close()
+
+
+@pytest.mark.parametrize('config_fixture', ['three_nodes_config_dict',
+                                            'nine_nodes_config_dict'])
+def test_nodes_get_only_their_own_files(config_fixture, request, tmp_path,
+                                        fake_root_dir, monkeypatch):
+    monkeypatch.setattr(main, '_generate_certs', _generate_certs)
+    config_dict = request.getfixturevalue(config_fixture)
+    config_path = _write_config(config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+
+    cluster = _get_cluster(config_path)
+    for node_name, node_dict in config_dict['existing_vms'].items():
+        host = cluster.get_host(node_dict['private_ip'])
+        install_dir = host.path(main.REMOTE_INSTALL_DIR)
+        files = set(
+            relpath(join(dir_path, file_name), install_dir)
+            for dir_path, _, file_names in os.walk(install_dir)
+            for file_name in file_names)
+        names = ([node_name] if config_fixture == 'nine_nodes_config_dict'
+                 else ['postgresql-' + node_name[-1],
+                       'rabbitmq-' + node_name[-1],
+                       'manager-' + node_name[-1]])
+        expected = set([main.CERTS_DIR_NAME + '/ca.pem', main.RPM_NAME,
+                        main.BUNDLE_DIGEST_NAME])
+        for name in names:
+            expected.update([
+                '{0}/{1}_cert.pem'.format(main.CERTS_DIR_NAME, name),
+                '{0}/{1}_key.pem'.format(main.CERTS_DIR_NAME, name),
+                '{0}/{1}_config.yaml'.format(main.CONFIG_FILES, name),
+                main.NODE_DIGEST_NAME.format(name)])
+            if name.startswith('manager'):
+                expected.add('license.yaml')
+            # The config files refer to the files on the host
+            with open(join(install_dir, main.CONFIG_FILES,
+                           '{0}_config.yaml'.format(name))) as config_file:
+                paths = re.findall(r'_path: (/\S+)', config_file.read())
+            assert join(main.REMOTE_INSTALL_DIR, 'certs/ca.pem') in paths
+            for path in paths:
+                assert exists(host.path(path)), path
+        assert files == expected
+
+
+def test_installed_rpm_is_not_uploaded(three_nodes_config_dict, tmp_path,
+                                       fake_root_dir):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    cluster = _get_cluster(config_path)
+    host = cluster.get_host(
+        three_nodes_config_dict['existing_vms']['node-2']['private_ip'])
+    state = host._load_state()
+    state['rpm_version'] = '5.1.2'
+    host._save_state(state)
+    os.makedirs(host.path(main.BASE_CFY_DIR))
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+
+    assert not exists(host.path(main._get_remote_path(main.RPM_PATH)))
+    assert exists(host.path(main._get_remote_path(join(
+        main.CONFIG_FILES_DIR, 'manager-2_config.yaml'))))
+    assert _installed_services(cluster, host.host)
+
+
+def _install_rpm(host, rpm_path):
+    remote_path = '/tmp/preinstalled.rpm'
+    with open(rpm_path, 'rb') as rpm_file, \
+            open(host.path(remote_path), 'wb') as remote_file:
+        remote_file.write(rpm_file.read())
+    assert host.execute('yum install -y ' + remote_path)[2] == 0
+
+
+def _get_host(cluster, config_dict, node_name):
+    return cluster.get_host(
+        config_dict['existing_vms'][node_name]['private_ip'])
+
+
+def test_only_differing_rpms_are_installed(three_nodes_config_dict, tmp_path,
+                                           fake_root_dir, monkeypatch,
+                                           write_rpm):
+    monkeypatch.setattr(main, '_install_cloudify_locally', mock.Mock(
+        side_effect=lambda rpm_path: write_rpm(main.RPM_PATH, '5.1.2')))
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    cluster = _get_cluster(config_path)
+    same_host = _get_host(cluster, three_nodes_config_dict, 'node-2')
+    _install_rpm(same_host, write_rpm(tmp_path / 'same.rpm', '5.1.2'))
+    drifted_host = _get_host(cluster, three_nodes_config_dict, 'node-3')
+    _install_rpm(drifted_host, write_rpm(tmp_path / 'old.rpm', '5.1.1'))
+
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+
+    remote_rpm_path = main._get_remote_path(main.RPM_PATH)
+    assert not exists(same_host.path(remote_rpm_path))
+    assert exists(drifted_host.path(remote_rpm_path))
+    for node_name in ('node-1', 'node-2', 'node-3'):
+        host = _get_host(cluster, three_nodes_config_dict, node_name)
+        assert host._load_state()['rpm_version'] == '5.1.2'
+        assert _installed_services(cluster, host.host)
+
+
+def test_upgraded_nodes_are_skipped(three_nodes_config_dict, tmp_path,
+                                    fake_root_dir, write_rpm):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+    upgrade_rpm_path = write_rpm(tmp_path / 'upgrade.rpm', '5.1.3',
+                                 payload=b'rpm' * 100)
+    cluster = _get_cluster(config_path)
+    upgraded_host = _get_host(cluster, three_nodes_config_dict, 'node-2')
+    _install_rpm(upgraded_host, upgrade_rpm_path)
+
+    main.upgrade(config_path, verbose=False,
+                 upgrade_rpm_path=upgrade_rpm_path)
+
+    for node_name in ('node-1', 'node-2', 'node-3'):
+        host = _get_host(cluster, three_nodes_config_dict, node_name)
+        assert host._load_state()['rpm_version'] == '5.1.3'
+        uploaded = [file_name for file_name in os.listdir(host.path('/tmp'))
+                    if file_name.endswith(main.UPGRADE_RPM_NAME + '.rpm')]
+        assert len(uploaded) == (0 if host is upgraded_host else 1)
+
+
+def test_fast_reset(three_nodes_config_dict, tmp_path, fake_root_dir,
+                    monkeypatch):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+    install_cloudify_remotely = mock.Mock()
+    monkeypatch.setattr(main, '_install_cloudify_remotely',
+                        install_cloudify_remotely)
+    transfer_stats.reset()
+
+    main.install(config_path, override=True, only_validate=False,
+                 verbose=False, fast_reset=True)
+
+    assert not install_cloudify_remotely.called
+    assert transfer_stats.transfers == []
+    cluster = _get_cluster(config_path)
+    for node_dict in three_nodes_config_dict['existing_vms'].values():
+        assert _installed_services(cluster, node_dict['private_ip'])
+
+
+def test_fast_reset_uploads_changed_bundles(three_nodes_config_dict,
+                                            tmp_path, fake_root_dir):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+    config_file_path = join(main.CONFIG_FILES_DIR, 'manager-1_config.yaml')
+    with open(config_file_path, 'a') as config_file:
+        config_file.write('# Changed\n')
+    transfer_stats.reset()
+
+    main.install(config_path, override=True, only_validate=False,
+                 verbose=False, fast_reset=True)
+
+    node_1 = three_nodes_config_dict['existing_vms']['node-1']['private_ip']
+    assert [transfer.host for transfer in transfer_stats.transfers] == [
+        node_1]
+    host = _get_cluster(config_path).get_host(node_1)
+    with open(host.path(main._get_remote_path(config_file_path))) as \
+            config_file:
+        assert config_file.read().endswith('# Changed\n')
+    # The RPM is still installed, so it's not uploaded again
+    assert not exists(host.path(main._get_remote_path(main.RPM_PATH)))
+
+
+def test_prepare_then_install(three_nodes_config_dict, tmp_path,
+                              fake_root_dir, monkeypatch):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.prepare(config_path, verbose=False)
+
+    assert main._get_staging_journal().is_complete(
+        get_config_digest(config_path))
+    cluster = _get_cluster(config_path)
+    for node_name in ('node-1', 'node-2', 'node-3'):
+        host = _get_host(cluster, three_nodes_config_dict, node_name)
+        assert host._load_state()['rpm_version']
+        assert exists(host.path(join(
+            main.BASE_CFY_DIR, 'manager-{0}_config.yaml'.format(
+                node_name[-1]))))
+        assert not exists(host.path('/etc/cloudify/.installed'))
+
+    transfer_stats.reset()
+    with mock.patch.object(main.CfyNode, 'run_command', autospec=True,
+                           side_effect=main.CfyNode.run_command) as \
+            run_command:
+        main.install(config_path, override=False, only_validate=False,
+                     verbose=False)
+
+    assert transfer_stats.transfers == []
+    commands = [call[0][1] for call in run_command.call_args_list]
+    assert not [command for command in commands
+                if command.startswith('yum') or
+                main._get_remote_path(main.CONFIG_FILES_DIR) in command]
+    for node_dict in three_nodes_config_dict['existing_vms'].values():
+        assert _installed_services(cluster, node_dict['private_ip'])
+    assert not exists(join(main.CLUSTER_INSTALL_DIR, JOURNAL_NAME))
+
+
+def test_failed_prepare_is_resumed(nine_nodes_config_dict, tmp_path,
+                                   fake_root_dir, monkeypatch):
+    config_path = _write_config(nine_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    copy_config_file = main._copy_config_file
+
+    def fail_on_manager_1(instance):
+        if instance.name == 'manager-1':
+            raise ClusterInstallError('Simulated failure')
+        copy_config_file(instance)
+
+    monkeypatch.setattr(main, '_copy_config_file', fail_on_manager_1)
+    with pytest.raises(ClusterInstallError):
+        main.prepare(config_path, verbose=False)
+    staged_nodes = main._get_staging_journal().staged_nodes
+    assert staged_nodes
+    assert 'manager-1' not in staged_nodes
+
+    retried = mock.Mock(side_effect=copy_config_file)
+    monkeypatch.setattr(main, '_copy_config_file', retried)
+    main.prepare(config_path, verbose=False)
+
+    assert set(call[0][0].name for call in retried.call_args_list) == \
+        set(nine_nodes_config_dict['existing_vms']) - set(staged_nodes)
+    assert main._get_staging_journal().is_complete(
+        get_config_digest(config_path))
+
+
+def _reconfigured_nodes(run_command):
+    return [call[0][0].name for call in run_command.call_args_list
+            if call[0][1].startswith('cfy_manager configure')]
+
+
+def test_reconfigure_changed_nodes(three_nodes_config_dict, tmp_path,
+                                   fake_root_dir, generated_certs):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+    three_nodes_config_dict['load_balancer_ip'] = '192.0.2.100'
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+
+    with mock.patch.object(main.CfyNode, 'run_command', autospec=True,
+                           side_effect=main.CfyNode.run_command) as \
+            run_command:
+        main.reconfigure(config_path, verbose=False)
+
+    # The load balancer is only in the queue nodes' and managers' configs
+    assert _reconfigured_nodes(run_command) == [
+        'rabbitmq-1', 'rabbitmq-2', 'rabbitmq-3',
+        'manager-1', 'manager-2', 'manager-3']
+    digest_commands = [call for call in run_command.call_args_list
+                       if call[0][1].startswith('sha256sum')]
+    assert len(digest_commands) == 3
+    host = _get_host(_get_cluster(config_path),
+                     three_nodes_config_dict, 'node-2')
+    with open(host.path('/etc/cloudify/rabbitmq-2_config.yaml')) as \
+            config_file:
+        assert '192.0.2.100' in config_file.read()
+    with open(join(main.CONFIG_FILES_DIR, 'manager-2_config.yaml')) as \
+            config_file:
+        assert '192.0.2.100' in config_file.read()
+
+    with mock.patch.object(main.CfyNode, 'run_command', autospec=True,
+                           side_effect=main.CfyNode.run_command) as \
+            run_command:
+        main.reconfigure(config_path, verbose=False)
+    assert _reconfigured_nodes(run_command) == []
+    # The applied files are recorded like converge records them
+    assert 'cfy_manager' not in _converge(config_path)
+
+
+def test_reconfigure_dry_run(three_nodes_config_dict, tmp_path,
+                             fake_root_dir, caplog):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+    caplog.set_level(logging.INFO, logger=main.logger.name)
+    three_nodes_config_dict['credentials']['manager']['admin_password'] = \
+        'new-password'
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+
+    with mock.patch.object(main.CfyNode, 'run_command', autospec=True,
+                           side_effect=main.CfyNode.run_command) as \
+            run_command:
+        main.reconfigure(config_path, verbose=False, dry_run=True)
+
+    assert _reconfigured_nodes(run_command) == []
+    # The diff is to the config file the node was applied with, not to the
+    # one cfy_manager merged with its defaults
+    assert '--- {0}'.format(join(main.CONFIG_FILES_DIR,
+                                 'manager-1_config.yaml')) in caplog.text
+    assert 'skip_validations' not in caplog.text
+    assert '-    admin_password: <hidden>' in caplog.text
+    assert 'new-password' not in caplog.text
+    assert 'Would reconfigure manager-1, manager-2, manager-3' in \
+        caplog.text
+
+
+def test_reconfigure_unknown_nodes(three_nodes_config_dict, tmp_path,
+                                   fake_root_dir, caplog):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+    # Installed by a version which didn't record the applied files
+    host = _get_host(_get_cluster(config_path), three_nodes_config_dict,
+                     'node-1')
+    os.remove(host.path(join(main.BASE_CFY_DIR,
+                             main.NODE_DIGEST_NAME.format('rabbitmq-1'))))
+
+    with mock.patch.object(main.CfyNode, 'run_command', autospec=True,
+                           side_effect=main.CfyNode.run_command) as \
+            run_command:
+        with pytest.raises(ClusterInstallError, match='reconfigure --all'):
+            main.reconfigure(config_path, verbose=False)
+    assert _reconfigured_nodes(run_command) == []
+    assert 'The files rabbitmq-1 run with are unknown' in caplog.text
+
+    with mock.patch.object(main.CfyNode, 'run_command', autospec=True,
+                           side_effect=main.CfyNode.run_command) as \
+            run_command:
+        main.reconfigure(config_path, verbose=False, reconfigure_all=True)
+    assert len(_reconfigured_nodes(run_command)) == 9
+    with mock.patch.object(main.CfyNode, 'run_command', autospec=True,
+                           side_effect=main.CfyNode.run_command) as \
+            run_command:
+        main.reconfigure(config_path, verbose=False)
+    assert _reconfigured_nodes(run_command) == []
+
+
+def test_reconfigure_needs_the_credentials(three_nodes_config_dict,
+                                           tmp_path, fake_root_dir):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+    os.remove(main.CREDENTIALS_FILE_PATH)
+
+    with pytest.raises(ClusterInstallError, match='manager.admin_password'):
+        main.reconfigure(config_path, verbose=False)
+
+
+def _write_generated_ca():
+    """Leave the CA the mocked certificates generation would have."""
+    if not exists(main.CERTS_DIR):
+        os.makedirs(main.CERTS_DIR)
+    for file_name in ('ca.pem', 'ca.key'):
+        open(join(main.CERTS_DIR, file_name), 'w').close()
+
+
+def _add_vm(config_dict, vm_name, private_ip):
+    config_dict['existing_vms'][vm_name] = {'private_ip': private_ip,
+                                            'public_ip': private_ip}
+
+
+def test_add_node(nine_nodes_config_dict, tmp_path, fake_root_dir):
+    config_path = _write_config(nine_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+    _write_generated_ca()
+    _add_vm(nine_nodes_config_dict, 'manager-4', '192.0.2.20')
+    _add_vm(nine_nodes_config_dict, 'rabbitmq-4', '192.0.2.21')
+    config_path = _write_config(nine_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    transfer_stats.reset()
+
+    with mock.patch.object(main.CfyNode, 'run_command', autospec=True,
+                           side_effect=main.CfyNode.run_command) as \
+            run_command:
+        main.add_node(config_path, ['manager-4', 'rabbitmq-4'],
+                      verbose=False)
+
+    installed = [call[0][0].name for call in run_command.call_args_list
+                 if call[0][1].startswith('systemd-run')]
+    assert installed == ['rabbitmq-4', 'manager-4']
+    assert set(transfer.host for transfer in transfer_stats.transfers) == \
+        set(['192.0.2.20', '192.0.2.21'])
+    generated = main._generate_certs.call_args[0][0]
+    assert [instance.name for instance in main._get_all_instances(
+        generated)] == ['rabbitmq-4', 'manager-4']
+    cluster = _get_cluster(config_path)
+    assert 'manager_service' in _installed_services(cluster, '192.0.2.20')
+    with open(cluster.get_host('192.0.2.21').path(
+            '/etc/cloudify/config.yaml')) as config_file:
+        rabbitmq_config = config_file.read()
+    assert 'join_cluster: rabbitmq-1' in rabbitmq_config
+    assert 'rabbitmq-4' in rabbitmq_config
+    # The other nodes' config files are left as they are
+    with open(join(main.CONFIG_FILES_DIR, 'rabbitmq-1_config.yaml')) as \
+            config_file:
+        assert 'rabbitmq-4' not in config_file.read()
+
+
+def test_add_node_to_three_nodes_cluster(three_nodes_config_dict, tmp_path,
+                                         fake_root_dir):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+    _write_generated_ca()
+    _add_vm(three_nodes_config_dict, 'manager-4', '192.0.2.20')
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+
+    main.add_node(config_path, ['manager-4'], verbose=False)
+
+    cluster = _get_cluster(config_path)
+    assert 'manager_service' in _installed_services(cluster, '192.0.2.20')
+
+    with pytest.raises(ClusterInstallError, match='DB nodes'):
+        main.add_node(config_path, ['postgresql-2'], verbose=False)
+    with pytest.raises(ClusterInstallError, match='named after'):
+        main.add_node(config_path, ['node-1'], verbose=False)
+
+
+def test_nodes_join_their_tier_one_at_a_time(nine_nodes_config_dict,
+                                             tmp_path, fake_root_dir):
+    config_path = _write_config(nine_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir, install_duration=0.1)
+    installs = []
+    start_installation = main._start_cloudify_installation
+    monitor_installation = main._monitor_cloudify_installation
+
+    def start(instance, verbose):
+        installs.append((instance.name, 'start', time.time()))
+        start_installation(instance, verbose)
+
+    def monitor(instance):
+        monitor_installation(instance)
+        installs.append((instance.name, 'end', time.time()))
+
+    with mock.patch.multiple(main, _start_cloudify_installation=start,
+                             _monitor_cloudify_installation=monitor):
+        main.install(config_path, override=False, only_validate=False,
+                     verbose=False, max_parallel=9)
+
+    # No two nodes of a tier run `cfy_manager install` at the same time,
+    # and they run it in their order
+    for node_type in 'postgresql', 'rabbitmq', 'manager':
+        tier_events = [(name, event) for name, event, _ in sorted(
+            installs, key=lambda install: install[2])
+            if name.startswith(node_type)]
+        assert tier_events == [
+            ('{0}-{1}'.format(node_type, i), event)
+            for i in (1, 2, 3) for event in ('start', 'end')]
+
+
+def test_install_colocated_nodes(nine_nodes_config_dict, tmp_path,
+                                 fake_root_dir):
+    vm_dict = nine_nodes_config_dict['existing_vms']['manager-1']
+    ips = {'manager-1': '192.0.2.30', 'manager-2': '192.0.2.31',
+           'rabbitmq-1': '192.0.2.30', 'rabbitmq-2': '192.0.2.31',
+           'postgresql-1': '192.0.2.32'}
+    nine_nodes_config_dict['existing_vms'] = dict(
+        (vm_name, dict(vm_dict, private_ip=ip, public_ip=ip))
+        for vm_name, ip in ips.items())
+    config_path = _write_config(nine_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+
+    with mock.patch.object(main.CfyNode, 'put_dir', autospec=True,
+                           side_effect=main.CfyNode.put_dir) as put_dir:
+        main.install(config_path, override=False, only_validate=False,
+                     verbose=False)
+
+    # A single bundle is uploaded to each host, whatever its nodes
+    assert sorted(call[0][0].private_ip for call in put_dir.call_args_list) \
+        == ['192.0.2.30', '192.0.2.31', '192.0.2.32']
+    cluster = _get_cluster(config_path)
+    host = cluster.get_host('192.0.2.31')
+    installed = os.listdir(host.path('/etc/cloudify/.installed'))
+    assert 'manager_service' in installed
+    assert 'queue_service' in installed
+    assert 'database_service' not in installed
+
+
+def test_upload_rate_per_node(three_nodes_config_dict, tmp_path,
+                              fake_root_dir):
+    node_dict = three_nodes_config_dict['existing_vms']['node-1']
+    node_dict['max_upload_rate'] = '100K'
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    upgrade_rpm_path = tmp_path / 'upgrade.rpm'
+    upgrade_rpm_path.write_bytes(b'rpm' * 10 * 1024)
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+    transfer_stats.reset()
+
+    main.upgrade(config_path, verbose=False,
+                 upgrade_rpm_path=str(upgrade_rpm_path))
+
+    durations = dict((transfer.host, transfer.duration)
+                     for transfer in transfer_stats.transfers)
+    assert len(durations) == 3
+    # 30KiB at 100KiB/s, less the initial burst of 10KiB
+    assert durations.pop(node_dict['private_ip']) >= 0.2
+    assert max(durations.values()) < 0.2
+
+
+def test_invalid_upload_rate(three_nodes_config_dict, tmp_path):
+    three_nodes_config_dict['existing_vms']['node-1']['max_upload_rate'] = \
+        'fast'
+    config_path = _write_config(three_nodes_config_dict, tmp_path)
+    with pytest.raises(ClusterInstallError, match='node-1: Invalid rate'):
+        main.install(config_path, override=False, only_validate=True,
+                     verbose=False)
+
+
+def test_failed_install_is_resumed(three_nodes_config_dict, tmp_path,
+                                   fake_root_dir):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir,
+                                install_failure_rate=1)
+    with pytest.raises(ClusterInstallError,
+                       match='Simulated installation failure'):
+        main.install(config_path, override=False, only_validate=False,
+                     verbose=False)
+
+    _get_cluster(config_path).options['install_failure_rate'] = 0
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+
+
+def test_latency_is_simulated(tmp_path, fake_root_dir):
+    transport = FakeTransport(
+        '192.0.2.10', 'centos', root_dir=fake_root_dir, latency=0.05,
+        handshake_round_trips=2)
+    result = transport.run('test -e /etc', False, True, 10, 10)
+    assert not result.failed
+    stats = transport.cluster.stats['192.0.2.10']
+    assert stats['handshakes'] == 1
+    assert stats['commands'] == 1
+
+
+def test_clusters_are_kept_per_options(fake_root_dir):
+    cluster = get_fake_cluster(fake_root_dir, latency=0.05)
+
+    assert get_fake_cluster(fake_root_dir, latency=0.05) is cluster
+    other_cluster = get_fake_cluster(fake_root_dir, latency=0.5)
+    assert other_cluster is not cluster
+    assert other_cluster.options['latency'] == 0.5
+
+
+def test_slow_commands_dont_hold_the_host(tmp_path, fake_root_dir):
+    transport = FakeTransport('192.0.2.10', 'centos', root_dir=fake_root_dir,
+                              yum_duration=1)
+    rpm_path = tmp_path / 'cloudify.rpm'
+    rpm_path.write_bytes(b'rpm')
+    transport.put_file(str(rpm_path), '/tmp/cloudify.rpm', 10)
+    yum = threading.Thread(target=transport.run, args=(
+        'yum install -y /tmp/cloudify.rpm', True, True, 10, 10))
+    yum.start()
+    try:
+        time.sleep(0.1)
+        start_time = time.time()
+        transport.run('test -e /etc', False, True, 10, 10)
+        assert time.time() - start_time < 0.5
+    finally:
+        yum.join()
+
+
+def test_dead_host(tmp_path, fake_root_dir):
+    transport = FakeTransport(
+        '192.0.2.10', 'centos', root_dir=fake_root_dir,
+        dead_hosts=['192.0.2.10'])
+    assert not transport.is_alive(1)
+    with pytest.raises(SSHConnectionError):
+        transport.test_connection(0)
+
+
+def test_attach_reports_every_failed_unit(three_nodes_config_dict, tmp_path,
+                                          fake_root_dir, caplog):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    status_codes = {'manager-1': 3, 'manager-2': 0, 'manager-3': 0,
+                    'rabbitmq-1': 3, 'postgresql-1': 1}
+    monitored = []
+
+    def monitor(instance):
+        monitored.append(instance.name)
+        if instance.name == 'manager-3':
+            raise ClusterInstallError('manager-3 failed while attached')
+
+    with mock.patch.multiple(
+            main,
+            _get_service_status_code=lambda instance: status_codes.get(
+                instance.name, 4),
+            _get_unit_logs=lambda instance: 'log of ' + instance.name,
+            _monitor_cloudify_installation=monitor):
+        with pytest.raises(ClusterInstallError) as error:
+            main.attach(config_path)
+
+    # The running units are attached to despite the failed ones
+    assert monitored == ['manager-2', 'manager-3']
+    for message in 'log of manager-1', 'log of rabbitmq-1', \
+            'manager-3 failed while attached':
+        assert message in str(error.value)
+    assert 'on postgresql-1 is unknown (exit code 1)' in caplog.text
+
+
+@pytest.fixture()
+def generated_certs(monkeypatch):
+    monkeypatch.setattr(main, '_generate_certs', _generate_certs)
+
+
+def _converge(config_path, **kwargs):
+    with mock.patch.object(main.CfyNode, 'run_command', autospec=True,
+                           side_effect=main.CfyNode.run_command) as \
+            run_command:
+        main.converge(config_path, verbose=False, **kwargs)
+    return [call[0][1].split()[0] for call in run_command.call_args_list]
+
+
+def test_converge_is_idempotent(three_nodes_config_dict, tmp_path,
+                                fake_root_dir, generated_certs):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    commands = _converge(config_path)
+
+    assert commands.count('systemd-run') == 9
+    cluster = _get_cluster(config_path)
+    for node_dict in three_nodes_config_dict['existing_vms'].values():
+        assert 'manager_service' in _installed_services(
+            cluster, node_dict['private_ip'])
+    # Once converged, the hosts are only observed, with two commands each
+    assert sorted(_converge(config_path)) == ['rpm'] * 3 + ['sha256sum'] * 3
+
+
+def test_converge_installed_cluster(three_nodes_config_dict, tmp_path,
+                                    fake_root_dir, generated_certs):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+    assert 'cfy_manager' not in _converge(config_path)
+
+    three_nodes_config_dict['load_balancer_ip'] = '192.0.2.100'
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    with mock.patch.object(main.CfyNode, 'run_command', autospec=True,
+                           side_effect=main.CfyNode.run_command) as \
+            run_command:
+        main.converge(config_path, verbose=False)
+
+    # The load balancer is only in the queue nodes' and managers' configs,
+    # and the nodes of a tier are configured in parallel
+    assert sorted(_reconfigured_nodes(run_command)) == [
+        'manager-1', 'manager-2', 'manager-3',
+        'rabbitmq-1', 'rabbitmq-2', 'rabbitmq-3']
+    host = _get_host(_get_cluster(config_path),
+                     three_nodes_config_dict, 'node-2')
+    with open(host.path('/etc/cloudify/rabbitmq-2_config.yaml')) as \
+            config_file:
+        assert '192.0.2.100' in config_file.read()
+
+
+def test_converge_dry_run(three_nodes_config_dict, tmp_path, fake_root_dir,
+                          caplog, generated_certs):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    caplog.set_level(logging.INFO, logger=main.logger.name)
+    commands = _converge(config_path, dry_run=True)
+
+    assert sorted(commands) == ['rpm'] * 3 + ['sha256sum'] * 3
+    assert 'manager-3 (' in caplog.text
+    assert 'Execution plan of the convergence' in caplog.text
+
+
+def test_failed_install_is_converged(nine_nodes_config_dict, tmp_path,
+                                     fake_root_dir, generated_certs):
+    config_path = _write_config(nine_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir,
+                                install_failure_rate=1)
+    with pytest.raises(ClusterInstallError,
+                       match='Simulated installation failure'):
+        main.converge(config_path, verbose=False)
+
+    cluster = _get_cluster(config_path)
+    cluster.options['install_failure_rate'] = 0
+    # The run stopped at the failure, maybe before some hosts got the RPM
+    hosts_without_rpm = [
+        node_name for node_name in nine_nodes_config_dict['existing_vms']
+        if not _get_host(cluster, nine_nodes_config_dict,
+                         node_name)._load_state()['rpm_version']]
+    commands = _converge(config_path)
+    # The failed installation is removed, and nothing is installed again
+    assert 'cfy_manager' in commands
+    assert commands.count('systemd-run') == 9
+    assert commands.count('yum') == len(hosts_without_rpm) < 9
+    assert sorted(_converge(config_path)) == ['rpm'] * 9 + ['sha256sum'] * 9
+
+
+def test_failed_configure_is_converged(three_nodes_config_dict, tmp_path,
+                                       fake_root_dir, generated_certs):
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    _converge(config_path)
+    three_nodes_config_dict['load_balancer_ip'] = '192.0.2.100'
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    with mock.patch.object(main, '_run_cfy_manager_configure',
+                           side_effect=ClusterInstallError('Failed')):
+        with pytest.raises(ClusterInstallError, match='Failed'):
+            main.converge(config_path, verbose=False)
+
+    # The uploaded files weren't applied, so they're applied now
+    with mock.patch.object(main.CfyNode, 'run_command', autospec=True,
+                           side_effect=main.CfyNode.run_command) as \
+            run_command:
+        main.converge(config_path, verbose=False)
+    assert sorted(_reconfigured_nodes(run_command)) == [
+        'manager-1', 'manager-2', 'manager-3',
+        'rabbitmq-1', 'rabbitmq-2', 'rabbitmq-3']
+
+
+def test_status(three_nodes_config_dict, tmp_path, fake_root_dir, caplog):
+    caplog.set_level(logging.INFO, logger=main.logger.name)
+    config_path = _write_config(three_nodes_config_dict, tmp_path,
+                                root_dir=fake_root_dir)
+    main.status(config_path)
+    assert caplog.text.count('not installed (no RPM)') == 9
+
+    main.install(config_path, override=False, only_validate=False,
+                 verbose=False)
+    with open(join(main.CONFIG_FILES_DIR, 'manager-1_config.yaml'),
+              'a') as config_file:
+        config_file.write('# changed\n')
+    caplog.clear()
+    # Served by the daemon, the command runs in its process
+    assert main._run_argv(['status', '--config-path', config_path]) == 0
+
+    assert caplog.text.count('installed, runs with its files') == 8
+    assert 'manager-1 ({0}): installed, its files changed since they were ' \
+        'applied'.format(three_nodes_config_dict['existing_vms']['node-1'][
+            'private_ip']) in caplog.text
+    assert main._run_argv(['remove', '--config-path', config_path]) == 1
+    assert 'The daemon serves only' in caplog.text
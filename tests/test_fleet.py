@@ -0,0 +1,197 @@
+import sys
+import json
+import threading
+from os.path import dirname
+
+import mock
+import pytest
+import yaml
+
+from cfy_cluster_manager import fleet as fleet_module, main
+from cfy_cluster_manager.fleet import (FleetCluster, get_clusters,
+                                       REPORT_NAME, run_cluster_process)
+from cfy_cluster_manager.main import fleet
+from cfy_cluster_manager.throttle import parse_rate, upload_throttle
+from cfy_cluster_manager.utils import ClusterInstallError
+
+RPM_URL = 'http://repository.example.com/cloudify-manager-install-5.1.2.rpm'
+METRICS = '''# TYPE cfy_cluster_manager_node_success gauge
+cfy_cluster_manager_node_success{{node="manager-1",operation="install"}} 1
+cfy_cluster_manager_node_success{{node="manager-2",operation="install"}} {0}
+cfy_cluster_manager_remote_commands{{host="10.0.0.1",operation="install",\
+phase="install"}} 12
+cfy_cluster_manager_uploaded_bytes{{host="10.0.0.1",operation="install",\
+phase="upload"}} 2048
+# EOF
+'''
+
+
+def _write_configs(config_dir, basic_config_dict, count, rpm_path=RPM_URL):
+    config_paths = []
+    for i in range(count):
+        cluster_dir = config_dir / 'site{0}'.format(i)
+        cluster_dir.mkdir()
+        config_path = cluster_dir / 'cfy_cluster_config.yaml'
+        config = dict(basic_config_dict, manager_rpm_path=rpm_path)
+        config_path.write_text(yaml.safe_dump(config))
+        config_paths.append(str(config_path))
+    return config_paths
+
+
+def _download(command):
+    with open(command[command.index('-o') + 1], 'w') as rpm_file:
+        rpm_file.write('rpm')
+
+
+def _get_arg(command, flag):
+    return command[command.index(flag) + 1]
+
+
+def test_cluster_names_are_unique(tmp_path):
+    clusters = get_clusters(['a/cluster.yaml', 'b/cluster.yaml',
+                             'c/my cluster.yml'], str(tmp_path))
+
+    assert [cluster.name for cluster in clusters] == \
+        ['cluster', 'cluster_2', 'my_cluster']
+    assert clusters[2].work_dir == str(tmp_path / 'my_cluster')
+
+
+def test_only_local_files_are_kept_apart(tmp_path, monkeypatch):
+    monkeypatch.setenv('PYTHONPATH', dirname(dirname(fleet_module.__file__)))
+    cluster = FleetCluster('site', 'cluster.yaml', str(tmp_path))
+    script = ('from cfy_cluster_manager import main\n'
+              'print(main.CLUSTER_INSTALL_DIR)\n'
+              'print(main.REMOTE_INSTALL_DIR)')
+
+    assert run_cluster_process(cluster, [sys.executable, '-c', script]) == 0
+    with open(cluster.output_path) as output_file:
+        assert output_file.read().split() == [
+            str(tmp_path / 'cloudify_cluster_manager'),
+            '/tmp/cloudify_cluster_manager']
+
+
+@mock.patch('cfy_cluster_manager.fleet.run', side_effect=_download)
+def test_budget_is_shared(mock_run, tmp_path, config_dir, basic_config_dict):
+    config_paths = _write_configs(config_dir, basic_config_dict, 3)
+    commands = []
+    running = []
+    lock = threading.Lock()
+
+    def run_cluster(cluster, command):
+        with lock:
+            running.append(cluster)
+            concurrent = len(running)
+        commands.append(command)
+        with lock:
+            running.remove(cluster)
+        assert concurrent <= 2
+        return 0
+
+    fleet(config_paths, 'install', verbose=False,
+          fleet_dir=str(tmp_path / 'fleet'), max_clusters=2,
+          max_parallel=10, max_upload_rate=1000,
+          rpm_cache_dir=str(tmp_path / 'cache'), run_cluster=run_cluster)
+
+    assert len(commands) == 3
+    for command in commands:
+        assert _get_arg(command, '--max-parallel') == '5'
+        assert _get_arg(command, '--min-parallel') == '2'
+        assert _get_arg(command, '--max-upload-rate') == '500'
+        assert '--upgrade-rpm' not in command
+
+
+@mock.patch('cfy_cluster_manager.fleet.run', side_effect=_download)
+def test_rpm_is_downloaded_once(mock_run, tmp_path, config_dir,
+                                basic_config_dict):
+    config_paths = _write_configs(config_dir, basic_config_dict, 2)
+    cluster_configs = []
+
+    def run_cluster(cluster, command):
+        with open(_get_arg(command, '--config-path')) as config_file:
+            cluster_configs.append(yaml.safe_load(config_file))
+        return 0
+
+    fleet(config_paths, 'upgrade', verbose=False,
+          fleet_dir=str(tmp_path / 'fleet'), upgrade_rpm_path=RPM_URL,
+          rpm_cache_dir=str(tmp_path / 'cache'), run_cluster=run_cluster)
+
+    mock_run.assert_called_once()
+    cached_path = fleet_module.get_cached_rpm(RPM_URL,
+                                              str(tmp_path / 'cache'))
+    assert cached_path.endswith('cloudify-manager-install-5.1.2.rpm')
+    assert [config['manager_rpm_path'] for config in cluster_configs] == \
+        [cached_path, cached_path]
+    # The original configuration files are left as they are
+    with open(config_paths[0]) as config_file:
+        assert yaml.safe_load(config_file)['manager_rpm_path'] == RPM_URL
+
+
+def test_local_rpm_config_is_used_as_is(tmp_path, config_dir,
+                                        basic_config_dict, license_path):
+    config_paths = _write_configs(config_dir, basic_config_dict, 1,
+                                  rpm_path=license_path)
+    commands = []
+
+    def run_cluster(cluster, command):
+        commands.append(command)
+        return 0
+
+    fleet(config_paths, 'converge', verbose=False,
+          fleet_dir=str(tmp_path / 'fleet'), run_cluster=run_cluster)
+
+    assert _get_arg(commands[0], '--config-path') == config_paths[0]
+    assert commands[0][3] == 'converge'
+
+
+def test_fleet_report(tmp_path, config_dir, basic_config_dict,
+                      license_path):
+    config_paths = _write_configs(config_dir, basic_config_dict, 2,
+                                  rpm_path=license_path)
+    fleet_dir = tmp_path / 'fleet'
+
+    def run_cluster(cluster, command):
+        failed = cluster.name == 'cfy_cluster_config_2'
+        with open(cluster.metrics_path, 'w') as metrics_file:
+            metrics_file.write(METRICS.format(0 if failed else 1))
+        with open(cluster.output_path, 'w') as output_file:
+            if failed:
+                output_file.write('2021-01-01 - [CFY-CLUSTER-MANAGER] - '
+                                  'ERROR - ClusterInstallError: boom\n')
+        return 1 if failed else 0
+
+    with pytest.raises(ClusterInstallError,
+                       match='clusters cfy_cluster_config_2 failed'):
+        fleet(config_paths, 'install', verbose=False,
+              fleet_dir=str(fleet_dir), run_cluster=run_cluster)
+
+    report = json.loads((fleet_dir / REPORT_NAME).read_text())
+    first, second = report['clusters']
+    assert first['succeeded'] and not second['succeeded']
+    assert (first['nodes'], first['nodes_succeeded']) == (2, 2)
+    assert second['nodes_succeeded'] == 1
+    assert first['remote_commands'] == 12
+    assert first['uploaded_bytes'] == 2048
+    assert first['error'] is None
+    assert second['error'] == 'ClusterInstallError: boom'
+
+
+def test_fleet_process_doesnt_throttle_uploads(tmp_path, monkeypatch):
+    fleet_calls = []
+    monkeypatch.setattr(main, 'fleet',
+                        lambda *args: fleet_calls.append(args))
+    parser = main.get_parser()
+    args = parser.parse_args([
+        'fleet', 'cluster.yaml', '--max-upload-rate', '10M',
+        '--max-host-upload-rate', '1M',
+        '--history-db', str(tmp_path / 'history.db')])
+    main.run_args(parser, args)
+
+    assert not upload_throttle.enabled
+    # The rates are split between the clusters' processes
+    assert fleet_calls[0][6:8] == (parse_rate('10M'), parse_rate('1M'))
+
+
+def test_missing_config_files(tmp_path):
+    with pytest.raises(ClusterInstallError, match='missing.yaml'):
+        fleet([str(tmp_path / 'missing.yaml')], 'install', verbose=False,
+              fleet_dir=str(tmp_path / 'fleet'))
@@ -50,3 +50,37 @@ def _assert_same_config_contents(output_path, config_name):
     err_msg = ('The output file {0} is not the same as the config file '
                '{1}'.format(output_path, config_name))
     assert config_dict == output_dict, err_msg
+
+
+@pytest.mark.parametrize('using_external_db', [True, False])
+def test_generate_config_by_node_counts(using_external_db, tmp_path):
+    outfile_path = str(tmp_path / 'config.yaml')
+    generate_config(output_path=outfile_path, using_three_nodes=False,
+                    using_nine_nodes=False,
+                    using_external_db=using_external_db, managers=5,
+                    brokers=4, db_nodes=None if using_external_db else 3)
+    with open(outfile_path) as output_file:
+        output_dict = yaml.load(output_file, yaml.Loader)
+
+    expected_names = (['manager-{0}'.format(i) for i in range(1, 6)] +
+                      ['rabbitmq-{0}'.format(i) for i in range(1, 5)])
+    if not using_external_db:
+        expected_names += ['postgresql-1', 'postgresql-2', 'postgresql-3']
+    assert list(output_dict['existing_vms']) == expected_names
+    assert ('external_db_configuration' in output_dict) == using_external_db
+    assert ('postgresql' in output_dict['credentials']) != using_external_db
+
+
+@pytest.mark.parametrize('counts, using_nine_nodes, using_external_db', [
+    ({'managers': 3, 'brokers': 3, 'db_nodes': 3}, True, False),
+    ({'managers': 3, 'db_nodes': 3}, False, False),
+    ({'managers': 3, 'brokers': 3}, False, False),
+    ({'managers': 3, 'brokers': 3, 'db_nodes': 3}, False, True),
+])
+def test_invalid_node_counts(counts, using_nine_nodes, using_external_db,
+                             tmp_path):
+    with pytest.raises(ClusterInstallError):
+        generate_config(output_path=str(tmp_path / 'config.yaml'),
+                        using_three_nodes=False,
+                        using_nine_nodes=using_nine_nodes,
+                        using_external_db=using_external_db, **counts)
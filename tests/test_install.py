@@ -9,8 +9,10 @@ import cfy_cluster_manager
 from cfy_cluster_manager.main import (_generate_general_cluster_dict,
                                       _generate_three_nodes_cluster_dict,
                                       _handle_certificates,
+                                      _monitor_cloudify_installation,
                                       _populate_credentials,
                                       _prepare_config_files)
+from cfy_cluster_manager.utils import ClusterInstallError
 
 
 @pytest.fixture(autouse=True)
@@ -137,7 +139,8 @@ def test_ldap_in_config_file(three_nodes_config_dict,
                              config_files_dir,
                              ldap_ca_path,
                              tmp_certs_dir,
-                             certs_dir):
+                             certs_dir,
+                             cluster_manager_dir):
     """Test if LDAP is configured properly in the manager config.yaml file."""
     # In this case, The three nodes and nine nodes logic is the same
     cluster_manager_ldap_ca = str(certs_dir / 'ldap_ca.pem')
@@ -154,12 +157,15 @@ def test_ldap_in_config_file(three_nodes_config_dict,
 
     mock_using_provided_config_files()
     with mock.patch('cfy_cluster_manager.main.LDAP_CA_PATH',
-                    cluster_manager_ldap_ca):
+                    cluster_manager_ldap_ca), \
+            mock.patch('cfy_cluster_manager.main.CLUSTER_INSTALL_DIR',
+                       str(cluster_manager_dir)):
         _handle_certificates(three_nodes_config_dict, None)
         _create_config_files(three_nodes_config_dict, config_files_dir)
     manager_config = _get_instance_config('manager', config_files_dir)
 
-    ldap_dict['ca_cert'] = cluster_manager_ldap_ca
+    # The CA's path on the managers
+    ldap_dict['ca_cert'] = '/tmp/cloudify_cluster_manager/certs/ldap_ca.pem'
     assert manager_config['restservice']['ldap'] == ldap_dict
     _assert_created_certs(tmp_certs_dir, certs_dir)
 
@@ -168,7 +174,8 @@ def test_extrnal_db_in_config_file(three_nodes_external_db_config_dict,
                                    config_files_dir,
                                    external_db_ca_path,
                                    tmp_certs_dir,
-                                   certs_dir):
+                                   certs_dir,
+                                   cluster_manager_dir):
     """
     Test if the external_db is configured properly in the manager
     config.yaml file.
@@ -190,14 +197,17 @@ def test_extrnal_db_in_config_file(three_nodes_external_db_config_dict,
 
     mock_using_provided_config_files()
     with mock.patch('cfy_cluster_manager.main.EXTERNAL_DB_CA_PATH',
-                    cluster_manager_external_db_ca):
+                    cluster_manager_external_db_ca), \
+            mock.patch('cfy_cluster_manager.main.CLUSTER_INSTALL_DIR',
+                       str(cluster_manager_dir)):
         _handle_certificates(three_nodes_external_db_config_dict, None)
         _create_config_files(three_nodes_external_db_config_dict,
                              config_files_dir)
     manager_config = _get_instance_config('manager', config_files_dir)
 
-    external_db_config.update({'ssl_client_verification': False,
-                               'ca_path': cluster_manager_external_db_ca})
+    external_db_config.update({
+        'ssl_client_verification': False,
+        'ca_path': '/tmp/cloudify_cluster_manager/certs/external_db_ca.pem'})
     assert manager_config['postgresql_client'] == external_db_config
     _assert_created_certs(tmp_certs_dir, certs_dir)
 
@@ -234,6 +244,31 @@ def test_nine_nodes_using_provided_config_paths(nine_nodes_config_dict,
     _assert_created_config_files(tmp_config_files_dir, config_files_dir)
 
 
+def test_monitor_installation_survives_connection_drop():
+    """Test the detached installation is monitored through SSH failures.
+
+    The first status check fails as if the SSH connection dropped, and the
+    monitoring should keep on polling the unit until it finishes.
+    """
+    instance = mock.Mock(unit_name='cfy_cluster_manager_manager',
+                         installed=False)
+    instance.type = 'manager'
+    instance.run_command.side_effect = [
+        ClusterInstallError('SSH: could not connect'),
+        mock.Mock(return_code=0),
+        mock.Mock(return_code=4),
+        mock.Mock(return_code=4),
+        mock.Mock(return_code=0),
+        mock.Mock(return_code=0)
+    ]
+    instance.file_exists.return_value = True
+    with mock.patch('cfy_cluster_manager.main.UNIT_POLL_INTERVAL', 0):
+        _monitor_cloudify_installation(instance)
+
+    assert instance.installed
+    assert instance.run_command.call_count == 6
+
+
 def _assert_manager_config_credentials(config_files_dir, credentials):
     manager_config = _get_instance_config('manager', config_files_dir)
 
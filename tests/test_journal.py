@@ -0,0 +1,34 @@
+from cfy_cluster_manager.journal import get_config_digest, StagingJournal
+
+
+def test_staging_journal(tmp_path):
+    config_path = tmp_path / 'cluster_config.yaml'
+    config_path.write_text(u'existing_vms: {}')
+    config_digest = get_config_digest(str(config_path))
+    journal_path = str(tmp_path / 'journal.json')
+
+    journal = StagingJournal(journal_path)
+    journal.start(config_digest)
+    journal.node_staged('manager-1')
+    assert not StagingJournal(journal_path).is_complete(config_digest)
+
+    journal.complete()
+    journal = StagingJournal(journal_path)
+    assert journal.is_complete(config_digest)
+    assert journal.staged_nodes == ['manager-1']
+
+    # Staging a changed configuration starts over
+    config_path.write_text(u'existing_vms: {manager-1: {}}')
+    new_digest = get_config_digest(str(config_path))
+    assert not journal.is_complete(new_digest)
+    journal.start(new_digest)
+    assert journal.staged_nodes == []
+
+    journal.clear()
+    assert not StagingJournal(journal_path).matches(new_digest)
+
+
+def test_invalid_journal_is_ignored(tmp_path):
+    journal_path = tmp_path / 'journal.json'
+    journal_path.write_text(u'{')
+    assert StagingJournal(str(journal_path)).staged_nodes == []
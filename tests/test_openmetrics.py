@@ -0,0 +1,73 @@
+from cfy_cluster_manager.openmetrics import (format_metrics,
+                                             MetricsFileWriter, parse_metrics,
+                                             RunMetrics)
+from cfy_cluster_manager.remote_stats import RemoteStats
+from cfy_cluster_manager.retry import RetryStats
+
+
+def _get_metrics():
+    metrics = RunMetrics()
+    metrics.start('install')
+    metrics.set_node_result('manager-1', True)
+    metrics.set_node_result('manager-2', False)
+    stats = RemoteStats()
+    with stats.phase('upload'):
+        stats.record('10.0.0.1', connections=1, files=2, bytes=100,
+                     wait_time=1.5)
+    retries = RetryStats()
+    retries.record_retry('Connecting', '10.0.0.1', 2)
+    retries.record_retry('Running `ls`', '10.0.0.1', 4)
+    return metrics, stats, retries
+
+
+def test_format_metrics():
+    metrics, stats, retries = _get_metrics()
+    metrics.finish(success=False)
+
+    lines = format_metrics(metrics, stats, retries).splitlines()
+
+    assert ('cfy_cluster_manager_run_success{operation="install"} 0'
+            in lines)
+    assert ('cfy_cluster_manager_run_in_progress{operation="install"} 0'
+            in lines)
+    assert ('cfy_cluster_manager_node_success{node="manager-2",'
+            'operation="install"} 0' in lines)
+    assert ('cfy_cluster_manager_uploaded_bytes{host="10.0.0.1",'
+            'operation="install",phase="upload"} 100' in lines)
+    assert ('cfy_cluster_manager_retries{host="10.0.0.1",'
+            'operation="install"} 2' in lines)
+    assert lines[-1] == '# EOF'
+
+
+def test_run_in_progress():
+    metrics, stats, retries = _get_metrics()
+
+    text = format_metrics(metrics, stats, retries)
+
+    assert 'cfy_cluster_manager_run_in_progress{operation="install"} 1' in text
+    assert 'run_success' not in text
+
+
+def test_metrics_file_writer(tmp_path):
+    metrics_path = tmp_path / 'metrics' / 'cluster.prom'
+    writer = MetricsFileWriter(str(metrics_path), interval=60)
+    writer.start()
+    assert metrics_path.exists()
+    writer.stop()
+    assert metrics_path.read_text().endswith('# EOF\n')
+    assert len(list(metrics_path.parent.iterdir())) == 1
+
+
+def test_parse_metrics():
+    metrics, stats, retries = _get_metrics()
+    metrics.set_node_result('manager "3"', True)
+    metrics.finish(success=True)
+
+    samples = parse_metrics(format_metrics(metrics, stats, retries))
+
+    assert samples['run_success'] == [({'operation': 'install'}, 1.0)]
+    assert ({'node': 'manager "3"', 'operation': 'install'}, 1.0) in \
+        samples['node_success']
+    assert samples['uploaded_bytes'] == [
+        ({'host': '10.0.0.1', 'operation': 'install', 'phase': 'upload'},
+         100.0)]
@@ -0,0 +1,188 @@
+from collections import OrderedDict
+
+import mock
+import pytest
+
+from cfy_cluster_manager.plan import (build_converge_plan, build_install_plan,
+                                      build_prepare_plan, build_upgrade_plan,
+                                      critical_path, format_plan, run_plan,
+                                      schedule_plan)
+
+
+def _instances_dict(hosts_per_type):
+    instances_dict = OrderedDict()
+    for instance_type, hosts in hosts_per_type:
+        instances_dict[instance_type] = []
+        for i, host in enumerate(hosts):
+            instance = mock.Mock(type=instance_type, private_ip=host)
+            instance.name = '{0}-{1}'.format(instance_type, i + 1)
+            instances_dict[instance_type].append(instance)
+    return instances_dict
+
+
+def _set_durations(steps, durations):
+    for step in steps:
+        step.duration = durations.get(step.step, 0)
+        step.source = 'default'
+
+
+def test_nine_nodes_install_plan():
+    instances_dict = _instances_dict((
+        ('postgresql', ('10.0.0.1', '10.0.0.2', '10.0.0.3')),
+        ('rabbitmq', ('10.0.0.4', '10.0.0.5', '10.0.0.6')),
+        ('manager', ('10.0.0.7', '10.0.0.8', '10.0.0.9'))))
+    steps = build_install_plan(instances_dict)
+    _set_durations(steps, {'upload': 10, 'rpm install': 20,
+                           'cfy_manager install': 100})
+
+    # The uploads and RPM installs all run at once, each tier waits on the
+    # tier before it, and its nodes join it one at a time
+    assert schedule_plan(steps) == 30 + 9 * 100
+    assert [step.name for step in critical_path(steps)] == [
+        'postgresql-1 upload', 'postgresql-1 rpm install'] + [
+        '{0}-{1} cfy_manager install'.format(instance_type, i)
+        for instance_type in ('postgresql', 'rabbitmq', 'manager')
+        for i in (1, 2, 3)]
+
+
+def test_three_nodes_install_plan():
+    hosts = ('10.0.0.1', '10.0.0.2', '10.0.0.3')
+    instances_dict = _instances_dict((('postgresql', hosts),
+                                      ('rabbitmq', hosts),
+                                      ('manager', hosts)))
+    steps = build_install_plan(instances_dict)
+    _set_durations(steps, {'upload': 10, 'rpm install': 20,
+                           'cfy_manager install': 100})
+
+    # The uploads of a host wait on its previous installation, but they
+    # are done while the tier before runs
+    assert schedule_plan(steps) == 30 + 9 * 100
+    assert [step.start for step in steps[:6]] == [0, 10, 30, 0, 10, 130]
+    assert steps[9].name == 'rabbitmq-1 upload'
+    assert steps[9].start == 130
+    plan_text = format_plan(steps, 'install', '5.1.2')
+    assert 'Execution plan of the install of Cloudify 5.1.2' in plan_text
+    assert '19:30 running the steps one at a time' in plan_text
+
+
+def test_prepare_plan():
+    hosts = ('10.0.0.1', '10.0.0.2', '10.0.0.3')
+    instances_dict = _instances_dict((('postgresql', hosts),
+                                      ('rabbitmq', hosts),
+                                      ('manager', hosts)))
+    steps = build_prepare_plan(instances_dict)
+    _set_durations(steps, {'upload': 10, 'rpm install': 20,
+                           'config copy': 1})
+
+    # The hosts are staged in parallel, each host's instances in turn
+    assert schedule_plan(steps) == 3 * (10 + 20 + 1)
+    assert [step.start for step in steps[:6]] == [0, 10, 30, 0, 10, 30]
+
+
+def test_converge_plan():
+    instances_dict = _instances_dict((
+        ('postgresql', ('10.0.0.1', '10.0.0.2')),
+        ('rabbitmq', ('10.0.0.3', '10.0.0.4')),
+        ('manager', ('10.0.0.5', '10.0.0.6'))))
+    postgresql_2 = instances_dict['postgresql'][1]
+    manager_1, manager_2 = instances_dict['manager']
+    steps = build_converge_plan(instances_dict, {
+        postgresql_2: ['cfy_manager configure'],
+        manager_1: ['upload', 'cfy_manager configure'],
+        manager_2: ['upload', 'rpm install', 'cfy_manager install']})
+    _set_durations(steps, {'upload': 10, 'rpm install': 20,
+                           'cfy_manager configure': 50,
+                           'cfy_manager install': 100})
+
+    # Only the given steps run, and the managers still wait on the DB and
+    # on the first manager
+    assert [step.name for step in steps] == [
+        'postgresql-2 cfy_manager configure', 'manager-1 upload',
+        'manager-1 cfy_manager configure', 'manager-2 upload',
+        'manager-2 rpm install', 'manager-2 cfy_manager install']
+    assert schedule_plan(steps) == 50 + 50 + 100
+    assert steps[-1].start == 100
+
+
+def test_converge_plan_joins_one_at_a_time():
+    instances_dict = _instances_dict((
+        ('rabbitmq', ('10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4')),))
+    rabbitmq_1, rabbitmq_2, rabbitmq_3, rabbitmq_4 = \
+        instances_dict['rabbitmq']
+    steps = build_converge_plan(instances_dict, {
+        rabbitmq_1: ['cfy_manager configure'],
+        rabbitmq_2: ['cfy_manager install'],
+        rabbitmq_3: ['cfy_manager install'],
+        rabbitmq_4: ['cfy_manager configure']})
+    _set_durations(steps, {'cfy_manager configure': 50,
+                           'cfy_manager install': 100})
+
+    # The installed nodes are configured once the first node is, while the
+    # new ones join the cluster one at a time
+    schedule_plan(steps)
+    assert [step.start for step in steps] == [0, 50, 150, 50]
+
+
+def test_upgrade_plan():
+    instances_dict = _instances_dict((
+        ('postgresql', ('10.0.0.1',)), ('rabbitmq', ('10.0.0.2',)),
+        ('manager', ('10.0.0.3', '10.0.0.4'))))
+    rpm_instances = instances_dict['manager'] + \
+        instances_dict['rabbitmq'] + instances_dict['postgresql']
+    steps = build_upgrade_plan(instances_dict, rpm_instances)
+    _set_durations(steps, {'rpm upgrade': 60, 'cfy_manager upgrade': 100})
+
+    assert schedule_plan(steps) == 60 + 4 * 100
+
+
+def test_capped_schedule_starts_the_critical_path_first():
+    instances_dict = _instances_dict((
+        ('postgresql', ('10.0.0.1', '10.0.0.2', '10.0.0.3')),
+        ('rabbitmq', ('10.0.0.4', '10.0.0.5', '10.0.0.6')),
+        ('manager', ('10.0.0.7', '10.0.0.8', '10.0.0.9'))))
+    steps = build_install_plan(instances_dict)
+    _set_durations(steps, {'upload': 10, 'rpm install': 20,
+                           'cfy_manager install': 100})
+    steps_by_name = dict((step.name, step) for step in steps)
+
+    # Two steps at a time are enough, since the other nodes are uploaded to
+    # while the nodes join their tiers one after the other
+    assert schedule_plan(steps, max_parallel=2) == 30 + 9 * 100
+    assert steps_by_name['rabbitmq-1 cfy_manager install'].start == 330
+    assert steps_by_name['manager-1 upload'].start < 630
+    assert schedule_plan(steps, max_parallel=1) == 9 * 130
+
+
+def test_run_plan_order():
+    instances_dict = _instances_dict((
+        ('rabbitmq', ('10.0.0.1',)), ('manager', ('10.0.0.2', '10.0.0.3'))))
+    steps = build_install_plan(instances_dict)
+    _set_durations(steps, {'upload': 10, 'rpm install': 20,
+                           'cfy_manager install': 100})
+    done = steps[:3]
+    started = []
+
+    run_plan(steps, lambda step: started.append(step.name), max_parallel=1,
+             done=done)
+
+    assert started == [
+        'manager-1 upload', 'manager-1 rpm install',
+        'manager-1 cfy_manager install', 'manager-2 upload',
+        'manager-2 rpm install', 'manager-2 cfy_manager install']
+
+
+def test_run_plan_stops_on_failure():
+    instances_dict = _instances_dict((
+        ('postgresql', ('10.0.0.1',)), ('manager', ('10.0.0.2',))))
+    steps = build_install_plan(instances_dict)
+    started = []
+
+    def run_step(step):
+        started.append(step.name)
+        if step.name == 'postgresql-1 rpm install':
+            raise RuntimeError('yum failed')
+
+    with pytest.raises(RuntimeError, match='yum failed'):
+        run_plan(steps, run_step, max_parallel=2)
+    assert 'postgresql-1 cfy_manager install' not in started
+    assert 'manager-1 cfy_manager install' not in started
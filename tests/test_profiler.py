@@ -0,0 +1,95 @@
+import json
+import time
+import argparse
+
+from cfy_cluster_manager import main, profiler
+from cfy_cluster_manager.profiler import SamplingProfiler
+
+
+def _busy(seconds):
+    end_time = time.time() + seconds
+    while time.time() < end_time:
+        pass
+
+
+def test_span_times():
+    sampling_profiler = SamplingProfiler(interval=0.001)
+    sampling_profiler.start()
+    with sampling_profiler.span('10.0.0.1', 'Running `sleep`'):
+        time.sleep(0.2)
+    with sampling_profiler.span('10.0.0.1', 'Running `busy; loop`'):
+        _busy(0.2)
+    sampling_profiler.stop()
+
+    waiting, busy = sampling_profiler.spans
+    assert waiting.wall_time >= 0.2
+    assert waiting.cpu_time < 0.1
+    assert busy.cpu_time > 0.1
+    remote_stacks = [stack for stack in sampling_profiler.samples
+                     if 'remote: 10.0.0.1 Running `busy: loop`' in stack]
+    assert remote_stacks
+    assert all('_busy (test_profiler.py' in stack or
+               'test_span_times' in stack.split(';')[-1]
+               for stack in remote_stacks)
+
+
+def test_nested_spans():
+    sampling_profiler = SamplingProfiler()
+    with sampling_profiler.span('10.0.0.1', 'Uploading'):
+        with sampling_profiler.span('10.0.0.1', 'Running `ls`'):
+            pass
+        assert list(sampling_profiler._active_spans.values()) == [
+            '10.0.0.1 Uploading']
+    assert not sampling_profiler._active_spans
+    assert len(sampling_profiler.spans) == 2
+
+
+def test_profile_files(tmp_path):
+    profile_path = str(tmp_path / 'profile.folded')
+    profiler.start_profiling(interval=0.001)
+    with profiler.remote_span('10.0.0.1', 'Connecting'):
+        _busy(0.05)
+    profiler.stop_profiling(profile_path)
+
+    with open(profile_path) as profile_file:
+        lines = profile_file.read().splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(' ', 1)
+        assert int(count) > 0
+    assert any(line.startswith('MainThread;remote: 10.0.0.1 Connecting;')
+               for line in lines)
+    with open(profile_path + profiler.SPANS_SUFFIX) as spans_file:
+        spans = json.load(spans_file)
+    assert [(span['host'], span['operation']) for span in spans] == [
+        ('10.0.0.1', 'Connecting')]
+
+    # Without a running profiler, a remote span is a no-op
+    with profiler.remote_span('10.0.0.1', 'Connecting'):
+        pass
+
+
+def test_nested_profiles(tmp_path):
+    # A daemon's profile, and the one of a command it serves
+    daemon_path = str(tmp_path / 'daemon.folded')
+    command_path = str(tmp_path / 'command.folded')
+    profiler.start_profiling(interval=0.001)
+    profiler.start_profiling(interval=0.001)
+    with profiler.remote_span('10.0.0.1', 'Connecting'):
+        pass
+    profiler.stop_profiling(command_path)
+    with profiler.remote_span('10.0.0.2', 'Connecting'):
+        pass
+    profiler.stop_profiling(daemon_path)
+
+    for path, hosts in ((command_path, ['10.0.0.1']),
+                        (daemon_path, ['10.0.0.1', '10.0.0.2'])):
+        with open(path + profiler.SPANS_SUFFIX) as spans_file:
+            assert [span['host'] for span in json.load(spans_file)] == hosts
+
+
+def test_every_command_is_profiled():
+    subparsers, = [action for action in main.get_parser()._actions
+                   if isinstance(action, argparse._SubParsersAction)]
+    for name, parser in subparsers.choices.items():
+        assert '--profile' in parser.format_usage(), name
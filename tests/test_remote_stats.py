@@ -0,0 +1,31 @@
+from cfy_cluster_manager.remote_stats import RemoteStats
+
+
+def test_records_per_node_and_phase():
+    stats = RemoteStats()
+    stats.record('10.0.0.1', connections=1, commands=1)
+    with stats.phase('upload'):
+        stats.record('10.0.0.1', connections=1, files=2, bytes=100,
+                     wait_time=1.5)
+        stats.record('10.0.0.2', connections=1, files=2, bytes=100)
+    stats.record('10.0.0.1', commands=1, sudo_commands=1)
+
+    assert stats.records[('10.0.0.1', 'other')] == {
+        'connections': 1, 'commands': 2, 'sudo_commands': 1}
+    assert stats.records[('10.0.0.1', 'upload')]['wait_time'] == 1.5
+    assert stats.totals()['bytes'] == 200
+
+
+def test_format_table():
+    stats = RemoteStats()
+    with stats.phase('upload'):
+        stats.record('10.0.0.1', connections=1, files=2, bytes=100,
+                     wait_time=1.25)
+
+    lines = stats.format_table().splitlines()
+
+    assert lines[0].split() == ['node', 'phase', 'connections', 'commands',
+                                'sudo', 'files', 'bytes', 'wait', '(s)']
+    assert lines[1].split() == ['10.0.0.1', 'upload', '1', '0', '0', '2',
+                                '100', '1.2']
+    assert lines[2].split() == ['total', '1', '0', '0', '2', '100', '1.2']
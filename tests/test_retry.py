@@ -0,0 +1,83 @@
+import mock
+import pytest
+
+from cfy_cluster_manager.exceptions import CircuitOpenError
+from cfy_cluster_manager.retry import (call_with_retries, CircuitBreaker,
+                                       get_circuit_breaker,
+                                       reset_circuit_breakers, RetryPolicy,
+                                       RetryStats)
+
+
+@pytest.fixture(autouse=True)
+def mock_sleep():
+    with mock.patch('cfy_cluster_manager.retry.time.sleep') as sleep_mock:
+        yield sleep_mock
+
+
+def test_exponential_backoff_with_jitter():
+    policy = RetryPolicy(base_delay=1, max_delay=10)
+    for retry_number, max_delay in (1, 1), (2, 2), (3, 4), (4, 8), (6, 10):
+        delay = policy.get_delay(retry_number)
+        assert max_delay / 2 <= delay <= max_delay
+
+
+def test_retryable_failure_is_retried(mock_sleep):
+    func = mock.Mock(side_effect=[IOError('reset'), IOError('reset'), 'ok'])
+    stats = RetryStats()
+    with mock.patch('cfy_cluster_manager.retry.retry_stats', stats):
+        result = call_with_retries(func, 'test', RetryPolicy(max_attempts=3),
+                                   lambda exc: True, host='192.0.2.1')
+
+    assert result == 'ok'
+    assert func.call_count == 3
+    assert mock_sleep.call_count == 2
+    assert stats.total_retries() == 2
+
+
+def test_non_retryable_failure_is_raised():
+    func = mock.Mock(side_effect=IOError('reset'))
+    with pytest.raises(IOError):
+        call_with_retries(func, 'test', RetryPolicy(max_attempts=3),
+                          lambda exc: False)
+    assert func.call_count == 1
+
+
+def test_attempts_are_bounded():
+    func = mock.Mock(side_effect=IOError('reset'))
+    with pytest.raises(IOError):
+        call_with_retries(func, 'test', RetryPolicy(max_attempts=3),
+                          lambda exc: True)
+    assert func.call_count == 3
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker('192.0.2.1', failure_threshold=2,
+                             reset_timeout=30)
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # After the reset timeout a single trial call is let through
+    breaker.opened_at -= 30
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError, match='trial'):
+        breaker.before_call()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.opened_at -= 30
+    breaker.before_call()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.before_call()
+
+
+def test_circuit_breakers_are_reset():
+    breaker = get_circuit_breaker('192.0.2.1')
+    assert get_circuit_breaker('192.0.2.1') is breaker
+    reset_circuit_breakers()
+    assert get_circuit_breaker('192.0.2.1') is not breaker
+    reset_circuit_breakers()
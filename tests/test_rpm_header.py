@@ -0,0 +1,71 @@
+import hashlib
+
+import pytest
+
+from cfy_cluster_manager.rpm_header import (parse_query_output,
+                                            read_rpm_header,
+                                            RpmHeaderError, RpmPackage)
+
+
+def test_read_rpm_header(tmp_path, write_rpm):
+    rpm_path = write_rpm(tmp_path / 'cloudify.rpm', version='5.1.2',
+                         release='ga.el7', epoch=1, sha1='ab' * 20,
+                         payload=b'x' * 1000)
+    package = read_rpm_header(rpm_path)
+    assert (package.name, package.epoch, package.version, package.release,
+            package.arch, package.digest) == (
+        'cloudify-manager-install', 1, '5.1.2', 'ga.el7', 'x86_64',
+        'ab' * 20)
+    assert str(package) == 'cloudify-manager-install-1:5.1.2-ga.el7.x86_64'
+
+
+def test_digest_of_unsigned_rpm(tmp_path, write_rpm):
+    rpm_path = write_rpm(tmp_path / 'cloudify.rpm')
+    with open(rpm_path, 'rb') as rpm_file:
+        # The lead, and an empty signature header
+        header = rpm_file.read()[96 + 16:]
+    assert read_rpm_header(rpm_path).digest == hashlib.sha1(
+        header).hexdigest()
+
+
+@pytest.mark.parametrize('content', [b'', b'rpm' * 100, b'\0' * 1024])
+def test_not_an_rpm(tmp_path, content):
+    rpm_path = tmp_path / 'cloudify.rpm'
+    rpm_path.write_bytes(content)
+    with pytest.raises(RpmHeaderError):
+        read_rpm_header(str(rpm_path))
+
+
+def test_truncated_rpm(tmp_path, write_rpm):
+    rpm_path = write_rpm(tmp_path / 'cloudify.rpm')
+    with open(rpm_path, 'rb') as rpm_file:
+        content = rpm_file.read()
+    with open(rpm_path, 'wb') as rpm_file:
+        rpm_file.write(content[:-10])
+    with pytest.raises(RpmHeaderError):
+        read_rpm_header(rpm_path)
+
+
+def test_parse_query_output():
+    package = parse_query_output(
+        'cloudify-manager-install (none) 5.1.2 ga x86_64 (none)\n')
+    assert (package.epoch, package.version, package.digest) == (
+        None, '5.1.2', None)
+    assert parse_query_output('') is None
+    with pytest.raises(RpmHeaderError):
+        parse_query_output('package cloudify-manager-install is not '
+                           'installed')
+
+
+def test_matches():
+    package = RpmPackage('cloudify-manager-install', '5.1.2', 'ga',
+                         arch='x86_64', digest='a' * 40)
+    assert package.matches(RpmPackage(
+        'cloudify-manager-install', '5.1.2', 'ga', arch='x86_64'))
+    assert not package.matches(RpmPackage(
+        'cloudify-manager-install', '5.1.2', 'ga', arch='x86_64',
+        digest='b' * 40))
+    assert not package.matches(RpmPackage(
+        'cloudify-manager-install', '5.1.1', 'ga', arch='x86_64'))
+    assert not package.matches(RpmPackage(
+        'cloudify-manager-install', '5.1.2', 'ga', epoch=1, arch='x86_64'))
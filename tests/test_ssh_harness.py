@@ -0,0 +1,158 @@
+import io
+import os
+import time
+
+import pytest
+import paramiko
+
+from cfy_cluster_manager.exceptions import RemoteTransportError
+from cfy_cluster_manager.ssh_harness import SSHServerHarness, strip_sudo
+from cfy_cluster_manager.throttle import transfer_stats, upload_throttle
+from cfy_cluster_manager.transport import FabricTransport
+from cfy_cluster_manager.utils import VM
+
+
+@pytest.fixture()
+def client_key_path(tmp_path):
+    key_path = str(tmp_path / 'client_key')
+    paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+    return key_path
+
+
+@pytest.fixture(autouse=True)
+def empty_stdin(monkeypatch):
+    # fabric forwards the local stdin to the remote commands, and reading
+    # pytest's captured stdin fails.
+    monkeypatch.setattr('sys.stdin', io.StringIO())
+
+
+@pytest.fixture()
+def server(tmp_path):
+    with SSHServerHarness(str(tmp_path / 'hosts')) as server:
+        yield server
+
+
+def _get_vm(server, client_key_path, transport='fabric'):
+    return VM(server.host, server.host, client_key_path, 'centos',
+              transport=transport, transport_options={'port': server.port})
+
+
+@pytest.mark.parametrize('transport', ['fabric', 'asyncssh'])
+def test_run_command(server, client_key_path, transport):
+    vm = _get_vm(server, client_key_path, transport)
+
+    vm.run_command('mkdir -p /tmp/test_dir', use_sudo=True)
+    assert vm.file_exists('/tmp/test_dir')
+    assert not vm.file_exists('/tmp/no_such_dir')
+
+    stats = server.stats
+    assert stats['commands'] == 3
+    assert stats['sudo_commands'] == 1
+    assert stats['channels'] >= 3
+    assert stats['bytes_received'] > 0
+    assert stats['bytes_sent'] > 0
+    vm.transport.close()
+
+
+@pytest.mark.parametrize('transport', ['fabric', 'asyncssh'])
+def test_put_file_and_dir(server, client_key_path, transport, tmp_path):
+    local_dir = tmp_path / 'local_dir'
+    (local_dir / 'sub_dir').mkdir(parents=True)
+    (local_dir / 'file_1').write_bytes(b'1' * 1000)
+    (local_dir / 'sub_dir' / 'file_2').write_bytes(b'2' * 2000)
+    (local_dir / 'file_1').chmod(0o600)
+    (local_dir / 'sub_dir' / 'file_2').chmod(0o755)
+    vm = _get_vm(server, client_key_path, transport)
+
+    vm.put_file(str(local_dir / 'file_1'), '/tmp/file_1')
+    vm.put_dir(str(local_dir), '/tmp/remote_dir')
+
+    with open(server.path('/tmp/remote_dir/sub_dir/file_2'), 'rb') as f:
+        assert f.read() == b'2' * 2000
+    for remote_path, mode in [('/tmp/file_1', 0o600),
+                              ('/tmp/remote_dir/file_1', 0o600),
+                              ('/tmp/remote_dir/sub_dir/file_2', 0o755)]:
+        assert os.stat(server.path(remote_path)).st_mode & 0o777 == mode
+    stats = server.stats
+    assert stats['sftp_bytes'] == 4000
+    assert stats['sftp_requests'] > 0
+    vm.transport.close()
+
+
+@pytest.mark.parametrize('transport', ['fabric', 'asyncssh'])
+def test_throttled_put_file(server, client_key_path, transport, tmp_path):
+    local_path = tmp_path / 'file'
+    local_path.write_bytes(b'1' * 200 * 1024)
+    local_path.chmod(0o750)
+    vm = _get_vm(server, client_key_path, transport)
+    upload_throttle.configure(max_host_rate=1024 ** 2)
+    transfer_stats.reset()
+    try:
+        vm.put_file(str(local_path), '/tmp/file')
+    finally:
+        upload_throttle.configure()
+        vm.transport.close()
+
+    with open(server.path('/tmp/file'), 'rb') as f:
+        assert f.read() == b'1' * 200 * 1024
+    assert os.stat(server.path('/tmp/file')).st_mode & 0o777 == 0o750
+    transfer, = transfer_stats.transfers
+    assert transfer.size == 200 * 1024
+    # 200KiB at 1MiB/s, less the initial burst of 100KiB
+    assert transfer.duration >= 0.09
+    assert transfer.throughput <= 2 * 1024 ** 2
+
+
+@pytest.mark.parametrize('transport', ['fabric', 'asyncssh'])
+def test_tuned_put_file(server, client_key_path, transport, tmp_path):
+    local_path = tmp_path / 'file'
+    local_path.write_bytes(b'1' * 1024 ** 2)
+    vm = VM(server.host, server.host, client_key_path, 'centos',
+            transport=transport,
+            transport_options={'port': server.port,
+                               'ciphers': ['aes256-ctr', 'unknown-cipher'],
+                               'compression': True,
+                               'sftp_request_size': 256 * 1024})
+    vm.put_file(str(local_path), '/tmp/file')
+    vm.transport.close()
+
+    with open(server.path('/tmp/file'), 'rb') as f:
+        assert f.read() == b'1' * 1024 ** 2
+    # 4 writes, and opening, closing and setting the file's attributes
+    assert server.stats['sftp_requests'] <= 4 + 4
+
+
+def test_delay_is_injected(tmp_path, client_key_path):
+    with SSHServerHarness(str(tmp_path / 'hosts'), delay=0.05) as server:
+        vm = _get_vm(server, client_key_path, 'asyncssh')
+        vm.test_connection()
+        server.reset_stats()
+
+        start_time = time.time()
+        vm.run_command('test -e /tmp', idempotent=True)
+        assert time.time() - start_time >= 0.05
+        assert server.stats['handshakes'] == 0
+        vm.transport.close()
+
+
+def test_dead_host_breaks_long_command(tmp_path, client_key_path,
+                                       monkeypatch):
+    with SSHServerHarness(str(tmp_path / 'hosts'), yum_duration=30) as \
+            server:
+        transport = FabricTransport(server.host, 'centos', client_key_path,
+                                    port=server.port, watchdog_interval=0.05)
+        # The host stops answering the probes, while its SSH session hangs
+        monkeypatch.setattr(transport, 'is_alive', lambda timeout: False)
+
+        start_time = time.time()
+        with pytest.raises(RemoteTransportError, match='stopped answering'):
+            transport.run('yum install -y /tmp/package.rpm', use_sudo=False,
+                          hide_stdout=True, connect_timeout=10, timeout=3600)
+        assert time.time() - start_time < 10
+
+
+def test_strip_sudo():
+    assert strip_sudo("sudo -S -p '[sudo] password: ' -H -u root ls /") == \
+        ('ls /', True)
+    assert strip_sudo("sudo -S -p '' test -e /tmp") == ('test -e /tmp', True)
+    assert strip_sudo('ls /') == ('ls /', False)
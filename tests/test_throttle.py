@@ -0,0 +1,107 @@
+import io
+import time
+import threading
+
+import pytest
+
+from cfy_cluster_manager.fake_transport import FakeTransport
+from cfy_cluster_manager.throttle import (parse_rate, ThrottledFile,
+                                          TokenBucket, TransferStats,
+                                          upload_throttle, UploadThrottle)
+
+
+@pytest.fixture(autouse=True)
+def reset_upload_throttle():
+    yield
+    upload_throttle.configure()
+
+
+@pytest.mark.parametrize('rate, expected', [
+    ('1000', 1000),
+    ('500K', 500 * 1024),
+    ('10M', 10 * 1024 ** 2),
+    ('1.5G', int(1.5 * 1024 ** 3)),
+    ('10MiB/s', 10 * 1024 ** 2),
+    ('2 mb', 2 * 1024 ** 2),
+])
+def test_parse_rate(rate, expected):
+    assert parse_rate(rate) == expected
+
+
+@pytest.mark.parametrize('rate', ['', 'fast', '10T', '0', '-1M'])
+def test_parse_invalid_rate(rate):
+    with pytest.raises(ValueError):
+        parse_rate(rate)
+
+
+def test_token_bucket_debt():
+    bucket = TokenBucket(rate=1000, burst=100)
+    assert bucket.reserve(100) == 0
+    # The next reservations queue behind the previous ones
+    assert bucket.reserve(500) == pytest.approx(0.5, abs=0.01)
+    assert bucket.reserve(500) == pytest.approx(1, abs=0.01)
+
+
+def test_parallel_uploads_share_the_rate():
+    throttle = UploadThrottle()
+    throttle.configure(max_rate=100 * 1024)
+
+    def upload(host):
+        file_obj = ThrottledFile(io.BytesIO(b'x' * 20 * 1024), host,
+                                 throttle)
+        while file_obj.read(4096):
+            pass
+
+    start_time = time.time()
+    threads = [threading.Thread(target=upload, args=(host,))
+               for host in ('192.0.2.1', '192.0.2.2', '192.0.2.3')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 60KiB at 100KiB/s, less the initial burst of 10KiB
+    assert time.time() - start_time >= 0.45
+
+
+def test_host_rates():
+    throttle = UploadThrottle()
+    throttle.configure(max_host_rate=1000, host_rates={'192.0.2.2': 10000})
+    assert throttle.enabled
+    throttle.reserve('192.0.2.1', 100)
+    throttle.reserve('192.0.2.2', 1000)
+    assert throttle.reserve('192.0.2.1', 1000) == pytest.approx(1, abs=0.01)
+    assert throttle.reserve('192.0.2.2', 1000) == pytest.approx(0.1,
+                                                                abs=0.01)
+    # Other hosts aren't held back by their neighbours' caps
+    assert throttle.reserve('192.0.2.3', 100) == 0
+
+
+def test_unlimited():
+    throttle = UploadThrottle()
+    assert not throttle.enabled
+    assert throttle.reserve('192.0.2.1', 10 ** 9) == 0
+
+
+def test_fake_upload_is_throttled(tmp_path):
+    local_path = tmp_path / 'file'
+    local_path.write_bytes(b'x' * 30 * 1024)
+    upload_throttle.configure(max_rate=100 * 1024)
+    transport = FakeTransport('192.0.2.10', 'centos',
+                              root_dir=str(tmp_path / 'fake_cluster'))
+
+    start_time = time.time()
+    transport.put_file(str(local_path), '/tmp/file', 10)
+    assert time.time() - start_time >= 0.2
+
+
+def test_transfer_report():
+    stats = TransferStats()
+    stats.record('192.0.2.1', '/tmp/cloudify.rpm', 4 * 1024 ** 2, 2)
+    stats.record('192.0.2.2', '/tmp/empty', 0, 0)
+
+    lines = stats.format_table().splitlines()
+    assert lines[0].split() == ['node', 'path', 'size', 'time', '(s)',
+                                'throughput']
+    assert lines[1].split() == ['192.0.2.1', '/tmp/cloudify.rpm', '4.0',
+                                'MiB', '2.0', '2.0', 'MiB/s']
+    assert lines[2].split()[-2:] == ['0.0', 'B/s']
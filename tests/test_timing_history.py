@@ -0,0 +1,55 @@
+import mock
+
+from cfy_cluster_manager.timing_history import (get_default_duration,
+                                                get_rpm_version,
+                                                StepTimings, TimingHistory)
+
+
+def _instance(name, private_ip):
+    return mock.Mock(type=name.split('-')[0], private_ip=private_ip)
+
+
+def _run(history, durations, version='5.1.2', success=True):
+    timings = StepTimings()
+    timings.start('install', version)
+    for (name, private_ip, step), duration in durations.items():
+        instance = _instance(name, private_ip)
+        instance.name = name
+        with mock.patch('time.time', side_effect=[0, duration]):
+            try:
+                with timings.step(instance, step):
+                    if not success:
+                        raise RuntimeError()
+            except RuntimeError:
+                pass
+    history.save(timings)
+
+
+def test_estimate_fallbacks(tmp_path):
+    history = TimingHistory(str(tmp_path / 'history' / 'timings.db'))
+    assert history.estimate('manager', 'cfy_manager install') == (
+        get_default_duration('manager', 'cfy_manager install'), 'default')
+
+    for duration in 100, 200, 600:
+        _run(history, {('manager-1', '10.0.0.1', 'cfy_manager install'):
+                       duration})
+    _run(history, {('manager-1', '10.0.0.1', 'cfy_manager install'): 900},
+         success=False)
+    _run(history, {('manager-2', '10.0.0.2', 'cfy_manager install'): 50},
+         version='5.1.1')
+
+    assert history.estimate('manager', 'cfy_manager install', '5.1.2',
+                            '10.0.0.1') == (200, 'host')
+    assert history.estimate('manager', 'cfy_manager install', '5.1.2',
+                            '10.0.0.3') == (200, 'version')
+    assert history.estimate('manager', 'cfy_manager install', '5.2',
+                            '10.0.0.3') == (150, 'role')
+    assert history.estimate('rabbitmq', 'upload')[1] == 'default'
+
+
+def test_get_rpm_version():
+    assert get_rpm_version('http://repository.cloudifysource.org/cloudify/'
+                           '5.1.2/ga-release/cloudify-manager-install-'
+                           '5.1.2-ga.el7.x86_64.rpm') == '5.1.2'
+    assert get_rpm_version('/tmp/cloudify-manager-install.rpm') == 'unknown'
+    assert get_rpm_version(None) == 'unknown'
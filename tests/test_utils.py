@@ -0,0 +1,55 @@
+import time
+
+import mock
+import pytest
+
+from cfy_cluster_manager.transport import CommandResult
+from cfy_cluster_manager.utils import (Deadline, DeadlineExceededError,
+                                       run, run_deadline, VM)
+
+
+@pytest.fixture()
+def deadline():
+    yield run_deadline
+    run_deadline.start(None)
+
+
+def test_deadline_bounds_timeout():
+    deadline = Deadline()
+    assert deadline.bound(30) == 30
+    assert deadline.bound(None) is None
+
+    deadline.start(10)
+    assert deadline.bound(30) <= 10
+    assert deadline.bound(5) == 5
+    assert deadline.bound(None) <= 10
+
+
+def test_deadline_exceeded():
+    deadline = Deadline()
+    deadline.start(0.01)
+    time.sleep(0.02)
+    with pytest.raises(DeadlineExceededError):
+        deadline.bound(30)
+
+
+def test_local_command_bounded_by_deadline(deadline):
+    deadline.start(0.5)
+    start_time = time.time()
+    with pytest.raises(DeadlineExceededError):
+        run(['sleep', '5'])
+    assert time.time() - start_time < 2
+
+
+@mock.patch('cfy_cluster_manager.utils.concurrency_limiter')
+def test_long_commands_are_not_metered(limiter):
+    vm = VM('192.0.2.1', None, None, 'centos')
+    vm.type = 'manager'
+    vm.transport = mock.Mock(connections=0)
+    vm.transport.run.return_value = CommandResult('', '', '', 0)
+
+    vm.run_command('cfy_manager install', timeout=3600)
+    limiter.slot.assert_not_called()
+    vm.run_command('test -e /tmp')
+    limiter.slot.assert_called_once_with('Running `test -e /tmp`', 0,
+                                         'manager')
@@ -195,3 +195,31 @@ def test_ssh_password_key_path_mutually_exc(three_nodes_config_dict):
         validate_config(config=three_nodes_config_dict,
                         using_three_nodes_cluster=True,
                         override=False)
+
+
+def test_validate_added_vm_names(three_nodes_config_dict):
+    for vm_name in ('manager-2', 'rabbitmq-x'):
+        three_nodes_config_dict['existing_vms'][vm_name] = {
+            'private_ip': '192.0.2.20', 'public_ip': '192.0.2.20'}
+    with pytest.raises(ClusterInstallError) as excinfo:
+        validate_config(config=three_nodes_config_dict,
+                        using_three_nodes_cluster=True,
+                        override=False)
+
+    assert 'The number of manager-2 should be greater than 3' in \
+        str(excinfo.value)
+    assert 'rabbitmq-x should be named `rabbitmq-<number>`' in \
+        str(excinfo.value)
+
+
+def test_colocated_nodes_of_the_same_type(nine_nodes_config_dict):
+    vms = nine_nodes_config_dict['existing_vms']
+    vms['rabbitmq-1']['private_ip'] = vms['manager-1']['private_ip']
+    vms['manager-2']['private_ip'] = vms['manager-1']['private_ip']
+    with pytest.raises(ClusterInstallError) as excinfo:
+        validate_config(config=nine_nodes_config_dict,
+                        using_three_nodes_cluster=False,
+                        override=False)
+
+    assert 'manager-1 and manager-2 are the same' in str(excinfo.value)
+    assert 'rabbitmq-1' not in str(excinfo.value)